@@ -0,0 +1,159 @@
+'''
+Benchmark page throughput of concurrent readers while runs are imported
+
+Usage:
+
+    python -m benchmarks.concurrency [--profile NAME ...] [--readers N]
+                                     [--database-url URL] [--output FILE]
+
+For each database profile (by default every entry of DATABASE_PROFILES) a
+scratch database is loaded with the first run of each method, then reader
+threads request method pages while the remaining runs are imported.
+Without --database-url a new temporary SQLite file is used per profile.
+Results are written as JSON.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from config import Config
+from metabolite_database import create_app, db
+from metabolite_database.importer import load_knowns, read_knowns_csv
+from metabolite_database.models import ChromatographyMethod
+from benchmarks.run import benchmark_config, git_commit
+from benchmarks.synthetic import SyntheticDataset
+
+
+def reader(client, urls, stop, latencies, errors):
+    i = 0
+    while not stop.is_set():
+        url = urls[i % len(urls)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            response = client.get(url)
+            response.get_data()
+        except Exception:
+            errors.append(url)
+            continue
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(url)
+
+
+def run_profile(profile, database_url, dataset, workdir, num_readers,
+                min_seconds):
+    '''Return throughput of readers during an import for one profile'''
+    config = benchmark_config(database_url)
+    config.DATABASE_PROFILE = profile
+    app = create_app(config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        runs, lists = dataset.write_files(workdir)
+        initial, pending = [], []
+        seen = set()
+        for run in runs:
+            (pending if run[1] in seen else initial).append(run)
+            seen.add(run[1])
+        for path, method, date, operator in initial:
+            load_knowns(read_knowns_csv(path), method, date, operator)
+        urls = ['/method/{}'.format(m.id)
+                for m in ChromatographyMethod.query.all()]
+        db.session.remove()
+
+        stop = threading.Event()
+        latencies = []
+        errors = []
+        threads = [threading.Thread(
+            target=reader, args=(app.test_client(), urls, stop, latencies,
+                                 errors)) for _ in range(num_readers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        import_start = time.perf_counter()
+        import_errors = 0
+        for path, method, date, operator in pending:
+            try:
+                load_knowns(read_knowns_csv(path), method, date, operator)
+            except Exception:
+                db.session.rollback()
+                import_errors += 1
+        import_seconds = time.perf_counter() - import_start
+        remaining = min_seconds - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+    latencies.sort()
+    return {'profile': profile,
+            'readers': num_readers,
+            'seconds': elapsed,
+            'reads': len(latencies),
+            'reads_per_second': len(latencies) / elapsed,
+            'read_errors': len(errors),
+            'median_latency': (statistics.median(latencies)
+                               if latencies else None),
+            'p95_latency': (latencies[int(len(latencies) * 0.95)]
+                            if latencies else None),
+            'imported_runs': len(pending) - import_errors,
+            'import_errors': import_errors,
+            'import_seconds': import_seconds}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--profile', action='append', default=[],
+                        choices=sorted(Config.DATABASE_PROFILES),
+                        help="Database profile to benchmark (repeatable)")
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0,
+                        help="Minimum time to keep readers running")
+    parser.add_argument('--compounds', type=int, default=2000)
+    parser.add_argument('--methods', type=int, default=2)
+    parser.add_argument('--runs-per-method', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', default=None,
+                        help="Scratch database to use for every profile")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    profiles = args.profile or sorted(Config.DATABASE_PROFILES)
+    dataset = SyntheticDataset(
+        num_compounds=args.compounds, num_methods=args.methods,
+        runs_per_method=args.runs_per_method, num_lists=0, seed=args.seed)
+    report = {'commit': git_commit(),
+              'timestamp': datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'parameters': {'compounds': args.compounds,
+                             'methods': args.methods,
+                             'runs_per_method': args.runs_per_method,
+                             'seed': args.seed},
+              'results': []}
+    for profile in profiles:
+        with tempfile.TemporaryDirectory() as workdir:
+            url = args.database_url or 'sqlite:///' + os.path.join(
+                workdir, 'bench.db')
+            report['results'].append(run_profile(
+                profile, url, dataset, workdir, args.readers, args.seconds))
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
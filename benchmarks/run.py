@@ -0,0 +1,207 @@
+'''
+Benchmark formula parsing, imports, queries and pages on synthetic data
+
+Usage:
+
+    python -m benchmarks.run [--compounds N] [--database-url URL ...]
+                             [--output results.json]
+
+Each database URL must point to a scratch database: all tables are dropped
+and recreated. Without --database-url a temporary SQLite file is used; set
+BENCHMARK_POSTGRES_URL to also benchmark a local PostgreSQL server. Results
+are written as JSON so runs from different commits can be compared.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from config import Config
+from metabolite_database import create_app, db
+from metabolite_database.importer import load_knowns, read_knowns_csv
+from metabolite_database.models import (ChromatographyMethod, Compound,
+                                        CompoundList, compoundlists,
+                                        formula_monoisotopic_mass)
+from metabolite_database.name_search import search_compound_names
+from benchmarks.synthetic import SyntheticDataset
+
+
+def benchmark_config(database_url):
+    class BenchmarkConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        CACHE_TYPE = 'null'
+        SQLALCHEMY_DATABASE_URI = database_url
+    return BenchmarkConfig
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(name, samples, **extra):
+    result = {'name': name,
+              'samples': len(samples),
+              'min': min(samples),
+              'median': statistics.median(samples),
+              'mean': statistics.mean(samples)}
+    result.update(extra)
+    return result
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_benchmarks(database_url, dataset, workdir, repeat=5):
+    '''Return list of timing results for one database'''
+    app = create_app(benchmark_config(database_url))
+    results = []
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        formulas = [formula for name, formula in dataset.compounds]
+        results.append(summarize(
+            'formula_parse',
+            timed(lambda: [formula_monoisotopic_mass(f) for f in formulas],
+                  repeat),
+            items=len(formulas)))
+
+        runs, lists = dataset.write_files(workdir)
+        samples = []
+        for path, method, date, operator in runs:
+            start = time.perf_counter()
+            load_knowns(read_knowns_csv(path), method, date, operator)
+            samples.append(time.perf_counter() - start)
+        results.append(summarize('import_csv', samples,
+                                 items=len(dataset.compounds)))
+
+        ids = dict(db.session.query(Compound.name, Compound.id))
+        for name, indexes in dataset.compound_lists:
+            compound_list = CompoundList(name=name)
+            db.session.add(compound_list)
+            db.session.flush()
+            db.session.execute(compoundlists.insert(), [
+                {'compound_id': ids[dataset.compounds[i][0]],
+                 'compound_list_id': compound_list.id} for i in indexes])
+        db.session.commit()
+
+        method = ChromatographyMethod.query.first()
+        compound_list = CompoundList.query.first()
+        results.append(summarize(
+            'retention_time_means',
+            timed(lambda: method.retention_time_means(), repeat)))
+        results.append(summarize(
+            'retention_time_means_compound_list',
+            timed(lambda: method.retention_time_means(
+                compound_list_id=compound_list.id), repeat)))
+        results.append(summarize(
+            'compounds_with_retention_times',
+            timed(lambda: method.compounds_with_retention_times().all(),
+                  repeat)))
+
+        names = [name for name, formula in
+                 dataset.compounds[::max(len(dataset.compounds) // 20, 1)]]
+        results.append(summarize(
+            'search_compound_names_prefix',
+            timed(lambda: [search_compound_names(name[:-2])
+                           for name in names], repeat),
+            items=len(names)))
+        results.append(summarize(
+            'search_compound_names_fuzzy',
+            timed(lambda: [search_compound_names(
+                name.replace('compound', 'compuond')) for name in names],
+                repeat),
+            items=len(names)))
+
+        client = app.test_client()
+        pages = [
+            ('GET', '/compounds', None),
+            ('GET', '/api/compounds?length=50', None),
+            ('GET', '/api/search/compound?q=compound-0001', None),
+            ('GET', '/compound/1', None),
+            ('GET', '/compound_lists', None),
+            ('GET', '/compound_list/{}'.format(compound_list.id), None),
+            ('GET', '/methods', None),
+            ('GET', '/method/{}'.format(method.id), None),
+            ('POST', '/method/{}'.format(method.id),
+             {'compoundlist': 0, 'submit': 'Get List',
+              'standardruns': [r.id for r in method.standard_runs]}),
+            ('GET', '/method/{}/export?mode=both'.format(method.id), None),
+            ('GET', '/standard_runs', None),
+            ('GET', '/standard_run/1', None),
+        ]
+        for http_method, url, data in pages:
+            def request():
+                response = client.open(url, method=http_method, data=data)
+                response.get_data()
+                assert response.status_code == 200, (url,
+                                                     response.status_code)
+            results.append(summarize(
+                'route {} {}'.format(http_method, url),
+                timed(request, repeat)))
+        db.session.remove()
+        db.drop_all()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--compounds', type=int, default=2000)
+    parser.add_argument('--methods', type=int, default=3)
+    parser.add_argument('--runs-per-method', type=int, default=3)
+    parser.add_argument('--lists', type=int, default=5)
+    parser.add_argument('--list-size', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url', action='append', default=[],
+                        help="Scratch database to benchmark (repeatable)")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    params = {'compounds': args.compounds, 'methods': args.methods,
+              'runs_per_method': args.runs_per_method, 'lists': args.lists,
+              'list_size': args.list_size, 'seed': args.seed}
+    dataset = SyntheticDataset(
+        num_compounds=args.compounds, num_methods=args.methods,
+        runs_per_method=args.runs_per_method, num_lists=args.lists,
+        list_size=args.list_size, seed=args.seed)
+    report = {'commit': git_commit(),
+              'timestamp': datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'parameters': params,
+              'databases': []}
+    with tempfile.TemporaryDirectory() as workdir:
+        urls = list(args.database_url)
+        if not urls:
+            urls.append('sqlite:///' + os.path.join(workdir, 'bench.db'))
+            if os.environ.get('BENCHMARK_POSTGRES_URL'):
+                urls.append(os.environ['BENCHMARK_POSTGRES_URL'])
+        for url in urls:
+            results = run_benchmarks(url, dataset, workdir, args.repeat)
+            report['databases'].append({'dialect': url.split(':', 1)[0],
+                                        'results': results})
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
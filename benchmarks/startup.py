@@ -0,0 +1,140 @@
+'''
+Benchmark start up time of the application for each APP_PROFILE
+
+Usage:
+
+    python -m benchmarks.startup [--profile NAME ...] [--repeat N]
+                                 [--imports N] [--output FILE]
+
+Every sample is a new Python process, as for each `flask` command run by a
+script. Three times are recorded per profile: importing the package and
+its commands, running create_app, and the wall time of a whole
+`flask --help` (which loads the app to list its commands). The 'default'
+profile leaves APP_PROFILE unset, as for a plain `flask` command. One more
+process runs with `python -X importtime` to list the slowest imports.
+Results are written as JSON.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from metabolite_database import app_profiles
+from benchmarks.run import git_commit, summarize
+
+benchmark_profiles = app_profiles + ('default',)
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from metabolite_database import create_app, cli
+imported = time.perf_counter()
+app = create_app()
+cli.register(app)
+created = time.perf_counter()
+sys.stdout.write(json.dumps({'import': imported - start,
+                             'create_app': created - imported}))
+'''
+
+
+def environment(profile, workdir):
+    env = dict(os.environ)
+    env.pop('APP_PROFILE', None)
+    if profile != 'default':
+        env['APP_PROFILE'] = profile
+    env.update({'DATABASE_URL': 'sqlite:///' + os.path.join(workdir,
+                                                            'bench.db'),
+                'MASS_INDEX_DIR': '',
+                'PYTHONPATH': os.pathsep.join(
+                    [basedir] + [p for p in [env.get('PYTHONPATH')] if p])})
+    return env
+
+
+def parse_importtime(stderr):
+    '''Return (module, self seconds, cumulative seconds, depth) tuples from
+    `python -X importtime` output'''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except (IndexError, ValueError):
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), self_us / 1e6, cumulative_us / 1e6,
+                        depth))
+    return imports
+
+
+def run_profile(profile, workdir, repeat, num_imports):
+    '''Return start up timings of one profile'''
+    env = environment(profile, workdir)
+    imports, apps, commands = [], [], []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT], cwd=workdir, env=env,
+            stderr=subprocess.DEVNULL)
+        sample = json.loads(output)
+        imports.append(sample['import'])
+        apps.append(sample['create_app'])
+        start = time.perf_counter()
+        subprocess.check_output(
+            [sys.executable, '-m', 'flask', '--app',
+             os.path.join(basedir, 'main.py'), '--help'],
+            cwd=workdir, env=env, stderr=subprocess.DEVNULL)
+        commands.append(time.perf_counter() - start)
+    traced = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+        cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    modules = parse_importtime(traced.stderr)
+    modules.sort(key=lambda m: m[2], reverse=True)
+    return {'profile': profile,
+            'timings': [summarize('import', imports),
+                        summarize('create_app', apps),
+                        summarize('flask_command', commands)],
+            'modules_imported': len(modules),
+            'slowest_imports': [
+                {'module': name, 'self': self_seconds,
+                 'cumulative': cumulative, 'depth': depth}
+                for name, self_seconds, cumulative, depth
+                in modules[:num_imports]]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--profile', action='append', default=[],
+                        choices=benchmark_profiles,
+                        help="App profile to benchmark (repeatable)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--imports', type=int, default=20,
+                        help="Number of slowest imports to list")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    report = {'commit': git_commit(),
+              'timestamp': datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'parameters': {'repeat': args.repeat},
+              'results': []}
+    for profile in args.profile or benchmark_profiles:
+        with tempfile.TemporaryDirectory() as workdir:
+            report['results'].append(run_profile(
+                profile, workdir, args.repeat, args.imports))
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''Deterministic synthetic lab-scale data for benchmarks'''
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+from metabolite_database.models import valid_atoms
+
+# Maximum count of each atom in generated formulas; atoms of valid_atoms
+# not listed here (such as electrons) are never used
+atom_ranges = {
+    'C': (1, 40),
+    'H': (1, 80),
+    'N': (0, 6),
+    'O': (0, 16),
+    'P': (0, 3),
+    'S': (0, 2),
+    'I': (0, 1),
+}
+
+
+def random_formula(rng):
+    '''Return a random formula in Hill order built from valid_atoms'''
+    formula = ''
+    for atom in ['C', 'H'] + sorted(set(atom_ranges) - {'C', 'H'}):
+        assert atom in valid_atoms
+        low, high = atom_ranges[atom]
+        count = rng.randint(low, high)
+        if atom == 'I' and rng.random() > 0.02:
+            count = 0
+        if count == 1:
+            formula += atom
+        elif count > 1:
+            formula += '{}{}'.format(atom, count)
+    return formula
+
+
+class SyntheticDataset(object):
+    '''
+    Compounds, methods, standard runs and compound lists for benchmarks
+
+    The same arguments always produce the same dataset.
+    '''
+    def __init__(self, num_compounds=1000, num_methods=3, runs_per_method=3,
+                 num_lists=5, list_size=100, coverage=0.8, seed=0):
+        rng = random.Random(seed)
+        self.compounds = [('compound-{:06d}'.format(i), random_formula(rng))
+                          for i in range(num_compounds)]
+        self.methods = ['method-{}'.format(i) for i in range(num_methods)]
+        # (method, date, operator, [(compound index, rt)])
+        self.runs = []
+        start = datetime(2018, 1, 1)
+        for m, method in enumerate(self.methods):
+            base_rts = [rng.uniform(30, 1800) for _ in self.compounds]
+            for r in range(runs_per_method):
+                date = start + timedelta(days=30 * r, hours=m)
+                drift = rng.uniform(-5, 5)
+                rts = [(i, round(base_rts[i] + drift + rng.gauss(0, 1), 3))
+                       for i in range(num_compounds)
+                       if rng.random() < coverage]
+                self.runs.append((method, date, 'operator-{}'.format(r), rts))
+        self.compound_lists = [
+            ('list-{}'.format(i),
+             sorted(rng.sample(range(num_compounds),
+                               min(list_size, num_compounds))))
+            for i in range(num_lists)]
+
+    def write_knowns_csv(self, path, run):
+        '''Write a knowns CSV file for one of `runs`'''
+        with open(path, 'w') as csvfh:
+            writer = csv.writer(csvfh)
+            writer.writerow(['Name', 'Formula', 'RT'])
+            for i, rt in run[3]:
+                name, formula = self.compounds[i]
+                writer.writerow([name, formula, rt])
+        return path
+
+    def write_files(self, directory):
+        '''
+        Write knowns CSV files for every run and compound list CSV files
+
+        Returns a list of (path, method, date, operator) for the runs and of
+        (path, name) for the compound lists.
+        '''
+        runs = []
+        for i, run in enumerate(self.runs):
+            path = os.path.join(directory, 'knowns-{}.csv'.format(i))
+            self.write_knowns_csv(path, run)
+            runs.append((path, run[0], run[1], run[2]))
+        lists = []
+        for name, indexes in self.compound_lists:
+            path = os.path.join(directory, '{}.csv'.format(name))
+            with open(path, 'w') as csvfh:
+                writer = csv.writer(csvfh)
+                for i in indexes:
+                    writer.writerow([self.compounds[i][0]])
+            lists.append((path, name))
+        return runs, lists
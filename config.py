@@ -10,9 +10,74 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 'web' sets up the whole site; 'cli' only the database, cache and
+    # commands, for scripts that run many short flask commands. Unset, it
+    # is chosen from the flask command (see create_app)
+    APP_PROFILE = os.environ.get('APP_PROFILE')
+    # Optional read-only copy of the database used by the main GET pages
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    # Engine tuning: 'baseline' uses library defaults, 'tuned' sizes the
+    # connection pool and enables WAL and larger caches on SQLite
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or 'tuned'
+    DATABASE_PROFILES = {
+        'baseline': {},
+        'tuned': {
+            'engine_options': {
+                'postgresql': {
+                    'pool_size': 10,
+                    'max_overflow': 20,
+                    'pool_pre_ping': True,
+                    'pool_recycle': 1800,
+                    'query_cache_size': 1200,
+                },
+                'sqlite': {
+                    'pool_size': 10,
+                    'max_overflow': 20,
+                },
+            },
+            'sqlite_pragmas': {
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'mmap_size': 256 * 1024 * 1024,
+                'cache_size': -64 * 1024,
+                'busy_timeout': 5000,
+            },
+        },
+    }
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['lparsons@princeton.edu']
+    # Page and query cache: 'null', 'lru' (per process) or 'filesystem'
+    # (shared by all processes using CACHE_DIR)
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'lru'
+    CACHE_DIR = os.environ.get('CACHE_DIR')
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 1000)
+    # Directory of memory-mapped compound mass indexes shared by all
+    # processes; set to an empty value to build the index in memory
+    MASS_INDEX_DIR = os.environ.get(
+        'MASS_INDEX_DIR', os.path.join(basedir, 'mass_index'))
+    # Files uploaded for background import jobs (see flask run-jobs)
+    UPLOAD_DIR = os.environ.get('UPLOAD_DIR') or os.path.join(basedir,
+                                                              'uploads')
+    # Workers update the heartbeat of a running job this often; running
+    # jobs without a heartbeat for JOB_TIMEOUT_SECONDS are assumed lost
+    # with their worker
+    JOB_HEARTBEAT_SECONDS = float(
+        os.environ.get('JOB_HEARTBEAT_SECONDS') or 30)
+    JOB_TIMEOUT_SECONDS = int(os.environ.get('JOB_TIMEOUT_SECONDS') or 300)
+    MAX_CONTENT_LENGTH = 64 * 1024 * 1024
+    # Request profiling: Server-Timing headers, Prometheus metrics at
+    # /_metrics and a log of requests slower than SLOW_REQUEST_SECONDS
+    INSTRUMENTATION_ENABLED = os.environ.get(
+        'INSTRUMENTATION_ENABLED', '1') not in ('0', 'false', 'False', '')
+    SERVER_TIMING_HEADER = True
+    # /_metrics is off unless enabled; it then answers requests carrying
+    # METRICS_TOKEN as a bearer token, or only local requests without one
+    METRICS_ENDPOINT = os.environ.get(
+        'METRICS_ENDPOINT', '0') not in ('0', 'false', 'False', '')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SLOW_REQUEST_SECONDS = float(
+        os.environ.get('SLOW_REQUEST_SECONDS') or 1.0)
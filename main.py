@@ -3,7 +3,7 @@ from metabolite_database import db
 from metabolite_database import cli
 from metabolite_database.models import (
     Compound, CompoundList, DbXref, ExternalDatabase, RetentionTime,
-    ChromatographyMethod, StandardRun)
+    ChromatographyMethod, StandardRun, Synonym)
 
 
 app = create_app()
@@ -19,4 +19,5 @@ def make_shell_context():
             'ExternalDatabase': ExternalDatabase,
             'RetentionTime': RetentionTime,
             'ChromatographyMethod': ChromatographyMethod,
-            'StandardRun': StandardRun}
+            'StandardRun': StandardRun,
+            'Synonym': Synonym}
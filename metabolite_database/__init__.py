@@ -1,15 +1,18 @@
 import logging
 import os
+import sys
 from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from logging.handlers import SMTPHandler
 from logging.handlers import RotatingFileHandler
-from flask_bootstrap import Bootstrap
 from sqlalchemy import MetaData
-from flask_moment import Moment
-from flask_bootstrap import StaticCDN
+from sqlalchemy.engine import make_url
+from metabolite_database.cache import Cache
+from metabolite_database.database import (RoutingSession, apply_sqlite_pragmas,
+                                          configure_database, replica_engine)
+from metabolite_database.instrumentation import Instrumentation
 
 naming_convention = {
     "ix": 'ix_%(column_0_label)s',
@@ -18,26 +21,87 @@ naming_convention = {
     "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
     "pk": "pk_%(table_name)s",
 }
-db = SQLAlchemy(metadata=MetaData(naming_convention=naming_convention))
+db = SQLAlchemy(metadata=MetaData(naming_convention=naming_convention),
+                session_options={'class_': RoutingSession})
 
 migrate = Migrate()
-bootstrap = Bootstrap()
-moment = Moment()
+cache = Cache()
+instrumentation = Instrumentation()
 
+app_profiles = ('web', 'cli')
 
-def create_app(config_class=Config):
+# flask commands that need the 'web' profile
+web_commands = ('run', 'routes', 'shell')
+
+# flask options taking a value, skipped when looking for the command
+flask_value_options = ('-A', '--app', '-e', '--env-file')
+
+
+def command_profile(argv=None):
+    '''
+    Return the profile for the flask command loading the app
+
+    'cli' when the app is loaded by the flask command line for anything
+    but web_commands (including listing the commands), 'web' for those
+    and None when the app is not loaded by the flask command line.
+    '''
+    import click
+    from flask.cli import ScriptInfo
+    context = click.get_current_context(silent=True)
+    if context is None or context.find_object(ScriptInfo) is None:
+        return None
+    args = iter(sys.argv[1:] if argv is None else argv)
+    for arg in args:
+        if arg in flask_value_options:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return 'web' if arg in web_commands else 'cli'
+    return 'cli'
+
+
+def create_app(config_class=Config, profile=None):
+    '''
+    Create the application for an APP_PROFILE
+
+    The 'cli' profile sets up only the database, migrations and cache: the
+    web-only extensions, blueprints, templates and request instrumentation
+    are neither imported nor initialized, so short-lived commands start
+    faster. Without an APP_PROFILE, commands run by the flask command line
+    use 'cli' except for web_commands.
+    '''
     app = Flask(__name__)
     app.config.from_object(config_class)
+    profile = (profile or app.config.get('APP_PROFILE') or command_profile()
+               or 'web')
+    if profile not in app_profiles:
+        raise ValueError("Invalid APP_PROFILE '{}'".format(profile))
+    app.config['APP_PROFILE'] = profile
 
+    configure_database(app)
     db.init_app(app)
     with app.app_context():
-        if db.engine.url.drivername == 'sqlite':
-            migrate.init_app(app, db, render_as_batch=True)
-        else:
-            migrate.init_app(app, db)
-    bootstrap.init_app(app)
+        apply_sqlite_pragmas(app, [db.engine, replica_engine(app)])
+    # The dialect is read from the URL so no connection is made here
+    if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() \
+            == 'sqlite':
+        migrate.init_app(app, db, render_as_batch=True)
+    else:
+        migrate.init_app(app, db)
+    cache.init_app(app)
+    if profile == 'web':
+        init_web(app)
+    init_logging(app)
+    return app
+
+
+def init_web(app):
+    '''Set up the extensions and blueprints only used to serve pages'''
+    from flask_bootstrap import Bootstrap, StaticCDN
+    from flask_moment import Moment
+    Bootstrap(app)
     app.extensions['bootstrap']['cdns']['jquery'] = StaticCDN()
-    moment.init_app(app)
+    Moment(app)
+    instrumentation.init_app(app)
 
     # Blueprint registration
     from metabolite_database.errors import bp as errors_bp  # noqa: E402,F401
@@ -46,7 +110,11 @@ def create_app(config_class=Config):
     app.register_blueprint(main_bp)
     from metabolite_database.auth import bp as auth_bp  # noqa: E402,F401
     app.register_blueprint(auth_bp)
+    from metabolite_database.api import bp as api_bp  # noqa: E402,F401
+    app.register_blueprint(api_bp, url_prefix='/api')
 
+
+def init_logging(app):
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
             auth = None
@@ -79,9 +147,8 @@ def create_app(config_class=Config):
         app.logger.addHandler(file_handler)
 
         app.logger.setLevel(logging.INFO)
-        app.logger.info('Metabolite Database startup')
-
-    return app
+        if app.config['APP_PROFILE'] == 'web':
+            app.logger.info('Metabolite Database startup')
 
 
 from metabolite_database import models  # noqa: E402,F401
@@ -0,0 +1,75 @@
+'''
+Monotone piecewise-linear retention time alignment
+
+A run is aligned to a reference run by fitting a monotone mapping from the
+run's retention times to the reference retention times of the compounds
+both runs share. The mapping is stored as knots and applied with linear
+interpolation, extrapolating outside the knots with the offset of the
+nearest knot.
+'''
+import numpy as np
+
+# Number of compounds per knot of the fitted curve
+POINTS_PER_KNOT = 10
+MAX_KNOTS = 20
+
+
+def _isotonic(values, weights):
+    '''Return the weighted non-decreasing fit of values (pool adjacent
+    violators)'''
+    blocks = []
+    for value, weight in zip(values, weights):
+        blocks.append([value, weight, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            value, weight, size = blocks.pop()
+            prev = blocks[-1]
+            total = prev[1] + weight
+            prev[0] = (prev[0] * prev[1] + value * weight) / total
+            prev[1] = total
+            prev[2] += size
+    fit = []
+    for value, weight, size in blocks:
+        fit.extend([value] * size)
+    return np.array(fit)
+
+
+def fit_alignment(run_rts, reference_rts):
+    '''
+    Return (knots_x, knots_y) mapping run retention times to the reference
+
+    The run's retention times are split into quantile bins; each bin gives a
+    knot at the median run RT and the median RT plus median offset to the
+    reference. Knot values are then made non-decreasing. With fewer than two
+    knots the fit is a constant offset, and with no shared compounds it is
+    the identity.
+    '''
+    x = np.asarray(run_rts, dtype=float)
+    y = np.asarray(reference_rts, dtype=float)
+    if len(x) == 0:
+        return [], []
+    order = np.argsort(x)
+    x, offsets = x[order], (y - x)[order]
+    num_knots = int(min(MAX_KNOTS, max(1, len(x) // POINTS_PER_KNOT)))
+    bins = np.array_split(np.arange(len(x)), num_knots)
+    knots_x = np.array([np.median(x[b]) for b in bins])
+    knots_offset = np.array([np.median(offsets[b]) for b in bins])
+    weights = np.array([len(b) for b in bins], dtype=float)
+    knots_y = _isotonic(knots_x + knots_offset, weights)
+    # Merge knots that share an x value
+    keep = np.concatenate([[True], np.diff(knots_x) > 0])
+    return knots_x[keep].tolist(), knots_y[keep].tolist()
+
+
+def apply_alignment(knots_x, knots_y, rts):
+    '''Return retention times mapped through the fitted knots'''
+    rts = np.asarray(rts, dtype=float)
+    if not len(knots_x):
+        return rts.copy()
+    knots_x = np.asarray(knots_x, dtype=float)
+    knots_y = np.asarray(knots_y, dtype=float)
+    aligned = np.interp(rts, knots_x, knots_y)
+    below = rts < knots_x[0]
+    aligned[below] = rts[below] + (knots_y[0] - knots_x[0])
+    above = rts > knots_x[-1]
+    aligned[above] = rts[above] + (knots_y[-1] - knots_x[-1])
+    return aligned
@@ -0,0 +1,281 @@
+'''
+Annotate LC-MS feature tables with known compounds
+
+A feature table lists the m/z, retention time and (optionally) intensity of
+detected peaks. Each feature is matched against the [M+H]+ or [M-H]- m/z of
+every compound with a mean retention time for a chromatography method,
+within a ppm window and a retention time window, and its candidates are
+ranked by their combined distance in both dimensions.
+
+The reference compounds are sorted by m/z once. Features are then processed
+in blocks: the m/z window of every feature in a block is located with one
+vectorized binary search (a sort-merge of the two m/z columns), and the
+candidate pairs are expanded, filtered and ranked with array operations, so
+there is no per-feature loop over compounds. Results are generated block by
+block and can be streamed as they are produced.
+'''
+import csv
+import io
+import itertools
+import json
+from collections import namedtuple
+import numpy as np
+from metabolite_database.search import PROTON_MASS, mass_tolerance
+
+# Accepted (case-insensitive) header names for each feature table column
+feature_columns = {
+    'id': ('id', 'feature', 'feature_id', 'name'),
+    'mz': ('mz', 'm/z', 'mzmed', 'm_z'),
+    'rt': ('rt', 'rtmed', 'retention_time', 'retention time'),
+    'intensity': ('intensity', 'area', 'height', 'into'),
+}
+
+# Number of features matched per vectorized block
+BLOCK_SIZE = 5000
+
+annotation_header = ['feature_id', 'feature_mz', 'feature_rt', 'intensity',
+                     'rank', 'compound_id', 'compound_name',
+                     'molecular_formula', 'compound_mz', 'ppm_error',
+                     'compound_rt', 'rt_error', 'distance']
+
+annotation_formats = ('csv', 'ndjson')
+
+Candidate = namedtuple('Candidate', ['rank', 'compound_id', 'name',
+                                     'molecular_formula', 'mz', 'ppm_error',
+                                     'rt', 'rt_error', 'distance'])
+
+
+class FeatureTable(object):
+    '''Feature ids, m/z, retention times and intensities as arrays'''
+    def __init__(self, ids, mz, rt, intensity=None):
+        self.ids = list(ids)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        if intensity is None:
+            intensity = np.full(len(self.mz), np.nan)
+        self.intensity = np.asarray(intensity, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.mz)
+
+
+def _find_columns(fieldnames):
+    lowered = {name.strip().lower(): name for name in fieldnames or []}
+    columns = {}
+    for key, aliases in feature_columns.items():
+        for alias in aliases:
+            if alias in lowered:
+                columns[key] = lowered[alias]
+                break
+    missing = [key for key in ('mz', 'rt') if key not in columns]
+    if missing:
+        raise ValueError(
+            "Feature table must have m/z and retention time columns (one "
+            "of {} and one of {})".format(', '.join(feature_columns['mz']),
+                                          ', '.join(feature_columns['rt'])))
+    return columns
+
+
+def read_feature_table(fh):
+    '''
+    Return a FeatureTable read from a CSV (or tab delimited) file object
+
+    Features without an id column are numbered from 1. Raises ValueError
+    if the m/z or retention time columns are missing or not numbers.
+    '''
+    header = fh.readline()
+    delimiter = '\t' if '\t' in header else ','
+    reader = csv.DictReader(itertools.chain([header], fh),
+                            delimiter=delimiter)
+    columns = _find_columns(reader.fieldnames)
+    ids, mz, rt, intensity = [], [], [], []
+    for line, row in enumerate(reader, start=2):
+        try:
+            mz.append(float(row[columns['mz']]))
+            rt.append(float(row[columns['rt']]))
+        except (TypeError, ValueError):
+            raise ValueError("Line {}: m/z and retention time must be "
+                             "numbers".format(line))
+        ids.append(row[columns['id']] if 'id' in columns else len(ids) + 1)
+        value = row.get(columns.get('intensity'))
+        try:
+            intensity.append(float(value))
+        except (TypeError, ValueError):
+            intensity.append(np.nan)
+    return FeatureTable(ids, mz, rt, intensity)
+
+
+class ReferenceTable(object):
+    '''Compound m/z and mean retention times for one method, sorted by m/z'''
+    def __init__(self, compound_ids, names, formulas, mz, rt):
+        order = np.argsort(mz, kind='stable')
+        self.compound_ids = np.asarray(compound_ids, dtype=np.int64)[order]
+        self.names = [names[i] for i in order]
+        self.formulas = [formulas[i] for i in order]
+        self.mz = np.asarray(mz, dtype=np.float64)[order]
+        self.rt = np.asarray(rt, dtype=np.float64)[order]
+
+    @classmethod
+    def for_method(cls, method, mode, standard_run_ids=None,
+                   compound_list_id=None, aligned=False):
+        '''
+        Return the reference of compounds with retention times in `method`
+
+        Compounds are placed at their [M+H]+ or [M-H]- m/z for ionization
+        `mode` (1 or -1); run, compound list and alignment options are
+        those of ChromatographyMethod.retention_time_means.
+        '''
+        ids, names, formulas, mz, rt = [], [], [], [], []
+        for mean in method.iter_retention_time_means(
+                standard_run_ids=standard_run_ids,
+                compound_list_id=compound_list_id, yield_per=1000,
+                aligned=aligned):
+            compound = mean.compound
+            if mean.mean_rt is None or compound.monoisotopic_mass is None:
+                continue
+            ids.append(compound.id)
+            names.append(compound.name)
+            formulas.append(compound.molecular_formula)
+            mz.append(compound.monoisotopic_mass + PROTON_MASS * mode)
+            rt.append(mean.mean_rt)
+        return cls(ids, names, formulas, mz, rt)
+
+    def __len__(self):
+        return len(self.mz)
+
+
+def _match_block(features, reference, start, end, ppm, rt_tolerance):
+    '''
+    Return candidate pairs for features[start:end]
+
+    The arrays of feature index, reference index, ppm error, retention time
+    error and distance are sorted by feature and then distance.
+    '''
+    mz = features.mz[start:end]
+    rt = features.rt[start:end]
+    delta = mass_tolerance(mz, ppm)
+    low = np.searchsorted(reference.mz, mz - delta, side='left')
+    high = np.searchsorted(reference.mz, mz + delta, side='right')
+    counts = high - low
+    # Expand each feature's window [low, high) into explicit pairs
+    feature = np.repeat(np.arange(len(mz)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    ref = np.repeat(low, counts) + offsets
+    rt_error = rt[feature] - reference.rt[ref]
+    keep = np.abs(rt_error) <= rt_tolerance
+    feature, ref, rt_error = feature[keep], ref[keep], rt_error[keep]
+    ppm_error = (mz[feature] - reference.mz[ref]) / reference.mz[ref] * 1e6
+    distance = np.hypot(ppm_error / ppm, rt_error / rt_tolerance)
+    order = np.lexsort((distance, feature))
+    return (feature[order] + start, ref[order], ppm_error[order],
+            rt_error[order], distance[order])
+
+
+def annotate_features(features, reference, ppm=5.0, rt_tolerance=0.5,
+                      max_candidates=5, block_size=BLOCK_SIZE):
+    '''
+    Return an iterator of (feature index, candidates) in table order
+
+    Candidates are compounds within `ppm` of the feature's m/z and
+    `rt_tolerance` (in the units of the stored retention times) of its
+    retention time, as a list of Candidate ranked by the distance of the
+    feature from the compound, with both errors scaled by their windows.
+    At most `max_candidates` are returned per feature (all with 0 or None).
+    '''
+    if ppm <= 0 or rt_tolerance <= 0:
+        raise ValueError("ppm and retention time windows must be positive")
+    return _annotate_features(features, reference, ppm, rt_tolerance,
+                              max_candidates, block_size)
+
+
+def _annotate_features(features, reference, ppm, rt_tolerance,
+                       max_candidates, block_size):
+    for start in range(0, len(features), block_size):
+        end = min(start + block_size, len(features))
+        feature, ref, ppm_error, rt_error, distance = _match_block(
+            features, reference, start, end, ppm, rt_tolerance)
+        bounds = np.searchsorted(feature, np.arange(start, end + 1))
+        for i in range(start, end):
+            first, last = bounds[i - start], bounds[i - start + 1]
+            if max_candidates:
+                last = min(last, first + max_candidates)
+            yield i, [Candidate(rank, int(reference.compound_ids[r]),
+                                reference.names[r], reference.formulas[r],
+                                float(reference.mz[r]), float(p),
+                                float(reference.rt[r]), float(e), float(d))
+                      for rank, (r, p, e, d) in enumerate(zip(
+                          ref[first:last], ppm_error[first:last],
+                          rt_error[first:last], distance[first:last]),
+                          start=1)]
+
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+
+def _iter_csv(features, annotations, unmatched):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(annotation_header)
+    rows = 0
+    for i, candidates in annotations:
+        feature = [features.ids[i], features.mz[i], features.rt[i],
+                   _number(features.intensity[i])]
+        for c in candidates:
+            writer.writerow(['' if value is None else value for value in
+                             feature + [c.rank, c.compound_id, c.name,
+                                        c.molecular_formula, c.mz,
+                                        round(c.ppm_error, 3), c.rt,
+                                        round(c.rt_error, 4),
+                                        round(c.distance, 4)]])
+        if unmatched and not candidates:
+            writer.writerow(['' if value is None else value
+                             for value in feature])
+        rows += len(candidates) or 1
+        if rows >= BLOCK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            rows = 0
+    yield buffer.getvalue()
+
+
+def _iter_ndjson(features, annotations, unmatched):
+    lines = []
+    for i, candidates in annotations:
+        if not candidates and not unmatched:
+            continue
+        lines.append(json.dumps({
+            'feature_id': features.ids[i],
+            'mz': float(features.mz[i]),
+            'rt': float(features.rt[i]),
+            'intensity': _number(features.intensity[i]),
+            'candidates': [c._asdict() for c in candidates]}))
+        if len(lines) >= BLOCK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_annotations(features, reference, output_format='csv', ppm=5.0,
+                     rt_tolerance=0.5, max_candidates=5, unmatched=False):
+    '''
+    Generate chunks of CSV or newline delimited JSON annotations
+
+    CSV has one row per candidate; NDJSON has one object per feature with
+    its ranked list of candidates. Features without candidates are only
+    written with `unmatched`. Raises ValueError for an unknown format or
+    invalid windows.
+    '''
+    if output_format not in annotation_formats:
+        raise ValueError("Invalid annotation format '{}': use one of "
+                         "{}".format(output_format,
+                                     ', '.join(annotation_formats)))
+    annotations = annotate_features(features, reference, ppm=ppm,
+                                    rt_tolerance=rt_tolerance,
+                                    max_candidates=max_candidates)
+    if output_format == 'csv':
+        return _iter_csv(features, annotations, unmatched)
+    return _iter_ndjson(features, annotations, unmatched)
@@ -0,0 +1,262 @@
+import io
+from flask import (Response, jsonify, request, stream_with_context,
+                   url_for)
+from sqlalchemy.orm import undefer
+from metabolite_database import db
+from metabolite_database.api import bp
+from metabolite_database.api.errors import bad_request
+from metabolite_database.annotate import (ReferenceTable, iter_annotations,
+                                          read_feature_table)
+from metabolite_database.models import (ChromatographyMethod, Compound, Job,
+                                        RetentionTimeSummary, compoundlists)
+from metabolite_database.ions import ion_table_for_formula
+from metabolite_database.name_search import search_compound_names
+from metabolite_database.search import parse_mode, search_ions, search_mz
+
+# DataTables column names that may be used for server side sorting
+compound_sort_columns = {
+    'name': Compound.standardized_name,
+    'molecular_formula': Compound.molecular_formula,
+    'monoisotopic_mass': Compound.monoisotopic_mass,
+    'm_z_positive': Compound.monoisotopic_mass,
+    'm_z_negative': Compound.monoisotopic_mass,
+}
+
+MAX_PAGE_LENGTH = 1000
+
+
+@bp.route('/search/mz', methods=['GET', 'POST'])
+def search_by_mz():
+    '''
+    Search compounds by m/z
+
+    Accepts `mz` (repeated or comma separated), `tolerance`, `unit` (ppm or
+    Da) and `mode` (1/pos or -1/neg) as query parameters, or the same keys
+    in a JSON body where `mz` is a list. With `ions` set, every
+    isotopologue and adduct of the mode's polarity is searched instead of
+    only [M+H]+/[M-H]-.
+    '''
+    data = request.get_json(silent=True) or {}
+    if data:
+        mz_values = data.get('mz', [])
+        if not isinstance(mz_values, list):
+            mz_values = [mz_values]
+    else:
+        data = request.values
+        mz_values = [v for value in request.values.getlist('mz')
+                     for v in value.split(',') if v.strip()]
+    if not mz_values:
+        return bad_request('must include at least one mz value')
+    search = search_mz
+    if data.get('ions') not in (None, '', '0', 'false', False):
+        search = search_ions
+    try:
+        results = search(mz_values,
+                         tolerance=float(data.get('tolerance', 5.0)),
+                         unit=data.get('unit', 'ppm'),
+                         mode=data.get('mode', 1))
+    except (TypeError, ValueError) as e:
+        return bad_request(str(e))
+    return jsonify({'results': results})
+
+
+@bp.route('/search/compound')
+def search_by_name():
+    '''
+    Search compounds by name or synonym for type-ahead completion
+
+    Accepts `q` and an optional `limit` (default 10). Names are matched
+    after normalization, prefixes first, then substrings and similar names.
+    '''
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+        results = search_compound_names(query, limit=limit)
+    except ValueError as e:
+        return bad_request(str(e))
+    for result in results:
+        result['url'] = url_for('main.compound', id=result['id'])
+    return jsonify({'query': query, 'results': results})
+
+
+@bp.route('/annotate', methods=['POST'])
+def annotate():
+    '''
+    Annotate an uploaded feature table with compounds of a method
+
+    The table is posted as the `features` file, with `method` (id or name),
+    `mode`, `ppm`, `rt_tolerance`, `max_candidates`, `compound_list_id`,
+    `aligned`, `unmatched` and `format` (csv or ndjson) as form fields.
+    Annotations are streamed as they are produced.
+    '''
+    upload = request.files.get('features')
+    if upload is None:
+        return bad_request('must include a features file')
+    method = request.form.get('method', '')
+    query = ChromatographyMethod.query
+    if method.isdigit():
+        m = query.get(int(method))
+    else:
+        m = query.filter_by(name=method).first()
+    if m is None:
+        return bad_request("no chromatography method '{}'".format(method))
+    flags = ('1', 'true', 'on', 'yes')
+    try:
+        features = read_feature_table(
+            io.TextIOWrapper(upload.stream, encoding='utf-8-sig'))
+        reference = ReferenceTable.for_method(
+            m, parse_mode(request.form.get('mode', 1)),
+            compound_list_id=request.form.get('compound_list_id', type=int),
+            aligned=request.form.get('aligned', '').lower() in flags)
+        output_format = request.form.get('format', 'csv')
+        chunks = iter_annotations(
+            features, reference, output_format,
+            ppm=float(request.form.get('ppm', 5.0)),
+            rt_tolerance=float(request.form.get('rt_tolerance', 0.5)),
+            max_candidates=int(request.form.get('max_candidates', 5)),
+            unmatched=request.form.get('unmatched', '').lower() in flags)
+    except (UnicodeDecodeError, ValueError) as e:
+        return bad_request(str(e))
+    mimetype = 'text/csv'
+    if output_format == 'ndjson':
+        mimetype = 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype)
+
+
+@bp.route('/retention_time_matrix')
+def retention_time_matrix():
+    '''
+    Return retention time summaries as a compound by method matrix
+
+    Filter with `compound_list_id`, `compound_id` and `method_id` (the ids
+    may be repeated or comma separated). Each compound has one entry per
+    method in `methods`, or null where it has no retention times.
+    '''
+    try:
+        compound_ids = [int(v) for value in request.args.getlist('compound_id')
+                        for v in value.split(',') if v.strip()]
+        method_ids = [int(v) for value in request.args.getlist('method_id')
+                      for v in value.split(',') if v.strip()]
+        compound_list_id = request.args.get('compound_list_id', type=int)
+    except ValueError:
+        return bad_request('compound_id and method_id must be integers')
+    summary = RetentionTimeSummary.__table__
+    query = (db.select(summary, Compound.name)
+             .join(Compound, Compound.id == summary.c.compound_id)
+             .order_by(Compound.standardized_name, Compound.id))
+    if compound_list_id:
+        query = query.join(
+            compoundlists,
+            compoundlists.c.compound_id == summary.c.compound_id).where(
+            compoundlists.c.compound_list_id == compound_list_id)
+    if compound_ids:
+        query = query.where(summary.c.compound_id.in_(compound_ids))
+    methods = ChromatographyMethod.query.order_by(ChromatographyMethod.id)
+    if method_ids:
+        query = query.where(
+            summary.c.chromatography_method_id.in_(method_ids))
+        methods = methods.filter(ChromatographyMethod.id.in_(method_ids))
+    methods = methods.all()
+    columns = {m.id: i for i, m in enumerate(methods)}
+    compounds = {}
+    for row in db.session.execute(query).mappings():
+        compound = compounds.get(row['compound_id'])
+        if compound is None:
+            compound = compounds[row['compound_id']] = {
+                'id': row['compound_id'],
+                'name': row['name'],
+                'summaries': [None] * len(methods)}
+        compound['summaries'][columns[row['chromatography_method_id']]] = {
+            'mean_rt': row['mean_rt'],
+            'median_rt': row['median_rt'],
+            'sd_rt': row['sd_rt'],
+            'min_rt': row['min_rt'],
+            'max_rt': row['max_rt'],
+            'n_runs': row['n_runs'],
+            'last_run_date': row['last_run_date'].isoformat()}
+    return jsonify({
+        'methods': [{'id': m.id, 'name': m.name} for m in methods],
+        'compounds': list(compounds.values())})
+
+
+@bp.route('/job/<int:id>')
+def job(id):
+    '''Return the status, progress and result of an import job'''
+    return jsonify(Job.query.get_or_404(id).to_dict())
+
+
+@bp.route('/compound/<int:id>/ions')
+def compound_ions(id):
+    '''Return the isotopologue and adduct m/z table of a compound'''
+    compound = Compound.query.get_or_404(id)
+    ions = ion_table_for_formula(compound.molecular_formula).rows()
+    for ion in ions:
+        ion['compound_id'] = compound.id
+    return jsonify({'id': compound.id, 'name': compound.name,
+                    'molecular_formula': compound.molecular_formula,
+                    'ions': ions})
+
+
+@bp.route('/compounds')
+def compounds():
+    '''
+    Return a page of compounds using the DataTables server side protocol
+
+    Supports `start`/`length` paging, sorting on name, formula or mass
+    columns and a `search[value]` filter on name or formula. Pass
+    `compound_list_id` to restrict results to a compound list.
+    '''
+    try:
+        draw = int(request.args.get('draw', 0))
+        start = max(int(request.args.get('start', 0)), 0)
+        length = int(request.args.get('length', 50))
+        compound_list_id = request.args.get('compound_list_id', type=int)
+    except ValueError:
+        return bad_request('draw, start and length must be integers')
+    if length < 0 or length > MAX_PAGE_LENGTH:
+        length = MAX_PAGE_LENGTH
+    query = Compound.query
+    if compound_list_id:
+        query = query.join(compoundlists).filter(
+            compoundlists.c.compound_list_id == compound_list_id)
+    records_total = query.count()
+    search = request.args.get('search[value]', '').strip()
+    records_filtered = records_total
+    if search:
+        query = query.filter(db.or_(
+            Compound.standardized_name.contains(search.lower(),
+                                                autoescape=True),
+            Compound.molecular_formula.startswith(search, autoescape=True)))
+        records_filtered = query.count()
+    order_by = []
+    i = 0
+    while 'order[{}][column]'.format(i) in request.args:
+        column = request.args.get('columns[{}][data]'.format(
+            request.args.get('order[{}][column]'.format(i))))
+        if column in compound_sort_columns:
+            sort_column = compound_sort_columns[column]
+            if request.args.get('order[{}][dir]'.format(i)) == 'desc':
+                sort_column = sort_column.desc()
+            order_by.append(sort_column)
+        i += 1
+    order_by.append(Compound.id)
+    compounds = query.options(
+        undefer(Compound.retention_time_count),
+        undefer(Compound.compound_list_count)).order_by(
+        *order_by).offset(start).limit(length).all()
+    return jsonify({
+        'draw': draw,
+        'recordsTotal': records_total,
+        'recordsFiltered': records_filtered,
+        'data': [{
+            'id': c.id,
+            'url': url_for('main.compound', id=c.id),
+            'name': c.name,
+            'molecular_formula': c.molecular_formula,
+            'monoisotopic_mass': c.monoisotopic_mass,
+            'm_z_positive': c.m_z(1),
+            'm_z_negative': c.m_z(-1),
+            'notes': c.notes,
+            'retention_time_count': c.retention_time_count,
+            'compound_list_count': c.compound_list_count,
+        } for c in compounds]})
@@ -0,0 +1,189 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, session
+
+
+class NullCache(object):
+    '''Cache backend that never stores anything'''
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(object):
+    '''In-process cache keeping the most recently used entries'''
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemCache(object):
+    '''
+    Cache stored as pickle files in a directory
+
+    Entries are written atomically, so any number of processes (such as
+    gunicorn workers) can share the directory. When more than `max_entries`
+    files exist the least recently written ones are removed.
+    '''
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fh:
+                return pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(value, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._prune()
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        for mtime, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class Cache(object):
+    '''
+    Cache of rendered pages and query results
+
+    Configured with CACHE_TYPE ('null', 'lru' or 'filesystem'),
+    CACHE_MAX_ENTRIES and, for the filesystem backend, CACHE_DIR.
+    '''
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'null')
+        max_entries = app.config.get('CACHE_MAX_ENTRIES', 1000)
+        if cache_type == 'null':
+            backend = NullCache()
+        elif cache_type == 'lru':
+            backend = LRUCache(max_entries)
+        elif cache_type == 'filesystem':
+            backend = FileSystemCache(
+                app.config.get('CACHE_DIR')
+                or os.path.join(app.instance_path, 'cache'), max_entries)
+        else:
+            raise ValueError("Invalid CACHE_TYPE '{}'".format(cache_type))
+        app.extensions['cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    @property
+    def enabled(self):
+        return not isinstance(self.backend, NullCache)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def clear(self):
+        self.backend.clear()
+
+    def memoize(self, key, versions, function):
+        '''Return cached result of `function` for key at these versions'''
+        if not self.enabled:
+            return function()
+        key = '{}:{}'.format(key, versions)
+        value = self.get(key)
+        if value is None:
+            value = function()
+            self.set(key, value)
+        return value
+
+    def cached_page(self, *version_keys):
+        '''
+        Decorator caching the response of a GET view
+
+        Responses are keyed on the request path and the current versions of
+        `version_keys`, which are formatted with the view arguments (for
+        example 'method:{id}').
+        '''
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (not self.enabled or request.method != 'GET'
+                        or '_flashes' in session):
+                    return view(*args, **kwargs)
+                from metabolite_database.models import data_versions
+                versions = data_versions(
+                    [key.format(**kwargs) for key in version_keys])
+                key = 'page:{}:{}'.format(request.full_path, versions)
+                cached = self.get(key)
+                if cached is not None:
+                    body, status, mimetype = cached
+                    return current_app.response_class(
+                        body, status=status, mimetype=mimetype)
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200 and \
+                        not response.direct_passthrough:
+                    self.set(key, (response.get_data(),
+                                   response.status_code,
+                                   response.mimetype))
+                return response
+            return wrapper
+        return decorator
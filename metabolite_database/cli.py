@@ -1,16 +1,74 @@
 import click
 import csv
 import sys
+import time
+from flask import current_app
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dateutil.parser import parse
 from metabolite_database import db
-from metabolite_database.models import get_one_or_create
-from metabolite_database.models import Compound
+from metabolite_database.models import bump_data_version
+from metabolite_database.models import data_versions
+from metabolite_database.mass_index import build_mass_index
 from metabolite_database.models import CompoundList
-from metabolite_database.models import ChromatographyMethod
-from metabolite_database.models import StandardRun
-from metabolite_database.models import RetentionTime
+from metabolite_database.models import Synonym
 from metabolite_database.models import standardize_compound_name
-from sqlalchemy.orm.exc import NoResultFound
+from metabolite_database.models import ChromatographyMethod
+from metabolite_database.importer import CompoundListExistsError
+from metabolite_database.importer import StandardRunExistsError
+from metabolite_database.importer import load_knowns
+from metabolite_database.importer import load_compound_list
+from metabolite_database.importer import read_compound_list_csv
+from metabolite_database.importer import read_knowns_csv
+from metabolite_database.importer import read_manifest
+from metabolite_database.matching import CompoundLookup
+from metabolite_database.matching import MIN_SIMILARITY
+from metabolite_database.search import parse_mode
+from metabolite_database.search import search_ions
+from metabolite_database.search import search_mz
+from metabolite_database.search import tolerance_units
+
+# annotate, exports, jobs and snapshot are imported by the commands using
+# them, so the other commands start faster
+
+
+def print_import_result(result):
+    if result.method_created:
+        print("Created new method: {}".format(result.method))
+    if result.unchanged:
+        print("Standard Run is up to date: {}".format(result.standard_run))
+        return
+    if result.standard_run_created:
+        print("Created new Standard Run: {}".format(result.standard_run))
+    else:
+        print("Updating Standard Run: {}".format(result.standard_run))
+    for row, message in result.bad_compounds + result.bad_retention_times:
+        sys.stderr.write("Error: {}\n".format(message))
+    for row, message in result.formula_warnings:
+        sys.stderr.write("Warning: {}\n".format(message))
+    print("Created {} new Compounds".format(result.compounds_created))
+    print("Recorded {} new Retention Times".format(
+        result.retention_times_created))
+    if not result.standard_run_created:
+        print("Updated {} and deleted {} Retention Times".format(
+            result.retention_times_updated, result.retention_times_deleted))
+    print("\nRows with invalid compounds:")
+    writer = csv.DictWriter(sys.stdout, fieldnames=result.knowns.fieldnames)
+    for row, message in result.bad_compounds:
+        writer.writerow(row)
+    print("\nRows with invalid retention times:")
+    for row, message in result.bad_retention_times:
+        writer.writerow(row)
+    print("\nImported {} rows in {:.3f}s".format(
+        result.knowns.num_rows, sum(t for _, t in result.timings)))
+    for phase, seconds in result.timings:
+        print("  {:<24}{:.3f}s".format(phase, seconds))
+
+
+def refresh_mass_index():
+    directory = current_app.config.get('MASS_INDEX_DIR')
+    if directory:
+        path = build_mass_index(directory, data_versions(['global'])[0])
+        print("Built compound mass index in '{}'".format(path))
 
 
 def register(app):
@@ -21,155 +79,380 @@ def register(app):
     @click.argument('operator')
     @click.option('-d', '--method-description', default=None)
     @click.option('--run-notes', default=None)
+    @click.option('-u', '--upsert', is_flag=True,
+                  help="Update the standard run if it already exists")
     def import_csv(csvfile, method, date, operator, method_description=None,
-                   run_notes=None):
-        """Import retention times from CSV file"""
+                   run_notes=None, upsert=False):
+        """Import retention times from CSV file
+
+        With --upsert, a standard run that already exists is updated to
+        match the file: only changed retention times are written.
+        """
         print("Importing records from '{}'".format(csvfile))
         datep = parse(date)
-        m, created = get_one_or_create(
-            session=db.session, model=ChromatographyMethod, name=method)
-        if created:
-            print("Created new method: {}".format(m))
-        sr, created = get_one_or_create(
-            session=db.session, model=StandardRun,
-            date=datep, operator=operator, chromatography_method=m)
-        if created:
-            sr.chromatography_method = m
-            if run_notes:
-                sr.notes = run_notes
-            if method_description:
-                m.description = method_description
-            print("Created new Standard Run: {}".format(sr))
-        else:
-            exit("Error: Standard Run with same operator and date already "
-                 "exists for this chromatography method.")
-        db.session.add_all([m, sr])
-        with open(csvfile) as csvfh:
-            csvreader = csv.DictReader(csvfh)
-            c_created = 0
-            rt_created = 0
-            bad_compounds = []
-            bad_retention_times = []
-            for row in csvreader:
-                name = row["Name"].strip()
-                formula = row["Formula"].strip()
-                rt_string = row["RT"].strip()
-                try:
-                    standardized_name = standardize_compound_name(name)
-                    c = Compound.query.filter_by(
-                        standardized_name=standardized_name).one()
-                    assert (c.molecular_formula == formula)
-                except NoResultFound:
-                    try:
-                        c, created = get_one_or_create(
-                            session=db.session, model=Compound,
-                            name=name,
-                            molecular_formula=formula)
-                        if created:
-                            c_created += 1
-                            db.session.add(c)
-                    except AssertionError as e:
-                        sys.stderr.write(
-                            "Error: Unable to record compound {} {}: {}\n"
-                            .format(name, formula, e))
-                        bad_compounds.append(row)
-                        next
-                except AssertionError as e:
-                    sys.stderr.write(
-                        "Error: Compound {} already exists with different "
-                        "formula.\n"
-                        "   Existing: {} - {}\n"
-                        "   New: {} - {}\n"
-                        .format(c, c.name, c.molecular_formula, name,
-                                formula))
-                    bad_compounds.append(row)
+        knowns = read_knowns_csv(csvfile)
+        try:
+            result = load_knowns(knowns, method, datep, operator,
+                                 method_description=method_description,
+                                 run_notes=run_notes, upsert=upsert)
+        except StandardRunExistsError as e:
+            exit("Error: {}".format(e))
+        print_import_result(result)
+        refresh_mass_index()
+
+    @app.cli.command()
+    @click.argument('manifest')
+    @click.option('-j', '--jobs', type=int, default=None,
+                  help="Number of parser processes (default: CPU count)")
+    @click.option('-u', '--upsert', is_flag=True,
+                  help="Update standard runs that already exist")
+    def import_batch(manifest, jobs, upsert):
+        """Import retention times from files listed in a manifest
+
+        The manifest is a CSV or YAML file with csvfile, method, date,
+        operator, method_description and run_notes for each standard run.
+        Files are parsed in parallel and each one is recorded in its own
+        transaction as soon as it has been parsed.
+        """
+        try:
+            runs = read_manifest(manifest)
+        except (OSError, ValueError) as e:
+            exit("Error: {}".format(e))
+        print("Importing {} files listed in '{}'".format(len(runs), manifest))
+        failed = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(read_knowns_csv, run['csvfile']): run
+                       for run in runs}
+            for future in as_completed(futures):
+                run = futures[future]
+                print("\n== {} ({} {} {})".format(
+                    run['csvfile'], run['method'], run['date'],
+                    run['operator']))
                 try:
-                    rt_value = float(rt_string)
-                    rt, created = get_one_or_create(
-                        session=db.session, model=RetentionTime,
-                        compound_id=c.id, standard_run_id=sr.id)
-                    if created:
-                        rt.retention_time = rt_value
-                        c.retention_times.append(rt)
-                        db.session.add_all([c, rt])
-                        rt_created += 1
-                    else:
-                        sys.stderr.write(
-                            "Retention time for this compound {} and standard "
-                            "run already exists\n".format(c))
-                        bad_retention_times.append(row)
-                except ValueError:
-                        sys.stderr.write("Unable to parse retention "
-                                         "time '{}' for {}\n"
-                                         .format(rt_string, c))
-                        bad_retention_times.append(row)
-                except AssertionError as e:
-                    sys.stderr.write("Unable to record retetion time '{}': "
-                                     "{}\n".format(rt_string, e))
-                    bad_retention_times.append(row)
-
-            print("Created {} new Compounds".format(c_created))
-            print("Recorded {} new Retention Times".format(rt_created))
-            print("\nRows with invalid compounds:")
-            writer = csv.DictWriter(sys.stdout, fieldnames=row.keys())
-            for row in bad_compounds:
-                writer.writerow(row)
-            print("\nRows with invalid retention times:")
-            for row in bad_retention_times:
-                writer.writerow(row)
-            db.session.commit()
+                    result = load_knowns(
+                        future.result(), run['method'], parse(run['date']),
+                        run['operator'],
+                        method_description=run['method_description'],
+                        run_notes=run['run_notes'], upsert=upsert)
+                except (OSError, KeyError, ValueError,
+                        StandardRunExistsError) as e:
+                    db.session.rollback()
+                    sys.stderr.write("Error: {}\n".format(e))
+                    failed.append(run['csvfile'])
+                    continue
+                print_import_result(result)
+        print("\nImported {} of {} files".format(
+            len(runs) - len(failed), len(runs)))
+        refresh_mass_index()
+        if failed:
+            exit("Failed to import: {}".format(', '.join(failed)))
 
     @app.cli.command()
     @click.argument('csvfile')
     @click.argument('name')
     @click.option('-d', '--description', default=None)
-    def add_compound_list(csvfile, name, description):
-        """Create new compound list from CSV file"""
-        list, created = get_one_or_create(
-            session=db.session, model=CompoundList, name=name,
-            description=description)
-        if created:
-            print("Created new compound list: {}".format(list))
-        else:
-            exit("Error: compound list already exists with name: {}"
-                 .format(list.name))
-        db.session.add(list)
+    @click.option('--fuzzy/--exact', default=True, show_default=True,
+                  help="Match misspelled names to the most similar name")
+    @click.option('--min-similarity', type=float, default=MIN_SIMILARITY,
+                  show_default=True,
+                  help="Lowest trigram similarity of a fuzzy match")
+    def add_compound_list(csvfile, name, description, fuzzy, min_similarity):
+        """Create new compound list from CSV file
+
+        The first column holds a compound id, name, synonym or molecular
+        formula. Names are matched ignoring case.
+        """
         print("Importing list of compounds from '{}'".format(csvfile))
+        try:
+            result = load_compound_list(
+                read_compound_list_csv(csvfile), name,
+                description=description, fuzzy=fuzzy,
+                min_similarity=min_similarity)
+        except CompoundListExistsError as e:
+            exit("Error: {}".format(e))
+        print("Created new compound list: {}".format(result.compound_list))
+        for value in result.not_found:
+            sys.stderr.write("Unable to find compound: {}\n".format(value))
+        for match in result.fuzzy_matches:
+            print("Matched '{}' to compound {} (similarity {:.2f})"
+                  .format(match.value, match.compound_id, match.score))
+        print("Added {} new compounds to compound list {}"
+              .format(result.compounds_added, result.compound_list.name))
+        print("Unable to find {} compounds in file".format(
+            len(result.not_found)))
+        refresh_mass_index()
+
+    @app.cli.command()
+    @click.option('-w', '--workers', type=int, default=1, show_default=True,
+                  help="Number of worker processes")
+    @click.option('--poll-interval', type=float, default=2.0,
+                  show_default=True,
+                  help="Seconds to wait when no job is queued")
+    @click.option('--once', is_flag=True,
+                  help="Exit when no queued jobs remain")
+    def run_jobs(workers, poll_interval, once):
+        """Run imports uploaded through the web interface"""
+        from metabolite_database.jobs import run_workers
+        count = run_workers(workers, poll_interval=poll_interval, once=once)
+        print("Ran {} jobs".format(count))
+
+    @app.cli.command()
+    @click.option('-t', '--timeout', type=int, default=None,
+                  help="Seconds without a heartbeat (default: "
+                  "JOB_TIMEOUT_SECONDS)")
+    def reap_jobs(timeout):
+        """Mark running jobs whose worker has stopped as failed"""
+        from metabolite_database.jobs import reap_stale_jobs
+        print("Marked {} jobs failed".format(reap_stale_jobs(timeout)))
+
+    @app.cli.command()
+    @click.argument('csvfile')
+    def add_synonyms(csvfile):
+        """Add compound synonyms from a CSV file
+
+        Each row holds a compound id or name followed by one or more
+        synonyms for it.
+        """
+        lookup = CompoundLookup()
+        synonyms = {}
         with open(csvfile) as csvfh:
-            csvreader = csv.reader(csvfh)
-            compounds_added = 0
-            compounds_not_found = []
-            for row in csvreader:
-                value = row[0]
-                id = None
-                compound = None
+            for row in csv.reader(csvfh):
+                if not row:
+                    continue
+                match = lookup.resolve(row[0], fuzzy=False)
+                if match.compound_id is None or match.method == 'formula':
+                    sys.stderr.write("Unable to find compound: {}\n"
+                                     .format(row[0]))
+                    continue
+                for synonym in row[1:]:
+                    synonym = synonym.strip()
+                    standardized_name = standardize_compound_name(synonym)
+                    if not synonym or lookup.name_id(standardized_name):
+                        continue
+                    synonyms[standardized_name] = {
+                        'compound_id': match.compound_id, 'name': synonym,
+                        'standardized_name': standardized_name}
+        if synonyms:
+            db.session.bulk_insert_mappings(Synonym, list(synonyms.values()))
+        bump_data_version()
+        db.session.commit()
+        print("Added {} synonyms".format(len(synonyms)))
+
+    @app.cli.command('build-mass-index')
+    def build_mass_index_command():
+        """Build the memory-mapped compound mass index"""
+        if not current_app.config.get('MASS_INDEX_DIR'):
+            exit("Error: MASS_INDEX_DIR is not configured")
+        refresh_mass_index()
+
+    @app.cli.command('search-mz')
+    @click.argument('mz', nargs=-1, type=float)
+    @click.option('-f', '--file', 'mzfile', type=click.File(),
+                  help="File with one m/z value per line (or first column "
+                  "of a CSV)")
+    @click.option('-t', '--tolerance', default=5.0, show_default=True)
+    @click.option('-u', '--unit', type=click.Choice(tolerance_units),
+                  default='ppm', show_default=True)
+    @click.option('-m', '--mode', default='1', show_default=True,
+                  help="Ionization mode: 1/pos or -1/neg")
+    @click.option('--ions', is_flag=True,
+                  help="Search all isotopologues and adducts")
+    def search_mz_values(mz, mzfile, tolerance, unit, mode, ions):
+        """Search compounds matching m/z values"""
+        mz_values = list(mz)
+        if mzfile:
+            for row in csv.reader(mzfile):
                 try:
-                    id = int(value)
-                    compound = Compound.query.get(id)
-                except ValueError:
+                    mz_values.append(float(row[0]))
+                except (IndexError, ValueError):
                     pass
-                if not compound:
-                    try:
-                        compound = Compound.query.filter_by(name=value).one()
-                    except NoResultFound:
-                        pass
-                if not compound:
-                    try:
-                        compound = Compound.query.filter_by(
-                            molecular_formula=value).one()
-                    except NoResultFound:
-                        pass
-                if not compound:
-                    compounds_not_found.append(value)
-                    sys.stderr.write("Unable to find compound: {}\n"
-                                     .format(value))
-                else:
-                    print(compound)
-                    list.compounds.append(compound)
-                    compounds_added += 1
-        db.session.add(list)
-        print("Added {} new compounds to compound list {}"
-              .format(compounds_added, list.name))
-        print("Unable to find {} compounds in file".format(
-            len(compounds_not_found)))
+        if not mz_values:
+            exit("Error: no m/z values specified")
+        search = search_ions if ions else search_mz
+        try:
+            results = search(mz_values, tolerance=tolerance, unit=unit,
+                             mode=mode)
+        except ValueError as e:
+            exit("Error: {}".format(e))
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['query_mz', 'compound_id', 'name', 'formula',
+                         'ion', 'm_z', 'error_ppm'])
+        for result in results:
+            for match in result['matches']:
+                ion = ''
+                if ions:
+                    ion = '{} {}'.format(match['adduct'],
+                                         match['isotopologue'])
+                writer.writerow([result['mz'], match['id'], match['name'],
+                                 match['molecular_formula'], ion,
+                                 match['m_z'],
+                                 '{:.3f}'.format(match['error_ppm'])])
+
+    @app.cli.command()
+    @click.argument('method')
+    @click.option('-o', '--output', type=click.File('w'), default='-',
+                  help="Output file (default: stdout)")
+    @click.option('-f', '--format', 'layout', default='elmaven',
+                  show_default=True,
+                  help="Layout: elmaven, mzmine or skyline")
+    @click.option('-m', '--mode', default=None,
+                  help="Include m/z for ionization mode: pos, neg or both")
+    @click.option('-r', '--run-id', 'run_ids', type=int, multiple=True,
+                  help="Standard run to include (default: all)")
+    @click.option('-l', '--compound-list', default=None,
+                  help="Only export compounds in this compound list")
+    @click.option('-a', '--aligned', is_flag=True,
+                  help="Correct retention time drift between runs")
+    def export_method(method, output, layout, mode, run_ids, compound_list,
+                      aligned):
+        """Export mean retention times for a chromatography method"""
+        from metabolite_database.exports import iter_export, parse_modes
+        m = ChromatographyMethod.query.filter_by(name=method).first()
+        if m is None:
+            exit("Error: no chromatography method named '{}'".format(method))
+        compound_list_id = None
+        list_name = m.name
+        if compound_list:
+            cl = CompoundList.query.filter_by(name=compound_list).first()
+            if cl is None:
+                exit("Error: no compound list named '{}'".format(
+                    compound_list))
+            compound_list_id = cl.id
+            list_name = cl.name
+        try:
+            chunks = iter_export(
+                layout,
+                m.iter_retention_time_means(standard_run_ids=run_ids,
+                                            compound_list_id=compound_list_id,
+                                            yield_per=1000, aligned=aligned),
+                modes=parse_modes(mode), list_name=list_name)
+        except ValueError as e:
+            exit("Error: {}".format(e))
+        for chunk in chunks:
+            output.write(chunk)
+
+    @app.cli.command()
+    @click.argument('features', type=click.File())
+    @click.argument('method')
+    @click.option('-o', '--output', type=click.File('w'), default='-',
+                  help="Output file (default: stdout)")
+    @click.option('-f', '--format', 'output_format', default='csv',
+                  show_default=True, help="Output format: csv or ndjson")
+    @click.option('-m', '--mode', default='1', show_default=True,
+                  help="Ionization mode: 1/pos or -1/neg")
+    @click.option('-p', '--ppm', default=5.0, show_default=True,
+                  help="m/z window (ppm)")
+    @click.option('-t', '--rt-tolerance', default=0.5, show_default=True,
+                  help="Retention time window, in the units of the "
+                  "imported retention times")
+    @click.option('-n', '--max-candidates', default=5, show_default=True,
+                  help="Candidates per feature (0 for all)")
+    @click.option('-r', '--run-id', 'run_ids', type=int, multiple=True,
+                  help="Standard run to include (default: all)")
+    @click.option('-l', '--compound-list', default=None,
+                  help="Only match compounds in this compound list")
+    @click.option('-a', '--aligned', is_flag=True,
+                  help="Correct retention time drift between runs")
+    @click.option('--unmatched', is_flag=True,
+                  help="Also write features without candidates")
+    def annotate(features, method, output, output_format, mode, ppm,
+                 rt_tolerance, max_candidates, run_ids, compound_list,
+                 aligned, unmatched):
+        """Annotate a feature table with compounds of a method"""
+        from metabolite_database.annotate import (ReferenceTable,
+                                                  iter_annotations,
+                                                  read_feature_table)
+        m = ChromatographyMethod.query.filter_by(name=method).first()
+        if m is None:
+            exit("Error: no chromatography method named '{}'".format(method))
+        compound_list_id = None
+        if compound_list:
+            cl = CompoundList.query.filter_by(name=compound_list).first()
+            if cl is None:
+                exit("Error: no compound list named '{}'".format(
+                    compound_list))
+            compound_list_id = cl.id
+        try:
+            table = read_feature_table(features)
+            reference = ReferenceTable.for_method(
+                m, parse_mode(mode), standard_run_ids=run_ids,
+                compound_list_id=compound_list_id, aligned=aligned)
+            chunks = iter_annotations(
+                table, reference, output_format, ppm=ppm,
+                rt_tolerance=rt_tolerance, max_candidates=max_candidates,
+                unmatched=unmatched)
+        except ValueError as e:
+            exit("Error: {}".format(e))
+        for chunk in chunks:
+            output.write(chunk)
+
+    @app.cli.command()
+    @click.argument('method')
+    @click.option('-r', '--reference-run', type=int, default=None,
+                  help="Standard run id to align other runs to")
+    @click.option('--refit', is_flag=True,
+                  help="Refit runs that are already aligned")
+    def align_runs(method, reference_run, refit):
+        """Fit retention time drift corrections for a method's runs
+
+        Only runs without an alignment are fitted unless --refit is given
+        or the reference run changes.
+        """
+        m = ChromatographyMethod.query.filter_by(name=method).first()
+        if m is None:
+            exit("Error: no chromatography method named '{}'".format(method))
+        run_ids = [r.id for r in m.standard_runs]
+        if reference_run is not None and reference_run not in run_ids:
+            exit("Error: standard run {} does not belong to {}".format(
+                reference_run, m.name))
+        alignments = m.align_standard_runs(reference_run_id=reference_run,
+                                           refit=refit)
+        bump_data_version([m.id])
         db.session.commit()
+        for alignment in alignments:
+            print("Aligned run {} to run {} using {} shared compounds".format(
+                alignment.standard_run_id, alignment.reference_run_id,
+                alignment.num_shared_compounds))
+
+    @app.cli.group()
+    def snapshot():
+        """Export or load Arrow/Parquet snapshots of the database"""
+
+    @snapshot.command('export')
+    @click.argument('directory')
+    @click.option('-f', '--format', 'output_format', default='arrow',
+                  show_default=True, help="File format: arrow or parquet")
+    @click.option('-b', '--batch-size', type=int, default=None,
+                  help="Rows per record batch (default: 50000)")
+    def snapshot_export(directory, output_format, batch_size):
+        """Write every table to columnar files in DIRECTORY"""
+        from metabolite_database.snapshot import BATCH_SIZE, export_snapshot
+        start = time.perf_counter()
+        try:
+            counts = export_snapshot(directory, output_format,
+                                     batch_size or BATCH_SIZE)
+        except ValueError as e:
+            exit("Error: {}".format(e))
+        for table, rows in counts.items():
+            print("  {:<28}{:>10} rows".format(table, rows))
+        print("Wrote snapshot to '{}' in {:.3f}s".format(
+            directory, time.perf_counter() - start))
+
+    @snapshot.command('import')
+    @click.argument('directory')
+    @click.option('-b', '--batch-size', type=int, default=None,
+                  help="Rows per insert (default: 50000)")
+    def snapshot_import(directory, batch_size):
+        """Load a snapshot from DIRECTORY into an empty database"""
+        from metabolite_database.snapshot import BATCH_SIZE, import_snapshot
+        start = time.perf_counter()
+        try:
+            counts = import_snapshot(directory, batch_size or BATCH_SIZE)
+        except ValueError as e:
+            db.session.rollback()
+            exit("Error: {}".format(e))
+        for table, rows in counts.items():
+            print("  {:<28}{:>10} rows".format(table, rows))
+        print("Loaded snapshot from '{}' in {:.3f}s".format(
+            directory, time.perf_counter() - start))
+        refresh_mass_index()
@@ -0,0 +1,92 @@
+'''
+Engine tuning profiles and read replica routing
+
+DATABASE_PROFILE names an entry of DATABASE_PROFILES giving engine options
+for each database dialect and PRAGMAs run on every new SQLite connection.
+When DATABASE_REPLICA_URL is set an engine is created for it, and queries
+made while reading from the replica (see `use_replica`) are sent to it
+unless the session has pending changes. The replica is not a
+Flask-SQLAlchemy bind: every model lives in both databases.
+'''
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+
+class RoutingSession(Session):
+    '''Session sending reads to the replica engine when requested'''
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and has_app_context() and g.get('use_replica')
+                and not self._flushing and not self.new and not self.dirty
+                and not self.deleted):
+            replica = current_app.extensions.get('replica_engine')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def use_replica():
+    '''Send this request's reads to the replica, if one is configured'''
+    g.use_replica = True
+
+
+def stop_using_replica(exc=None):
+    g.pop('use_replica', None)
+
+
+def database_profile(app):
+    '''Return the configured DATABASE_PROFILE settings'''
+    name = app.config.get('DATABASE_PROFILE') or 'baseline'
+    try:
+        return app.config['DATABASE_PROFILES'][name]
+    except KeyError:
+        raise ValueError("Invalid DATABASE_PROFILE '{}'".format(name))
+
+
+def _profile_engine_options(profile, url):
+    dialect = make_url(url).get_backend_name()
+    options = dict(profile.get('engine_options', {}).get(dialect, {}))
+    if dialect == 'sqlite' and make_url(url).database in (None, '',
+                                                          ':memory:'):
+        # In-memory databases use a single static connection
+        options = {}
+    return options
+
+
+def configure_database(app):
+    '''Set engine options from the profile before db.init_app'''
+    profile = database_profile(app)
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    options = _profile_engine_options(profile, url)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def replica_engine(app):
+    '''Create the DATABASE_REPLICA_URL engine, if configured'''
+    url = app.config.get('DATABASE_REPLICA_URL')
+    if not url:
+        return None
+    engine = create_engine(
+        url, **_profile_engine_options(database_profile(app), url))
+    app.extensions['replica_engine'] = engine
+    return engine
+
+
+def apply_sqlite_pragmas(app, engines):
+    '''Run the profile's SQLite PRAGMAs on each new connection'''
+    pragmas = database_profile(app).get('sqlite_pragmas', {})
+    if not pragmas:
+        return
+    for engine in engines:
+        if engine is None or engine.dialect.name != 'sqlite':
+            continue
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
@@ -0,0 +1,119 @@
+import csv
+import io
+from metabolite_database.search import parse_mode
+
+# Number of rows written to the buffer before a chunk is yielded
+EXPORT_CHUNK_ROWS = 500
+
+
+def _elmaven_header(modes):
+    header = ['compound', 'formula', 'RT']
+    if modes:
+        header.extend(['mz', 'charge'])
+    return header
+
+
+def _elmaven_row(mean, mode, list_name):
+    row = [mean.compound.name, mean.compound.molecular_formula,
+           mean.mean_rt]
+    if mode:
+        row.extend([mean.compound.m_z(mode), mode])
+    return row
+
+
+def _mzmine_header(modes):
+    return ['ID', 'm/z', 'Retention time', 'Identity', 'Formula']
+
+
+def _mzmine_row(mean, mode, list_name):
+    return [mean.compound.id, mean.compound.m_z(mode), mean.mean_rt,
+            mean.compound.name, mean.compound.molecular_formula]
+
+
+def _skyline_header(modes):
+    return ['Molecule List Name', 'Molecule Name', 'Molecular Formula',
+            'Precursor Adduct', 'Precursor m/z', 'Explicit Retention Time']
+
+
+def _skyline_row(mean, mode, list_name):
+    return [list_name, mean.compound.name, mean.compound.molecular_formula,
+            '[M+H]' if mode > 0 else '[M-H]', mean.compound.m_z(mode),
+            mean.mean_rt]
+
+
+def parse_modes(value):
+    '''Return list of ionization modes from '', 'both' or a single mode'''
+    if not value:
+        return []
+    if value == 'both':
+        return [1, -1]
+    return [parse_mode(value)]
+
+
+class ExportLayout(object):
+    '''Column layout of a retention time list for an analysis tool'''
+    def __init__(self, label, header, row, delimiter=',', requires_mode=False,
+                 extension='csv'):
+        self.label = label
+        self.header = header
+        self.row = row
+        self.delimiter = delimiter
+        self.requires_mode = requires_mode
+        self.extension = extension
+
+    @property
+    def mimetype(self):
+        if self.delimiter == '\t':
+            return 'text/tab-separated-values'
+        return 'text/csv'
+
+
+export_layouts = {
+    'elmaven': ExportLayout('El-MAVEN', _elmaven_header, _elmaven_row),
+    'mzmine': ExportLayout('MZmine', _mzmine_header, _mzmine_row,
+                           requires_mode=True),
+    'skyline': ExportLayout('Skyline', _skyline_header, _skyline_row,
+                            delimiter='\t', requires_mode=True,
+                            extension='tsv'),
+}
+
+
+def iter_export(layout_name, means, modes=None, list_name='Compounds'):
+    '''
+    Generate chunks of delimited text for retention time means
+
+    `means` is an iterable of RetentionTimeMean, such as
+    ChromatographyMethod.iter_retention_time_means, and is consumed lazily.
+    One row is written per compound for each ionization mode in `modes`;
+    `list_name` names the molecule list in layouts that have one.
+    Raises ValueError for an unknown layout or a layout that needs a mode.
+    '''
+    try:
+        layout = export_layouts[layout_name]
+    except KeyError:
+        raise ValueError("Invalid export format '{}': use one of {}".format(
+            layout_name, ', '.join(sorted(export_layouts))))
+    modes = list(modes or [])
+    if layout.requires_mode and not modes:
+        raise ValueError("{} export requires an ionization mode".format(
+            layout.label))
+    return _iter_export(layout, means, modes or [None], list_name)
+
+
+def _iter_export(layout, means, modes, list_name):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=layout.delimiter,
+                        lineterminator='\n')
+    writer.writerow(layout.header([m for m in modes if m]))
+    rows = 0
+    for mean in means:
+        for mode in modes:
+            writer.writerow(['' if value is None else value
+                             for value in layout.row(mean, mode, list_name)])
+            rows += 1
+        if rows >= EXPORT_CHUNK_ROWS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            rows = 0
+    yield buffer.getvalue()
@@ -0,0 +1,410 @@
+import csv
+import hashlib
+import os
+import time
+from metabolite_database import db
+from metabolite_database.models import get_one_or_create
+from metabolite_database.models import validate_formulas
+from metabolite_database.models import Compound
+from metabolite_database.models import CompoundList
+from metabolite_database.models import compoundlists
+from metabolite_database.models import ChromatographyMethod
+from metabolite_database.models import StandardRun
+from metabolite_database.models import RetentionTime
+from metabolite_database.models import standardize_compound_name
+from metabolite_database.models import refresh_retention_time_aggregates
+from metabolite_database.models import refresh_retention_time_summaries
+from metabolite_database.models import bump_data_version
+from metabolite_database.matching import CompoundLookup
+from metabolite_database.matching import MIN_SIMILARITY
+
+# Keep IN clauses below SQLite's default limit on bound parameters
+IN_CLAUSE_CHUNK_SIZE = 500
+
+
+class StandardRunExistsError(Exception):
+    pass
+
+
+class CompoundListExistsError(Exception):
+    pass
+
+
+manifest_fields = ('csvfile', 'method', 'date', 'operator',
+                   'method_description', 'run_notes')
+
+
+class KnownsFile(object):
+    '''
+    Parsed and validated contents of a knowns CSV file
+
+    `compounds` maps standardized names to the (name, formula, mass) of each
+    valid compound in the file, and `retention_times` lists
+    (standardized name, retention time, row) for each parsable retention
+    time. Rows that fail validation are kept with an error message in
+    `bad_compounds` and `bad_retention_times`, and rows recorded with a
+    formula not in Hill order with a warning in `formula_warnings`.
+    `rejected_names` holds the standardized names of the rejected rows.
+    `digest` is the SHA-256 of the file's contents.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.digest = None
+        self.fieldnames = []
+        self.num_rows = 0
+        self.compounds = {}
+        self.retention_times = []
+        self.bad_compounds = []
+        self.bad_retention_times = []
+        self.formula_warnings = []
+        self.rejected_names = set()
+        self.parse_time = 0.0
+
+
+class ImportResult(object):
+    def __init__(self, knowns):
+        self.knowns = knowns
+        self.method = None
+        self.method_created = False
+        self.standard_run = None
+        self.standard_run_created = False
+        self.unchanged = False
+        self.compounds_created = 0
+        self.retention_times_created = 0
+        self.retention_times_updated = 0
+        self.retention_times_deleted = 0
+        self.bad_compounds = list(knowns.bad_compounds)
+        self.bad_retention_times = list(knowns.bad_retention_times)
+        self.formula_warnings = list(knowns.formula_warnings)
+        self.timings = [('parse', knowns.parse_time)]
+
+
+def file_digest(path):
+    '''Return the SHA-256 hex digest of a file'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CompoundListResult(object):
+    def __init__(self, compound_list):
+        self.compound_list = compound_list
+        self.compounds_added = 0
+        self.not_found = []
+        self.fuzzy_matches = []
+
+
+def read_knowns_csv(csvfile):
+    '''Read and validate a knowns CSV file with Name, Formula and RT columns
+
+    Only the file is read; no database access is needed, so files can be
+    parsed in a separate process.
+    '''
+    start = time.perf_counter()
+    knowns = KnownsFile(csvfile)
+    knowns.digest = file_digest(csvfile)
+    seen = set()
+    with open(csvfile) as csvfh:
+        csvreader = csv.DictReader(csvfh)
+        knowns.fieldnames = csvreader.fieldnames or []
+        rows = list(csvreader)
+    knowns.num_rows = len(rows)
+    # Check the whole formula column up front, once per distinct formula
+    masses, formula_errors, formula_warnings = validate_formulas(
+        [row["Formula"].strip() for row in rows])
+    formula_errors = {error.row: error for error in formula_errors}
+    formula_warnings = {warning.row: warning
+                        for warning in formula_warnings}
+    for i, row in enumerate(rows):
+        name = row["Name"].strip()
+        formula = row["Formula"].strip()
+        rt_string = row["RT"].strip()
+        standardized_name = standardize_compound_name(name)
+        existing = knowns.compounds.get(standardized_name)
+        if existing is None:
+            if i in formula_errors:
+                knowns.bad_compounds.append(
+                    (row, "Unable to record compound {} {}: {}"
+                     .format(name, formula, formula_errors[i].message)))
+                knowns.rejected_names.add(standardized_name)
+                continue
+            knowns.compounds[standardized_name] = (name, formula, masses[i])
+            if i in formula_warnings:
+                knowns.formula_warnings.append(
+                    (row, "Compound {} {}: {}".format(
+                        name, formula, formula_warnings[i].message)))
+        elif existing[1] != formula:
+            knowns.bad_compounds.append(
+                (row, "Compound {} listed with different formulas: "
+                 "{} and {}".format(name, existing[1], formula)))
+            knowns.rejected_names.add(standardized_name)
+            continue
+        try:
+            rt_value = float(rt_string)
+        except ValueError:
+            knowns.bad_retention_times.append(
+                (row, "Unable to parse retention time '{}' for {}"
+                 .format(rt_string, name)))
+            knowns.rejected_names.add(standardized_name)
+            continue
+        if standardized_name in seen:
+            knowns.bad_retention_times.append(
+                (row, "Retention time for this compound {} and standard "
+                 "run already exists".format(name)))
+            knowns.rejected_names.add(standardized_name)
+            continue
+        seen.add(standardized_name)
+        knowns.retention_times.append((standardized_name, rt_value, row))
+    knowns.parse_time = time.perf_counter() - start
+    return knowns
+
+
+def read_manifest(manifest):
+    '''
+    Return list of import_csv arguments listed in a YAML or CSV manifest
+
+    CSV manifests need a header row with the columns in `manifest_fields`;
+    YAML manifests hold a list of mappings with the same keys (optionally
+    under a top level `runs` key). Relative csvfile paths are resolved
+    against the manifest's directory.
+    '''
+    with open(manifest) as fh:
+        if os.path.splitext(manifest)[1].lower() in ('.yml', '.yaml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required to read YAML manifests")
+            entries = yaml.safe_load(fh) or []
+            if isinstance(entries, dict):
+                entries = entries.get('runs', [])
+        else:
+            entries = list(csv.DictReader(fh))
+    basedir = os.path.dirname(os.path.abspath(manifest))
+    runs = []
+    for i, entry in enumerate(entries, start=1):
+        run = {field: entry.get(field) or None for field in manifest_fields}
+        if not run['run_notes'] and entry.get('notes'):
+            run['run_notes'] = entry['notes']
+        missing = [field for field in manifest_fields[:4] if not run[field]]
+        if missing:
+            raise ValueError("Manifest entry {} is missing {}".format(
+                i, ', '.join(missing)))
+        run['date'] = str(run['date'])
+        run['csvfile'] = os.path.join(basedir, run['csvfile'])
+        runs.append(run)
+    return runs
+
+
+def chunked(values, size=IN_CLAUSE_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def existing_compounds(session, standardized_names):
+    '''Return dict of standardized name to (id, formula) for known names'''
+    compounds = {}
+    for chunk in chunked(standardized_names):
+        query = (session.query(Compound.id, Compound.standardized_name,
+                               Compound.molecular_formula)
+                 .filter(Compound.standardized_name.in_(chunk)))
+        for id, standardized_name, formula in query:
+            compounds[standardized_name] = (id, formula)
+    return compounds
+
+
+def existing_retention_times(session, standard_run_id):
+    '''Return dict of compound id to list of (id, retention time) in a run'''
+    retention_times = {}
+    query = (session.query(RetentionTime.id, RetentionTime.compound_id,
+                           RetentionTime.retention_time)
+             .filter(RetentionTime.standard_run_id == standard_run_id)
+             .order_by(RetentionTime.id))
+    for id, compound_id, rt_value in query:
+        retention_times.setdefault(compound_id, []).append((id, rt_value))
+    return retention_times
+
+
+def load_knowns(knowns, method, date, operator, method_description=None,
+                run_notes=None, upsert=False, session=None):
+    '''
+    Record the compounds and retention times from a parsed knowns file
+
+    All compound names are resolved with batched IN queries, then new
+    compounds and retention times are inserted in bulk and committed in a
+    single transaction. Raises StandardRunExistsError if a run with the same
+    operator and date already exists for the method, unless `upsert` is
+    set: then the run's retention times are brought in line with the file
+    by inserting, updating and deleting only the rows that differ. A file
+    whose digest matches the one recorded for the run is skipped.
+    '''
+    session = session or db.session
+    result = ImportResult(knowns)
+    start = time.perf_counter()
+    m, result.method_created = get_one_or_create(
+        session=session, model=ChromatographyMethod, name=method)
+    sr, result.standard_run_created = get_one_or_create(
+        session=session, model=StandardRun,
+        date=date, operator=operator, chromatography_method=m)
+    result.method = m
+    result.standard_run = sr
+    if not result.standard_run_created:
+        if not upsert:
+            session.rollback()
+            raise StandardRunExistsError(
+                "Standard Run with same operator and date already exists "
+                "for this chromatography method.")
+        if knowns.digest is not None and sr.file_digest == knowns.digest:
+            session.rollback()
+            result.unchanged = True
+            result.timings.append(('setup', time.perf_counter() - start))
+            return result
+    if run_notes:
+        sr.notes = run_notes
+    if method_description:
+        m.description = method_description
+    sr.file_digest = knowns.digest
+    session.flush()
+    result.timings.append(('setup', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    existing = existing_compounds(session, knowns.compounds.keys())
+    result.timings.append(('resolve', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    new_compounds = [
+        {'name': name, 'standardized_name': standardized_name,
+         'molecular_formula': formula, 'monoisotopic_mass': mass}
+        for standardized_name, (name, formula, mass)
+        in knowns.compounds.items() if standardized_name not in existing]
+    if new_compounds:
+        session.bulk_insert_mappings(Compound, new_compounds)
+        existing.update(existing_compounds(
+            session, [c['standardized_name'] for c in new_compounds]))
+    result.compounds_created = len(new_compounds)
+    result.timings.append(('insert compounds', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    recorded = {}
+    if not result.standard_run_created:
+        recorded = existing_retention_times(session, sr.id)
+    inserts = []
+    updates = []
+    deletes = []
+    changed_compounds = set()
+    for standardized_name, rt_value, row in knowns.retention_times:
+        id, formula = existing[standardized_name]
+        name, new_formula, mass = knowns.compounds[standardized_name]
+        if formula != new_formula:
+            # A rejected row leaves what is recorded for the compound alone
+            recorded.pop(id, None)
+            result.bad_compounds.append(
+                (row, "Compound {} already exists with different formula.\n"
+                 "   Existing: {}\n"
+                 "   New: {} - {}".format(name, formula, name, new_formula)))
+            continue
+        previous = recorded.pop(id, None)
+        if previous is None:
+            inserts.append({'compound_id': id, 'standard_run_id': sr.id,
+                            'retention_time': rt_value})
+            changed_compounds.add(id)
+            continue
+        (rt_id, previous_value), duplicates = previous[0], previous[1:]
+        if previous_value != rt_value:
+            updates.append({'id': rt_id, 'retention_time': rt_value})
+            changed_compounds.add(id)
+        if duplicates:
+            deletes.extend(rt_id for rt_id, _ in duplicates)
+            changed_compounds.add(id)
+    # Rows rejected while reading the file leave what is recorded for their
+    # compounds alone too
+    if recorded and knowns.rejected_names:
+        for id, _ in existing_compounds(
+                session, sorted(knowns.rejected_names)).values():
+            recorded.pop(id, None)
+    # Anything recorded for the run but missing from the file is removed
+    for id, previous in recorded.items():
+        deletes.extend(rt_id for rt_id, _ in previous)
+        changed_compounds.add(id)
+    if inserts:
+        session.bulk_insert_mappings(RetentionTime, inserts)
+    if updates:
+        session.bulk_update_mappings(RetentionTime, updates)
+    for chunk in chunked(deletes):
+        (session.query(RetentionTime)
+         .filter(RetentionTime.id.in_(chunk))
+         .delete(synchronize_session=False))
+    result.retention_times_created = len(inserts)
+    result.retention_times_updated = len(updates)
+    result.retention_times_deleted = len(deletes)
+    result.timings.append(('write retention times',
+                           time.perf_counter() - start))
+
+    if inserts or updates or deletes:
+        start = time.perf_counter()
+        refresh_retention_time_aggregates([sr.id], session)
+        for chunk in chunked(sorted(changed_compounds)):
+            refresh_retention_time_summaries(m.id, chunk, session)
+        bump_data_version([m.id], session)
+        result.timings.append(('refresh aggregates',
+                               time.perf_counter() - start))
+
+        start = time.perf_counter()
+        if sr.id == m.reference_standard_run_id():
+            # Every run was fitted against the old reference values
+            m.align_standard_runs(refit=True, session=session)
+        else:
+            m.align_standard_run(sr.id, session=session)
+        result.timings.append(('align run', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    session.commit()
+    result.timings.append(('commit', time.perf_counter() - start))
+    return result
+
+
+def read_compound_list_csv(csvfile):
+    '''Return the values in the first column of a compound list file'''
+    with open(csvfile) as csvfh:
+        return [row[0] for row in csv.reader(csvfh) if row]
+
+
+def load_compound_list(values, name, description=None, fuzzy=True,
+                       min_similarity=MIN_SIMILARITY, session=None):
+    '''
+    Create a compound list of the compounds referred to by `values`
+
+    Values are compound ids, names, synonyms or formulas, resolved against a
+    CompoundLookup loaded once; with `fuzzy`, unmatched values are matched
+    to the most similar name. Raises CompoundListExistsError if a list with
+    this name exists.
+    '''
+    session = session or db.session
+    if session.query(CompoundList.id).filter_by(name=name).first():
+        raise CompoundListExistsError(
+            "compound list already exists with name: {}".format(name))
+    compound_list = CompoundList(name=name, description=description)
+    session.add(compound_list)
+    session.flush()
+    result = CompoundListResult(compound_list)
+    lookup = CompoundLookup(session)
+    # Ids in file order without duplicates
+    compound_ids = {}
+    for match in lookup.resolve_all(values, fuzzy=fuzzy,
+                                    min_similarity=min_similarity):
+        if match.compound_id is None:
+            result.not_found.append(match.value)
+            continue
+        if match.method == 'fuzzy':
+            result.fuzzy_matches.append(match)
+        compound_ids.setdefault(match.compound_id)
+    if compound_ids:
+        session.execute(compoundlists.insert(), [
+            {'compound_id': id, 'compound_list_id': compound_list.id}
+            for id in compound_ids])
+    result.compounds_added = len(compound_ids)
+    bump_data_version(session=session)
+    session.commit()
+    return result
@@ -0,0 +1,256 @@
+'''
+Per-request timing of SQL, template rendering and Python code
+
+Every request records the number and duration of SQL statements, the time
+spent rendering templates and the remaining Python time. The totals are
+sent in a Server-Timing header, accumulated for the Prometheus text
+endpoint /_metrics (when METRICS_ENDPOINT is enabled) and, for requests
+slower than SLOW_REQUEST_SECONDS, logged together with their slowest
+statements. /_metrics requires the METRICS_TOKEN bearer token if one is
+configured and otherwise only answers requests from localhost.
+
+Metrics are kept per process; with several worker processes each one
+reports its own counters.
+'''
+import hmac
+import threading
+import time
+from collections import defaultdict
+from flask import (abort, before_render_template, current_app, g,
+                   has_app_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+# Number of statements kept per request for the slow-request log
+MAX_STATEMENTS = 50
+SLOW_LOG_STATEMENTS = 10
+# Addresses allowed to read /_metrics when no METRICS_TOKEN is set
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class RequestTimings(object):
+    '''Timings collected while handling one request'''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_sql_time = 0.0
+        self.render_starts = []
+        self.statements = []
+
+    def add_statement(self, statement, seconds):
+        self.sql_count += 1
+        self.sql_time += seconds
+        if self.render_starts:
+            self.template_sql_time += seconds
+        self.statements.append((seconds, statement))
+        if len(self.statements) > MAX_STATEMENTS:
+            self.statements.sort(reverse=True, key=lambda s: s[0])
+            del self.statements[MAX_STATEMENTS:]
+
+    def finish(self):
+        '''Return dict of total, sql, template and python seconds'''
+        total = time.perf_counter() - self.start
+        # SQL run lazily while rendering is only counted as SQL
+        template = max(self.template_time - self.template_sql_time, 0.0)
+        return {'total': total, 'sql': self.sql_time, 'template': template,
+                'python': max(total - self.sql_time - template, 0.0)}
+
+
+class Metrics(object):
+    '''Request counters and timing totals for the /_metrics endpoint'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.sql_count = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.slow_requests = defaultdict(int)
+
+    def observe(self, endpoint, method, status, timings, sql_count, slow):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            for part, seconds in timings.items():
+                self.seconds[(endpoint, part)] += seconds
+            self.sql_count[endpoint] += sql_count
+            counts = self.buckets[endpoint]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if timings['total'] <= bound:
+                    counts[i] += 1
+            if slow:
+                self.slow_requests[endpoint] += 1
+
+    def render(self):
+        '''Return the metrics in the Prometheus text exposition format'''
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, _escape(v))
+                                      for k, v in labels)
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, label_text,
+                                                    value))
+
+        with self._lock:
+            metric('metabolite_database_requests_total', 'counter',
+                   'Requests handled',
+                   [('', (('endpoint', e), ('method', m), ('status', s)), n)
+                    for (e, m, s), n in sorted(self.requests.items())])
+            totals = defaultdict(int)
+            for (e, m, s), n in self.requests.items():
+                totals[e] += n
+            histogram = []
+            for endpoint, counts in sorted(self.buckets.items()):
+                for bound, count in zip(DURATION_BUCKETS, counts):
+                    histogram.append(('_bucket', (('endpoint', endpoint),
+                                                  ('le', repr(bound))), count))
+                histogram.append(('_bucket', (('endpoint', endpoint),
+                                              ('le', '+Inf')),
+                                  totals[endpoint]))
+                histogram.append(('_sum', (('endpoint', endpoint),),
+                                  self.seconds[(endpoint, 'total')]))
+                histogram.append(('_count', (('endpoint', endpoint),),
+                                  totals[endpoint]))
+            metric('metabolite_database_request_duration_seconds',
+                   'histogram', 'Time to handle requests', histogram)
+            metric('metabolite_database_request_part_seconds_total',
+                   'counter', 'Time spent handling requests in sql, '
+                   'template and python code',
+                   [('', (('endpoint', e), ('part', p)), s)
+                    for (e, p), s in sorted(self.seconds.items())
+                    if p != 'total'])
+            metric('metabolite_database_sql_queries_total', 'counter',
+                   'SQL statements executed while handling requests',
+                   [('', (('endpoint', e),), n)
+                    for e, n in sorted(self.sql_count.items())])
+            metric('metabolite_database_slow_requests_total', 'counter',
+                   'Requests slower than SLOW_REQUEST_SECONDS',
+                   [('', (('endpoint', e),), n)
+                    for e, n in sorted(self.slow_requests.items())])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _current_timings():
+    if has_app_context():
+        return g.get('_request_timings')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start_time'].pop()
+    timings = _current_timings()
+    if timings is not None:
+        timings.add_statement(statement, time.perf_counter() - start)
+
+
+def _before_render_template(app, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None:
+        timings.render_starts.append(time.perf_counter())
+
+
+def _template_rendered(app, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None and timings.render_starts:
+        start = timings.render_starts.pop()
+        if not timings.render_starts:
+            timings.template_time += time.perf_counter() - start
+
+
+class Instrumentation(object):
+    '''
+    Request profiling extension
+
+    Configured with INSTRUMENTATION_ENABLED, SERVER_TIMING_HEADER,
+    METRICS_ENDPOINT, METRICS_TOKEN and SLOW_REQUEST_SECONDS.
+    '''
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['instrumentation'] = self
+        if not app.config.get('INSTRUMENTATION_ENABLED', True):
+            return
+        app.extensions['metrics'] = Metrics()
+        # Listen on every engine so no engine is created here
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        if app.config.get('METRICS_ENDPOINT', False):
+            app.add_url_rule('/_metrics', 'metrics', self.metrics_view)
+
+    @property
+    def metrics(self):
+        return current_app.extensions['metrics']
+
+    def _start_request(self):
+        g._request_timings = RequestTimings()
+
+    def _finish_request(self, response):
+        timings = g.pop('_request_timings', None)
+        if timings is None:
+            return response
+        parts = timings.finish()
+        if current_app.config.get('SERVER_TIMING_HEADER', True):
+            response.headers['Server-Timing'] = ', '.join(
+                ['sql;dur={:.2f};desc="{} queries"'.format(
+                    parts['sql'] * 1000, timings.sql_count)]
+                + ['{};dur={:.2f}'.format(part, parts[part] * 1000)
+                   for part in ('template', 'python', 'total')])
+        endpoint = request.endpoint or 'unknown'
+        threshold = current_app.config.get('SLOW_REQUEST_SECONDS')
+        slow = threshold is not None and parts['total'] >= threshold
+        if slow:
+            self._log_slow_request(timings, parts)
+        self.metrics.observe(endpoint, request.method, response.status_code,
+                             parts, timings.sql_count, slow)
+        return response
+
+    def _log_slow_request(self, timings, parts):
+        statements = sorted(timings.statements, reverse=True,
+                            key=lambda s: s[0])[:SLOW_LOG_STATEMENTS]
+        current_app.logger.warning(
+            "Slow request %s %s: %.3fs (sql %.3fs in %d queries, template "
+            "%.3fs, python %.3fs)\n%s", request.method, request.full_path,
+            parts['total'], parts['sql'], timings.sql_count,
+            parts['template'], parts['python'],
+            '\n'.join('  {:.3f}s {}'.format(seconds, ' '.join(
+                statement.split())) for seconds, statement in statements))
+
+    def metrics_view(self):
+        token = current_app.config.get('METRICS_TOKEN')
+        if token:
+            allowed = hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer {}'.format(token))
+        else:
+            allowed = request.remote_addr in LOCAL_ADDRESSES
+        if not allowed:
+            abort(403)
+        return current_app.response_class(
+            self.metrics.render(),
+            mimetype='text/plain; version=0.0.4; charset=utf-8')
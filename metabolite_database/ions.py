@@ -0,0 +1,151 @@
+'''
+Isotopologue and adduct m/z tables
+
+The m/z of every combination of compound, isotopologue and adduct is
+computed at once from a matrix of element counts, giving an IonTable of
+flat NumPy arrays sorted by m/z that can be searched with binary search.
+'''
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+from metabolite_database import cache
+from metabolite_database.models import (Compound, atom_masses, data_versions,
+                                        parse_formula)
+
+ELECTRON_MASS = atom_masses['e']
+
+Adduct = namedtuple('Adduct', ['name', 'charge', 'composition'])
+Isotopologue = namedtuple('Isotopologue',
+                          ['name', 'mass_shift', 'element', 'min_count'])
+
+# Composition is the change in atoms from the neutral molecule M
+adducts = [
+    Adduct('[M+H]+', 1, {'H': 1}),
+    Adduct('[M+Na]+', 1, {'Na': 1}),
+    Adduct('[M+K]+', 1, {'K': 1}),
+    Adduct('[M+NH4]+', 1, {'N': 1, 'H': 4}),
+    Adduct('[M+2H]2+', 2, {'H': 2}),
+    Adduct('[M+H+Na]2+', 2, {'H': 1, 'Na': 1}),
+    Adduct('[M+H+K]2+', 2, {'H': 1, 'K': 1}),
+    Adduct('[M+H+NH4]2+', 2, {'N': 1, 'H': 5}),
+    Adduct('[M+2Na]2+', 2, {'Na': 2}),
+    Adduct('[M+3H]3+', 3, {'H': 3}),
+    Adduct('[M+2H+Na]3+', 3, {'H': 2, 'Na': 1}),
+    Adduct('[M-H]-', -1, {'H': -1}),
+    Adduct('[M+Cl]-', -1, {'Cl': 1}),
+    Adduct('[M+FA-H]-', -1, {'C': 1, 'H': 1, 'O': 2}),
+    Adduct('[M-2H]2-', -2, {'H': -2}),
+    Adduct('[M-3H]3-', -3, {'H': -3}),
+]
+
+# Isotopologues are only generated for compounds with at least `min_count`
+# atoms of `element`
+isotopologues = [
+    Isotopologue('M+0', 0.0, None, 0),
+    Isotopologue('M+1 13C', 1.0033548378, 'C', 1),
+    Isotopologue('M+1 15N', 0.9970348934, 'N', 1),
+    Isotopologue('M+2 13C2', 2.0067096756, 'C', 2),
+    Isotopologue('M+2 34S', 1.9957958, 'S', 1),
+]
+
+elements = [atom for atom in atom_masses if atom != 'e']
+element_masses = np.array([atom_masses[atom] for atom in elements])
+
+
+def adduct_mass_delta(adduct):
+    '''Return mass added to M by an adduct, including lost electrons'''
+    delta = sum(atom_masses[atom] * count
+                for atom, count in adduct.composition.items())
+    return delta - adduct.charge * ELECTRON_MASS
+
+
+def element_counts(formulas):
+    '''Return an (n formulas x n elements) array of element counts'''
+    counts = np.zeros((len(formulas), len(elements)), dtype=np.int32)
+    index = {atom: i for i, atom in enumerate(elements)}
+    for row, formula in enumerate(formulas):
+        for atom, count in parse_formula(formula).items():
+            if atom in index:
+                counts[row, index[atom]] = count
+    return counts
+
+
+class IonTable(object):
+    '''
+    m/z of every ion of a set of compounds, sorted by m/z
+
+    Row i describes an ion of compound `compound_ids[i]` with isotopologue
+    `isotopologues[isotopologue[i]]` and adduct `adducts[adduct[i]]`.
+    '''
+    def __init__(self, compound_ids, mz, isotopologue, adduct):
+        order = np.argsort(mz, kind='stable')
+        self.compound_ids = compound_ids[order]
+        self.mz = mz[order]
+        self.isotopologue = isotopologue[order]
+        self.adduct = adduct[order]
+        self.charge = np.array([a.charge for a in adducts],
+                               dtype=np.int8)[self.adduct]
+
+    def __len__(self):
+        return len(self.mz)
+
+    def ranges(self, low, high):
+        '''Return start and end row indexes of ions within m/z windows'''
+        return (np.searchsorted(self.mz, low, side='left'),
+                np.searchsorted(self.mz, high, side='right'))
+
+    def rows(self, indexes=None):
+        '''Return list of dicts describing the ions at `indexes`'''
+        if indexes is None:
+            indexes = range(len(self))
+        return [{'compound_id': int(self.compound_ids[i]),
+                 'isotopologue': isotopologues[self.isotopologue[i]].name,
+                 'adduct': adducts[self.adduct[i]].name,
+                 'charge': int(self.charge[i]),
+                 'm_z': float(self.mz[i])} for i in indexes]
+
+
+def build_ion_table(compound_ids, formulas):
+    '''Compute the IonTable for compounds with the given formulas'''
+    counts = element_counts(formulas)
+    masses = counts @ element_masses
+    iso_shift = np.array([iso.mass_shift for iso in isotopologues])
+    iso_possible = np.ones((len(formulas), len(isotopologues)), dtype=bool)
+    for j, iso in enumerate(isotopologues):
+        if iso.element:
+            iso_possible[:, j] = (counts[:, elements.index(iso.element)]
+                                  >= iso.min_count)
+    deltas = np.array([adduct_mass_delta(a) for a in adducts])
+    charges = np.abs(np.array([a.charge for a in adducts]))
+    # Shape (compound, isotopologue, adduct)
+    mz = ((masses[:, None, None] + iso_shift[None, :, None]
+           + deltas[None, None, :]) / charges[None, None, :])
+    shape = mz.shape
+    compound_index, iso_index, adduct_index = np.indices(shape)
+    keep = np.broadcast_to(iso_possible[:, :, None], shape).ravel()
+    compound_ids = np.asarray(compound_ids, dtype=np.int32)
+    return IonTable(compound_ids[compound_index.ravel()[keep]],
+                    mz.ravel()[keep],
+                    iso_index.ravel()[keep].astype(np.int8),
+                    adduct_index.ravel()[keep].astype(np.int8))
+
+
+@lru_cache(maxsize=4096)
+def ion_table_for_formula(formula):
+    '''Return the IonTable of a single formula (cached per formula)'''
+    return build_ion_table([0], [formula])
+
+
+def compound_ion_table():
+    '''
+    Return the IonTable of every compound in the database
+
+    The table is cached with the app cache and rebuilt when data is loaded.
+    '''
+    def build():
+        rows = Compound.query.with_entities(
+            Compound.id, Compound.molecular_formula).all()
+        return build_ion_table([row.id for row in rows],
+                               [row.molecular_formula for row in rows])
+    versions = data_versions(['global']) if cache.enabled else ()
+    return cache.memoize('ion_table', versions, build)
@@ -0,0 +1,253 @@
+'''
+Background jobs for imports started from the web interface
+
+Uploaded files are saved in UPLOAD_DIR and recorded as queued Job rows.
+`flask run-jobs` starts worker processes that claim queued jobs with a
+conditional UPDATE, so any number of workers can share the table, and run
+them with the same import functions as the command line. Progress, row
+errors and timings are stored on the job for the status page. While a job
+runs its worker updates the job's heartbeat every JOB_HEARTBEAT_SECONDS;
+running jobs without a heartbeat for JOB_TIMEOUT_SECONDS, left by a worker
+that died, are marked failed when workers start and by `flask reap-jobs`.
+'''
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from flask import current_app
+from werkzeug.utils import secure_filename
+from metabolite_database import create_app, db
+from metabolite_database.importer import (load_compound_list, load_knowns,
+                                          read_compound_list_csv,
+                                          read_knowns_csv)
+from metabolite_database.mass_index import build_mass_index
+from metabolite_database.models import Job, data_versions
+
+job_kinds = ('knowns', 'compound_list')
+
+
+def enqueue_job(kind, upload, parameters, session=None):
+    '''Save an uploaded file and queue a job to import it'''
+    if kind not in job_kinds:
+        raise ValueError("Invalid job kind '{}'".format(kind))
+    session = session or db.session
+    directory = current_app.config['UPLOAD_DIR']
+    os.makedirs(directory, exist_ok=True)
+    filename = secure_filename(upload.filename) or 'upload.csv'
+    job = Job(kind=kind, filename=upload.filename,
+              parameters=json.dumps(parameters), progress='Queued')
+    session.add(job)
+    session.flush()
+    job.path = os.path.join(directory, '{}-{}'.format(job.id, filename))
+    upload.save(job.path)
+    session.commit()
+    return job
+
+
+def claim_job(worker, session=None):
+    '''Mark the oldest queued job as running by `worker` and return it'''
+    session = session or db.session
+    while True:
+        candidate = (session.query(Job.id).filter_by(status='queued')
+                     .order_by(Job.id).first())
+        if candidate is None:
+            session.rollback()
+            return None
+        now = datetime.utcnow()
+        claimed = (session.query(Job)
+                   .filter(Job.id == candidate.id, Job.status == 'queued')
+                   .update({'status': 'running', 'worker': worker,
+                            'started': now, 'heartbeat': now,
+                            'progress': 'Starting'},
+                           synchronize_session=False))
+        session.commit()
+        if claimed:
+            return session.get(Job, candidate.id)
+
+
+def reap_stale_jobs(timeout=None, session=None):
+    '''Mark running jobs without a heartbeat for `timeout` seconds failed'''
+    session = session or db.session
+    if timeout is None:
+        timeout = current_app.config['JOB_TIMEOUT_SECONDS']
+    now = datetime.utcnow()
+    reaped = (session.query(Job)
+              .filter(Job.status == 'running',
+                      db.func.coalesce(Job.heartbeat, Job.started)
+                      < now - timedelta(seconds=timeout))
+              .update({'status': 'failed', 'progress': 'Failed',
+                       'error': 'Worker stopped: no heartbeat for {} '
+                                'seconds'.format(timeout),
+                       'finished': now},
+                      synchronize_session=False))
+    session.commit()
+    return reaped
+
+
+def _beat(app, job_id, interval, stop):
+    '''Update the heartbeat of a running job until `stop` is set'''
+    with app.app_context():
+        while not stop.wait(interval):
+            try:
+                (db.session.query(Job)
+                 .filter(Job.id == job_id, Job.status == 'running')
+                 .update({'heartbeat': datetime.utcnow()},
+                         synchronize_session=False))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Heartbeat of job %s failed", job_id)
+        db.session.remove()
+
+
+def _set_progress(job, progress, session):
+    job.progress = progress
+    job.heartbeat = datetime.utcnow()
+    session.commit()
+
+
+def _row_errors(errors):
+    return [{'row': row, 'message': message} for row, message in errors]
+
+
+def knowns_summary(result):
+    return {'method': result.method.name,
+            'method_id': result.method.id,
+            'standard_run_id': result.standard_run.id,
+            'rows': result.knowns.num_rows,
+            'unchanged': result.unchanged,
+            'compounds_created': result.compounds_created,
+            'retention_times_created': result.retention_times_created,
+            'retention_times_updated': result.retention_times_updated,
+            'retention_times_deleted': result.retention_times_deleted,
+            'fieldnames': result.knowns.fieldnames,
+            'bad_compounds': _row_errors(result.bad_compounds),
+            'bad_retention_times': _row_errors(result.bad_retention_times),
+            'formula_warnings': _row_errors(result.formula_warnings),
+            'timings': result.timings}
+
+
+def compound_list_summary(result, num_rows, timings):
+    return {'compound_list': result.compound_list.name,
+            'compound_list_id': result.compound_list.id,
+            'rows': num_rows,
+            'compounds_added': result.compounds_added,
+            'not_found': result.not_found,
+            'fuzzy_matches': [{'value': m.value,
+                               'compound_id': m.compound_id,
+                               'score': m.score}
+                              for m in result.fuzzy_matches],
+            'timings': timings}
+
+
+def _run_knowns_job(job, parameters, session):
+    _set_progress(job, 'Reading file', session)
+    knowns = read_knowns_csv(job.path)
+    _set_progress(job, 'Loading {} rows'.format(knowns.num_rows), session)
+    result = load_knowns(
+        knowns, parameters['method'], parse(parameters['date']),
+        parameters['operator'],
+        method_description=parameters.get('method_description'),
+        run_notes=parameters.get('run_notes'),
+        upsert=parameters.get('upsert', False), session=session)
+    return knowns_summary(result)
+
+
+def _run_compound_list_job(job, parameters, session):
+    _set_progress(job, 'Reading file', session)
+    start = time.perf_counter()
+    values = read_compound_list_csv(job.path)
+    timings = [('parse', time.perf_counter() - start)]
+    _set_progress(job, 'Matching {} rows'.format(len(values)), session)
+    start = time.perf_counter()
+    result = load_compound_list(
+        values, parameters['name'],
+        description=parameters.get('description'),
+        fuzzy=parameters.get('fuzzy', True), session=session)
+    timings.append(('match and insert', time.perf_counter() - start))
+    return compound_list_summary(result, len(values), timings)
+
+
+def run_job(job, session=None):
+    '''
+    Run a claimed job, recording its result or error
+
+    The result is only recorded while the job is still running, so a job
+    already marked failed by reap_stale_jobs stays failed.
+    '''
+    session = session or db.session
+    job_id = job.id
+    parameters = json.loads(job.parameters)
+    runner = {'knowns': _run_knowns_job,
+              'compound_list': _run_compound_list_job}[job.kind]
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=_beat, daemon=True,
+        args=(current_app._get_current_object(), job_id,
+              current_app.config['JOB_HEARTBEAT_SECONDS'], stop))
+    heartbeat.start()
+    try:
+        summary = runner(job, parameters, session)
+    except Exception as e:
+        session.rollback()
+        current_app.logger.exception("Job %s failed", job_id)
+        values = {'status': 'failed', 'progress': 'Failed',
+                  'error': str(e) or e.__class__.__name__}
+    else:
+        values = {'status': 'done', 'progress': 'Finished',
+                  'result': json.dumps(summary)}
+    finally:
+        stop.set()
+        heartbeat.join()
+    values['finished'] = datetime.utcnow()
+    recorded = (session.query(Job)
+                .filter(Job.id == job_id, Job.status == 'running')
+                .update(values, synchronize_session=False))
+    session.commit()
+    if not recorded:
+        current_app.logger.warning(
+            "Job %s was no longer running; its result was not recorded",
+            job_id)
+    return session.get(Job, job_id)
+
+
+def work(worker, poll_interval=2.0, once=False):
+    '''Run queued jobs until stopped (or the queue is empty with `once`)'''
+    count = 0
+    reap_stale_jobs()
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            if once:
+                return count
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        count += 1
+        directory = current_app.config.get('MASS_INDEX_DIR')
+        if directory and job.status == 'done':
+            build_mass_index(directory, data_versions(['global'])[0])
+        db.session.remove()
+
+
+def _worker_process(number, poll_interval, once):
+    app = create_app(profile='cli')
+    with app.app_context():
+        return work('{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                      number),
+                    poll_interval=poll_interval, once=once)
+
+
+def run_workers(num_workers, poll_interval=2.0, once=False):
+    '''Run jobs in `num_workers` processes; return number of jobs run'''
+    if num_workers == 1:
+        return work('{}:{}'.format(socket.gethostname(), os.getpid()),
+                    poll_interval=poll_interval, once=once)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_worker_process, i, poll_interval, once)
+                   for i in range(num_workers)]
+        return sum(future.result() for future in futures)
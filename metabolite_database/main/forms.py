@@ -1,6 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import SelectField, SelectMultipleField, SubmitField, widgets
-from wtforms.validators import DataRequired, InputRequired
+from flask_wtf.file import FileAllowed, FileField, FileRequired
+from wtforms import (BooleanField, DateField, SelectField,
+                     SelectMultipleField, StringField, SubmitField,
+                     TextAreaField, widgets)
+from wtforms.validators import DataRequired, InputRequired, Optional
 
 
 class MultiCheckboxField(SelectMultipleField):
@@ -19,4 +22,29 @@ class RetentionTimesForm(FlaskForm):
                                validators=[InputRequired()])
     standardruns = MultiCheckboxField(
         'Standard Runs', coerce=int, validators=[DataRequired()])
+    aligned = BooleanField('Correct retention time drift against the '
+                           'reference run')
     submit = SubmitField('Get List')
+
+
+class UploadKnownsForm(FlaskForm):
+    csvfile = FileField('Knowns CSV File (Name, Formula and RT columns)',
+                        validators=[FileRequired(), FileAllowed(['csv'])])
+    method = StringField('Chromatography Method', validators=[DataRequired()])
+    date = DateField('Run Date', validators=[DataRequired()])
+    operator = StringField('Operator', validators=[DataRequired()])
+    method_description = TextAreaField('Method Description',
+                                       validators=[Optional()])
+    run_notes = TextAreaField('Run Notes', validators=[Optional()])
+    upsert = BooleanField('Update the standard run if it already exists')
+    submit = SubmitField('Upload Knowns')
+
+
+class UploadCompoundListForm(FlaskForm):
+    csvfile = FileField('Compound List CSV File (compound id, name or '
+                        'formula in the first column)',
+                        validators=[FileRequired(), FileAllowed(['csv'])])
+    name = StringField('List Name', validators=[DataRequired()])
+    description = TextAreaField('Description', validators=[Optional()])
+    exact = BooleanField('Only match exact ids, names and formulas')
+    submit = SubmitField('Upload Compound List')
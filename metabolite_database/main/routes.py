@@ -1,8 +1,35 @@
-from flask import (render_template, current_app, redirect, url_for)
+from flask import (render_template, current_app, redirect, url_for, request,
+                   Response, stream_with_context, abort, flash)
+from sqlalchemy.orm import joinedload, selectinload, undefer
+from werkzeug.utils import secure_filename
+from metabolite_database import cache
+from metabolite_database.database import stop_using_replica, use_replica
 from metabolite_database.models import (Compound, ChromatographyMethod,
-                                        StandardRun, CompoundList)
+                                        StandardRun, CompoundList,
+                                        RetentionTime, RetentionTimeSummary,
+                                        Job, data_versions,
+                                        method_version_key)
 from metabolite_database.main import bp
-from metabolite_database.main.forms import RetentionTimesForm
+from metabolite_database.jobs import enqueue_job
+from metabolite_database.main.forms import (RetentionTimesForm,
+                                            UploadCompoundListForm,
+                                            UploadKnownsForm)
+from metabolite_database.ions import ion_table_for_formula
+from metabolite_database.exports import (export_layouts, iter_export,
+                                         parse_modes)
+
+
+# Pages that must show the latest writes
+primary_endpoints = {'main.upload', 'main.jobs', 'main.job'}
+
+
+@bp.before_request
+def read_from_replica():
+    if request.method == 'GET' and request.endpoint not in primary_endpoints:
+        use_replica()
+
+
+bp.teardown_request(stop_using_replica)
 
 
 @bp.route('/')
@@ -12,85 +39,165 @@ def index():
 
 
 @bp.route('/compounds')
+@cache.cached_page('global')
 def compounds():
-    compounds = Compound.query.all()
     return render_template('main/compound_list.html',
                            title="All Compounds",
                            description="All compounds in the database",
-                           compounds=compounds)
+                           compound_count=Compound.query.count(),
+                           data_url=url_for('api.compounds'))
 
 
 @bp.route('/compound/<id>')
+@cache.cached_page('global')
 def compound(id):
-    compound = Compound.query.filter_by(id=id).first_or_404()
+    compound = Compound.query.filter_by(id=id).options(
+        selectinload(Compound.retention_times)
+        .joinedload(RetentionTime.standard_run)
+        .joinedload(StandardRun.chromatography_method),
+        selectinload(Compound.retention_time_summaries)
+        .joinedload(RetentionTimeSummary.chromatography_method),
+        selectinload(Compound.compound_lists)).first_or_404()
+    ions = ion_table_for_formula(compound.molecular_formula).rows()
     return render_template('main/compound.html',
-                           title=compound.name, compound=compound)
+                           title=compound.name, compound=compound, ions=ions)
 
 
 @bp.route('/compound_lists')
+@cache.cached_page('global')
 def compound_lists():
-    compound_lists = CompoundList.query.all()
+    compound_lists = CompoundList.query.options(
+        undefer(CompoundList.compound_count)).all()
     return render_template('main/compound_lists.html',
                            title="Compound Lists",
                            compound_lists=compound_lists)
 
 
 @bp.route('/compound_list/<id>')
+@cache.cached_page('global')
 def compound_list(id):
-    compound_list = CompoundList.query.filter_by(id=id).first_or_404()
+    compound_list = CompoundList.query.filter_by(id=id).options(
+        undefer(CompoundList.compound_count)).first_or_404()
     return render_template('main/compound_list.html',
                            title=compound_list.name,
                            description=compound_list.description,
-                           compounds=compound_list.compounds)
+                           compound_count=compound_list.compound_count,
+                           data_url=url_for('api.compounds',
+                                            compound_list_id=compound_list.id),
+                           matrix_url=url_for(
+                               'api.retention_time_matrix',
+                               compound_list_id=compound_list.id))
 
 
 @bp.route('/methods')
+@cache.cached_page('global')
 def methods():
-    methods = ChromatographyMethod.query.all()
+    methods = ChromatographyMethod.query.options(
+        undefer(ChromatographyMethod.standard_run_count),
+        undefer(ChromatographyMethod.compound_count)).all()
     return render_template('main/methods.html',
                            title="Chromatography Methods", methods=methods)
 
 
-@bp.route('/method/<id>', methods=['GET', 'POST'])
-def method(id):
-    method = ChromatographyMethod.query.filter_by(id=id).first_or_404()
+def method_choices(method):
+    '''Return compound list and standard run choices for a method'''
     compound_lists = [(0, "All ({} compounds)".format(
         Compound.query.count()))]
     compound_lists.extend([(cl.id, "{} ({} compounds)".format(
-        cl.name, len(cl.compounds))) for cl in CompoundList.query.all()])
+        cl.name, cl.compound_count)) for cl in CompoundList.query.options(
+            undefer(CompoundList.compound_count))])
+    runs = StandardRun.query.filter_by(
+        chromatography_method_id=method.id).options(
+        undefer(StandardRun.retention_time_count)).all()
     standard_runs = [
         (r.id, "Run on {:%Y-%m-%d} by {} ({} retention times)".format(
-            r.date, r.operator, len(r.retention_times)))
-        for r in method.standard_runs]
+            r.date, r.operator, r.retention_time_count))
+        for r in runs]
+    return compound_lists, standard_runs
+
+
+@bp.route('/method/<id>', methods=['GET', 'POST'])
+def method(id):
+    method = ChromatographyMethod.query.filter_by(id=id).first_or_404()
+    versions = ()
+    if cache.enabled:
+        versions = data_versions(['global', method_version_key(method.id)])
+    compound_lists, standard_runs = cache.memoize(
+        'method_choices:{}'.format(method.id), versions,
+        lambda: method_choices(method))
+    run_ids = [run_id for run_id, label in standard_runs]
     form = RetentionTimesForm(
         compoundlist=0,
-        standardruns=[r.id for r in method.standard_runs])
+        standardruns=run_ids)
     form.compoundlist.choices = compound_lists
     form.standardruns.choices = standard_runs
-    retention_times = None
+    retention_times_table = None
     current_app.logger.debug("compound list data: {}".format(
         form.compoundlist.data))
     if form.validate_on_submit():
-        retention_times = method.retention_time_means(
-            compound_list_id=form.compoundlist.data,
-            standard_run_ids=form.standardruns.data)
+        retention_times_table = cache.memoize(
+            'retention_times:{}:{}:{}:{}'.format(
+                method.id, form.compoundlist.data,
+                sorted(form.standardruns.data), form.aligned.data), versions,
+            lambda: render_template(
+                'main/_retention_times.html',
+                method=method,
+                form=form,
+                retention_times=method.retention_time_means(
+                    compound_list_id=form.compoundlist.data,
+                    standard_run_ids=form.standardruns.data,
+                    aligned=form.aligned.data),
+                export_layouts=export_layouts))
         if form.submit.data:
             current_app.logger.debug("Select form submitted")
     if not form.standardruns.data:
-        form.standardruns.process_data([r.id for r in method.standard_runs])
+        form.standardruns.process_data(run_ids)
     return render_template(
         'main/method.html',
         title="{} method".format(method.name),
         method=method,
         form=form,
-        retention_times=retention_times)
+        retention_times_table=retention_times_table)
+
+
+@bp.route('/method/<id>/export')
+def export_method(id):
+    method = ChromatographyMethod.query.filter_by(id=id).first_or_404()
+    layout = request.args.get('format', 'elmaven')
+    compound_list_id = request.args.get('compoundlist', type=int)
+    list_name = method.name
+    if compound_list_id:
+        list_name = CompoundList.query.get_or_404(compound_list_id).name
+    flags = ('1', 'true', 'on', 'yes')
+    try:
+        chunks = iter_export(
+            layout,
+            method.iter_retention_time_means(
+                standard_run_ids=request.args.getlist('standardruns',
+                                                      type=int),
+                compound_list_id=compound_list_id,
+                yield_per=1000,
+                aligned=request.args.get('aligned', '').lower() in flags),
+            modes=parse_modes(request.args.get('mode')),
+            list_name=list_name)
+    except ValueError:
+        abort(400)
+    filename = "{}.{}".format(secure_filename(list_name),
+                              export_layouts[layout].extension)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=export_layouts[layout].mimetype,
+        headers={'Content-Disposition':
+                 'attachment; filename="{}"'.format(filename)})
 
 
 @bp.route('/standard_runs')
 @bp.route('/standardruns')
 @bp.route('/standard-runs')
+@cache.cached_page('global')
 def standard_runs():
-    runs = StandardRun.query.all()
+    runs = StandardRun.query.options(
+        undefer(StandardRun.retention_time_count)).all()
     return render_template('main/standard_runs.html',
                            title="Standard runs", runs=runs)
 
@@ -98,8 +205,51 @@ def standard_runs():
 @bp.route('/standard_run/<id>')
 @bp.route('/standardrun/<id>')
 @bp.route('/standard-run/<id>')
+@cache.cached_page('global')
 def standard_run(id):
-    run = StandardRun.query.filter_by(id=id).first_or_404()
+    run = StandardRun.query.filter_by(id=id).options(
+        joinedload(StandardRun.chromatography_method),
+        selectinload(StandardRun.retention_times)
+        .joinedload(RetentionTime.compound)).first_or_404()
     # TODO Fix date represntation (how to use moment for format?)
     return render_template('main/standard_run.html',
                            title="Standard run: {}".format(run.date), run=run)
+
+
+@bp.route('/upload', methods=['GET', 'POST'])
+def upload():
+    knowns_form = UploadKnownsForm(prefix='knowns')
+    list_form = UploadCompoundListForm(prefix='list')
+    job = None
+    if knowns_form.submit.data and knowns_form.validate():
+        job = enqueue_job('knowns', knowns_form.csvfile.data, {
+            'method': knowns_form.method.data.strip(),
+            'date': knowns_form.date.data.isoformat(),
+            'operator': knowns_form.operator.data.strip(),
+            'method_description': knowns_form.method_description.data or None,
+            'run_notes': knowns_form.run_notes.data or None,
+            'upsert': knowns_form.upsert.data})
+    elif list_form.submit.data and list_form.validate():
+        job = enqueue_job('compound_list', list_form.csvfile.data, {
+            'name': list_form.name.data.strip(),
+            'description': list_form.description.data or None,
+            'fuzzy': not list_form.exact.data})
+    if job is not None:
+        flash("Queued import of {}".format(job.filename))
+        return redirect(url_for('main.job', id=job.id))
+    return render_template('main/upload.html', title="Upload",
+                           knowns_form=knowns_form, list_form=list_form)
+
+
+@bp.route('/jobs')
+def jobs():
+    jobs = Job.query.order_by(Job.id.desc()).limit(100).all()
+    return render_template('main/jobs.html', title="Import jobs", jobs=jobs)
+
+
+@bp.route('/job/<int:id>')
+def job(id):
+    job = Job.query.get_or_404(id)
+    return render_template('main/job.html',
+                           title="Import job {}".format(job.id), job=job,
+                           result=job.result_data)
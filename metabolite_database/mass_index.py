@@ -0,0 +1,156 @@
+'''
+Read-only index of compound ids, names, formulas and masses
+
+The index is a struct of arrays sorted by monoisotopic mass. It is saved as
+.npy files in a directory per data version (MASS_INDEX_DIR/v<version>) and
+memory-mapped when loaded, so every worker process shares the same pages
+and lookups need no ORM objects.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from flask import current_app
+from metabolite_database import cache, db
+from metabolite_database.models import Compound, data_versions
+
+array_names = ('masses', 'ids', 'name_offsets', 'names', 'formula_offsets',
+               'formulas')
+
+_mapped = {}
+_mapped_lock = threading.Lock()
+
+
+def _pack_strings(strings):
+    '''Return (offsets, blob) arrays for a list of strings'''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+
+class MassIndex(object):
+    '''Compounds sorted by monoisotopic mass'''
+    def __init__(self, masses, ids, name_offsets, names, formula_offsets,
+                 formulas):
+        self.masses = masses
+        self.ids = ids
+        self.name_offsets = name_offsets
+        self.names = names
+        self.formula_offsets = formula_offsets
+        self.formulas = formulas
+
+    @classmethod
+    def from_database(cls, session=None):
+        session = session or db.session
+        rows = (session.query(Compound.id, Compound.name,
+                              Compound.molecular_formula,
+                              Compound.monoisotopic_mass)
+                .filter(Compound.monoisotopic_mass.isnot(None))
+                .order_by(Compound.monoisotopic_mass, Compound.id)
+                .all())
+        name_offsets, names = _pack_strings([row.name for row in rows])
+        formula_offsets, formulas = _pack_strings(
+            [row.molecular_formula for row in rows])
+        return cls(np.array([row.monoisotopic_mass for row in rows],
+                            dtype=np.float64),
+                   np.array([row.id for row in rows], dtype=np.int32),
+                   name_offsets, names, formula_offsets, formulas)
+
+    @classmethod
+    def load(cls, path):
+        '''Memory-map an index saved in `path`'''
+        return cls(*[np.load(os.path.join(path, name + '.npy'),
+                             mmap_mode='r') for name in array_names])
+
+    def save(self, path):
+        for name in array_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    def __len__(self):
+        return len(self.masses)
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:
+                          self.name_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def formula(self, i):
+        return self.formulas[
+            self.formula_offsets[i]:
+            self.formula_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def ranges(self, low, high):
+        '''Return start and end indexes of compounds within mass windows'''
+        return (np.searchsorted(self.masses, low, side='left'),
+                np.searchsorted(self.masses, high, side='right'))
+
+
+def build_mass_index(directory, version, session=None):
+    '''
+    Save the index for a data version in `directory` and return its path
+
+    The index is written to a temporary directory and renamed into place,
+    so readers never see a partial index. Indexes older than the previous
+    version are removed; processes that still have them mapped keep
+    working, and the previous one is kept for processes that have not seen
+    the new version yet.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'v{}'.format(version))
+    tmp = tempfile.mkdtemp(dir=directory, prefix='.build-')
+    try:
+        MassIndex.from_database(session).save(tmp)
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    for entry in os.scandir(directory):
+        if not entry.is_dir() or not entry.name.startswith('v'):
+            continue
+        try:
+            entry_version = int(entry.name[1:])
+        except ValueError:
+            continue
+        if entry_version < version - 1:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    return path
+
+
+def current_mass_index():
+    '''
+    Return the MassIndex for the current data version
+
+    With MASS_INDEX_DIR set, the saved index is memory-mapped (building it
+    first if needed) and kept mapped for the life of the process. Otherwise
+    the index is built in memory and kept in the app cache, as it also is
+    when the saved index was removed by another process before it could be
+    mapped.
+    '''
+    directory = current_app.config.get('MASS_INDEX_DIR')
+    version = data_versions(['global'])[0]
+    if not directory:
+        return cache.memoize('mass_index', (version,),
+                             MassIndex.from_database)
+    key = (directory, version)
+    with _mapped_lock:
+        index = _mapped.get(key)
+        if index is None:
+            path = os.path.join(directory, 'v{}'.format(version))
+            if not os.path.isdir(path):
+                build_mass_index(directory, version)
+            try:
+                index = MassIndex.load(path)
+            except OSError:
+                current_app.logger.warning(
+                    "Mass index %s was removed before it was loaded", path)
+            else:
+                _mapped.clear()
+                _mapped[key] = index
+    if index is None:
+        index = cache.memoize('mass_index', (version,),
+                              MassIndex.from_database)
+    return index
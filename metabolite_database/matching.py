@@ -0,0 +1,160 @@
+'''
+Resolve compound references against an in-memory lookup
+
+A CompoundLookup is loaded with one query for compounds and one for
+synonyms, and resolves values the way compound list files refer to
+compounds: by id, by standardized name or synonym, by molecular formula if
+only one compound has it and, failing those, by the most similar name in a
+trigram index.
+'''
+from collections import Counter, defaultdict, namedtuple
+from metabolite_database import db
+from metabolite_database.models import (Compound, Synonym,
+                                        standardize_compound_name)
+
+Match = namedtuple('Match', ['value', 'compound_id', 'method', 'score'])
+
+# Lowest trigram similarity accepted as a fuzzy match
+MIN_SIMILARITY = 0.6
+
+
+def trigrams(text):
+    '''Return the set of trigrams of a standardized string
+
+    Each word is padded with two spaces in front and one behind, as in
+    PostgreSQL's pg_trgm, so short words and word starts weigh more.
+    '''
+    grams = set()
+    for word in text.split():
+        padded = '  {} '.format(word)
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex(object):
+    '''Index of strings by trigram for similarity search'''
+    def __init__(self, keys=()):
+        self.keys = []
+        self.sizes = []
+        self.postings = defaultdict(list)
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        i = len(self.keys)
+        grams = trigrams(key)
+        self.keys.append(key)
+        self.sizes.append(len(grams))
+        for gram in grams:
+            self.postings[gram].append(i)
+
+    def similar(self, text, min_similarity=MIN_SIMILARITY):
+        '''Return (position, similarity) pairs of keys similar to text
+
+        Similarity is the number of shared trigrams divided by the number
+        of distinct trigrams in either string.
+        '''
+        grams = trigrams(text)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        results = []
+        for i, count in shared.items():
+            similarity = count / (len(grams) + self.sizes[i] - count)
+            if similarity >= min_similarity:
+                results.append((i, similarity))
+        return results
+
+    def search(self, text, min_similarity=MIN_SIMILARITY, limit=None):
+        '''Return (key, similarity) pairs most similar to text first'''
+        results = [(self.keys[i], similarity) for i, similarity
+                   in self.similar(text, min_similarity)]
+        results.sort(key=lambda r: (-r[1], r[0]))
+        return results[:limit] if limit else results
+
+    def containing(self, text):
+        '''
+        Return the positions of keys containing text
+
+        Candidates share the rarest trigram inside the words of text and
+        are then checked, so text needs a word of three or more characters.
+        '''
+        grams = [word[i:i + 3] for word in text.split()
+                 for i in range(len(word) - 2)]
+        if not grams:
+            return []
+        postings = min((self.postings.get(gram, ()) for gram in grams),
+                       key=len)
+        return [i for i in postings if text in self.keys[i]]
+
+
+class CompoundLookup(object):
+    '''Compound ids by id, standardized name, synonym and formula'''
+    def __init__(self, session=None):
+        session = session or db.session
+        self.ids = set()
+        self.names = {}
+        self.synonyms = {}
+        self.formulas = defaultdict(list)
+        for id, standardized_name, formula in session.query(
+                Compound.id, Compound.standardized_name,
+                Compound.molecular_formula):
+            self.ids.add(id)
+            self.names[standardized_name] = id
+            self.formulas[formula].append(id)
+        for compound_id, standardized_name in session.query(
+                Synonym.compound_id, Synonym.standardized_name):
+            self.synonyms[standardized_name] = compound_id
+        self._index = None
+
+    @property
+    def index(self):
+        '''Trigram index of names and synonyms, built on first use'''
+        if self._index is None:
+            self._index = TrigramIndex(list(self.names)
+                                       + list(self.synonyms))
+        return self._index
+
+    def name_id(self, standardized_name):
+        '''Return id of the compound with this name or synonym'''
+        id = self.names.get(standardized_name)
+        if id is None:
+            id = self.synonyms.get(standardized_name)
+        return id
+
+    def resolve(self, value, fuzzy=True, min_similarity=MIN_SIMILARITY):
+        '''Return the Match for one value (compound_id None if not found)'''
+        value = value.strip()
+        try:
+            id = int(value)
+        except ValueError:
+            pass
+        else:
+            if id in self.ids:
+                return Match(value, id, 'id', 1.0)
+        standardized_name = standardize_compound_name(value)
+        if standardized_name in self.names:
+            return Match(value, self.names[standardized_name], 'name', 1.0)
+        if standardized_name in self.synonyms:
+            return Match(value, self.synonyms[standardized_name], 'synonym',
+                         1.0)
+        ids = self.formulas.get(value, ())
+        if len(ids) == 1:
+            return Match(value, ids[0], 'formula', 1.0)
+        if fuzzy and standardized_name:
+            candidates = self.index.search(standardized_name,
+                                           min_similarity=min_similarity)
+            if candidates:
+                best = candidates[0][1]
+                ids = set(self.name_id(key) for key, similarity
+                          in candidates if similarity == best)
+                # Equally similar names of different compounds are ambiguous
+                if len(ids) == 1:
+                    return Match(value, ids.pop(), 'fuzzy', best)
+        return Match(value, None, None, 0.0)
+
+    def resolve_all(self, values, fuzzy=True,
+                    min_similarity=MIN_SIMILARITY):
+        '''Return a Match for each value'''
+        return [self.resolve(value, fuzzy, min_similarity)
+                for value in values]
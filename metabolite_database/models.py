@@ -1,21 +1,61 @@
+import json
+import math
 import re
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
 from metabolite_database import db
+from metabolite_database.alignment import apply_alignment, fit_alignment
+from sqlalchemy import DDL, event
 from sqlalchemy.orm import validates
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import label, func
 from flask import current_app
 
 valid_atoms = {
     'e': 0.00054857990943,
+    'Br': 78.9183371,
     'C': 12.00000000,
+    'Cl': 34.96885268,
+    'F': 18.99840322,
     'H': 1.00782503224,
     'I': 126.904457,
+    'K': 38.96370649,
     'N': 14.0030740052,
+    'Na': 22.98976928,
     'O': 15.9949146221,
     'P': 30.97376151,
-    'S': 31.972072}
+    'S': 31.972072,
+    'Si': 27.9769265325}
+
+# Isotope labels, written in formulas as for example C4[13C]2H12O6
+valid_isotopes = {
+    '[2H]': 2.0141017778,
+    '[13C]': 13.0033548378,
+    '[15N]': 15.0001088984,
+    '[18O]': 17.9991596129,
+    '[34S]': 33.96786690}
+
+atom_masses = dict(valid_atoms, **valid_isotopes)
+
+
+RetentionTimeMean = namedtuple('RetentionTimeMean',
+                               ['compound', 'mean_rt', 'sd_rt', 'n_runs'])
+
+
+def _retention_time_mean(compound, rt_sum, rt_count, rt_sum_squares,
+                         n_runs):
+    mean_rt = sd_rt = None
+    if rt_count:
+        mean_rt = rt_sum / rt_count
+    if rt_count and rt_count > 1:
+        variance = (rt_sum_squares - rt_sum * mean_rt) / (rt_count - 1)
+        sd_rt = math.sqrt(max(variance, 0.0))
+    return RetentionTimeMean(compound, mean_rt, sd_rt, n_runs or 0)
 
 
 compoundlists = db.Table(
@@ -23,7 +63,134 @@ compoundlists = db.Table(
     db.Column('compound_id', db.Integer,
               db.ForeignKey('compound.id'), primary_key=True),
     db.Column('compound_list_id', db.Integer,
-              db.ForeignKey('compound_list.id'), primary_key=True))
+              db.ForeignKey('compound_list.id'), primary_key=True,
+              index=True))
+
+
+_formula_token = re.compile(r'(\[\d+[A-Z][a-z]?\]|[A-Z][a-z]?|e)(\d*)')
+
+FormulaError = namedtuple('FormulaError', ['row', 'formula', 'message'])
+
+
+def _element(atom):
+    '''Return the element symbol of an atom or isotope label'''
+    return atom.strip('[]0123456789')
+
+
+def _hill_key(atom, has_carbon):
+    element = _element(atom)
+    rank = 2
+    if has_carbon and element in ('C', 'H'):
+        rank = 0 if element == 'C' else 1
+    return (rank, element, atom != element, atom)
+
+
+def hill_formula(counts):
+    '''Return the formula of a dict of atom counts in Hill order
+
+    Carbon and hydrogen come first when carbon is present, followed by the
+    other elements alphabetically. Isotope labels follow their element.
+    '''
+    has_carbon = any(_element(atom) == 'C' for atom in counts)
+    formula = ''
+    for atom in sorted(counts, key=lambda a: _hill_key(a, has_carbon)):
+        count = counts[atom]
+        formula += atom if count == 1 else '{}{}'.format(atom, count)
+    return formula
+
+
+def check_formula(formula, strict=True):
+    '''Return (counts, errors) for a molecular formula
+
+    The formula is tokenized in a single pass against `atom_masses`. With
+    `strict`, repeated atoms and zero counts are also errors. Formulas need
+    not be in Hill order (see hill_order_warning).
+    '''
+    counts = {}
+    errors = []
+    if not formula:
+        return counts, ["formula must not be blank"]
+    pos = 0
+    while pos < len(formula):
+        m = _formula_token.match(formula, pos)
+        if not m:
+            errors.append("'{}' not recognized".format(formula[pos:]))
+            break
+        atom, num_atom = m.groups()
+        pos = m.end()
+        if atom not in atom_masses:
+            errors.append("unknown atom '{}'".format(atom))
+            continue
+        if strict and atom in counts:
+            errors.append("'{}' repeated".format(atom))
+        count = int(num_atom) if num_atom else 1
+        if strict and count == 0:
+            errors.append("'{}' has a count of zero".format(atom))
+        counts[atom] = counts.get(atom, 0) + count
+    return counts, errors
+
+
+def hill_order_warning(formula):
+    '''Return a message if a valid formula is not in Hill order, or None'''
+    order = [m.group(1) for m in _formula_token.finditer(formula)]
+    has_carbon = any(_element(atom) == 'C' for atom in order)
+    if order == sorted(order, key=lambda a: _hill_key(a, has_carbon)):
+        return None
+    return "not in Hill order, expected {}".format(
+        hill_formula(check_formula(formula, strict=False)[0]))
+
+
+def parse_formula(formula, strict=False):
+    '''Return a dict of atom counts for a molecular formula
+
+    Raises AssertionError if the formula is not valid (see check_formula).
+    '''
+    counts, errors = check_formula(formula, strict)
+    if errors:
+        raise AssertionError("Invalid formula specified: {}".format(
+            '; '.join(errors)))
+    return counts
+
+
+def formula_monoisotopic_mass(formula, strict=False):
+    '''Return the monoisotopic mass of a molecular formula'''
+    counts = parse_formula(formula, strict)
+    mass = 0.0
+    for atom, atom_mass in atom_masses.items():
+        mass += counts.get(atom, 0) * atom_mass
+    return mass
+
+
+def validate_formulas(formulas, strict=True):
+    '''
+    Validate a column of formulas in one pass
+
+    Returns (masses, errors, warnings): masses[i] is the monoisotopic mass
+    of formulas[i] or None if it is invalid, errors holds a FormulaError
+    for each invalid row (rows numbered from 0) and warnings one for each
+    valid row whose formula is not in Hill order. Each distinct formula is
+    only checked once.
+    '''
+    checked = {}
+    masses = []
+    errors = []
+    warnings = []
+    for row, formula in enumerate(formulas):
+        result = checked.get(formula)
+        if result is None:
+            try:
+                result = (formula_monoisotopic_mass(formula, strict), None,
+                          hill_order_warning(formula))
+            except AssertionError as e:
+                result = (None, str(e), None)
+            checked[formula] = result
+        mass, message, warning = result
+        masses.append(mass)
+        if message is not None:
+            errors.append(FormulaError(row, formula, message))
+        if warning is not None:
+            warnings.append(FormulaError(row, formula, warning))
+    return masses, errors, warnings
 
 
 def standardize_compound_name(name):
@@ -35,6 +202,41 @@ def standardized_compound_name_default(context):
     return standardize_compound_name(context.get_current_parameters()['name'])
 
 
+greek_letters = {
+    'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta', 'ε': 'epsilon',
+    'ζ': 'zeta', 'η': 'eta', 'θ': 'theta', 'ι': 'iota', 'κ': 'kappa',
+    'λ': 'lambda', 'μ': 'mu', 'ν': 'nu', 'ξ': 'xi', 'ο': 'omicron',
+    'π': 'pi', 'ρ': 'rho', 'σ': 'sigma', 'ς': 'sigma', 'τ': 'tau',
+    'υ': 'upsilon', 'φ': 'phi', 'χ': 'chi', 'ψ': 'psi', 'ω': 'omega'}
+
+# D-/L-/DL- configuration and optical rotation prefixes, e.g. "(+)-"
+stereo_prefix_pattern = re.compile(
+    r'(?<!\w)(?:(?:d|l|dl|rac)-|\((?:\+|-|\+/-|±|r|s|rs)\)-?)')
+hydrate_suffix_pattern = re.compile(
+    r'[\s,;.·*]+(?:(?:mono|di|tri|tetra|penta|hexa|hepta|octa|hemi|sesqui)?'
+    r'hydrate|(?:[xn]\s*)?(?:\d+(?:\.\d+)?)?\s*h2o)$')
+separator_pattern = re.compile(r'[\W_]+')
+
+
+def normalize_compound_name(name):
+    '''
+    Return a compound name normalized for searching
+
+    Greek letters are spelled out, D-/L- and optical rotation prefixes and
+    hydrate suffixes are removed and punctuation is replaced by single
+    spaces, so "D-Glucose monohydrate" and "glucose" search alike.
+    '''
+    name = unicodedata.normalize('NFKC', name).lower()
+    name = ''.join(greek_letters.get(c, c) for c in name)
+    name = hydrate_suffix_pattern.sub('', name.strip())
+    name = stereo_prefix_pattern.sub('', name)
+    return separator_pattern.sub(' ', name).strip()
+
+
+def search_name_default(context):
+    return normalize_compound_name(context.get_current_parameters()['name'])
+
+
 class CompoundList(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(256), unique=True, nullable=False)
@@ -46,48 +248,36 @@ class CompoundList(db.Model):
 class Compound(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     standardized_name = db.Column(db.String(256), index=True, unique=True,
-                                  default=standardized_compound_name_default,
-                                  onupdate=standardized_compound_name_default)
+                                  default=standardized_compound_name_default)
     name = db.Column(db.String(256), index=True, unique=True, nullable=False)
+    search_name = db.Column(db.String(256), index=True,
+                            default=search_name_default)
     molecular_formula = db.Column(db.String(128), index=True, nullable=False)
+    monoisotopic_mass = db.Column(db.Float, index=True)
     notes = db.Column(db.Text)
     external_databases = db.relationship('DbXref', back_populates="compound")
     retention_times = db.relationship('RetentionTime', backref="compound")
+    synonyms = db.relationship('Synonym', back_populates="compound",
+                               order_by='Synonym.name')
+    retention_time_summaries = db.relationship(
+        'RetentionTimeSummary', viewonly=True,
+        order_by='RetentionTimeSummary.chromatography_method_id')
     compound_lists = db.relationship('CompoundList', secondary=compoundlists,
                                      back_populates="compounds")
 
+    @validates('name')
+    def standardize_name(self, key, name):
+        if name is not None:
+            self.standardized_name = standardize_compound_name(name)
+            self.search_name = normalize_compound_name(name)
+        return name
+
     @validates('molecular_formula')
     def is_formula_valid(self, key, formula):
-        if formula == '' or formula is None:
-            raise AssertionError("Molecular formula must not be blank")
-        check_formula = formula
-        for atom in valid_atoms.keys():
-            check_formula = re.sub(r'{}[\d]*'.format(atom), '', check_formula)
-        if check_formula != '':
-            raise AssertionError("Invalid formula specified: '{}' not "
-                                 "recognized".format(check_formula))
+        self.monoisotopic_mass = formula_monoisotopic_mass(formula,
+                                                           strict=True)
         return formula
 
-    @hybrid_property
-    def monoisotopic_mass(self):
-        mass = None
-        # print(self.molecular_formula)
-        mass = 0.0
-        for atom in valid_atoms.keys():
-            num_atom = 0
-            m = re.match(r'.*{}(\d*).*'.format(atom),
-                         self.molecular_formula)
-            if m:
-                # print("Num {} atoms: {}".format(atom, m.group(1)))
-                try:
-                    num_atom = int(m.group(1))
-                except ValueError:
-                    num_atom = 1
-            # print("weight = {} + ({} * {})".format(
-            #       mass, valid_atoms[atom], num_atom))
-            mass += num_atom * valid_atoms[atom]
-        return mass
-
     def m_z(self, mode):
         m_z = None
         if (self.monoisotopic_mass):
@@ -102,6 +292,29 @@ class Compound(db.Model):
         return '<Compound {}>'.format(self.name)
 
 
+class Synonym(db.Model):
+    '''Alternative name of a compound, used to match compound lists'''
+    id = db.Column(db.Integer, primary_key=True)
+    compound_id = db.Column(db.Integer, db.ForeignKey('compound.id'),
+                            index=True, nullable=False)
+    name = db.Column(db.String(256), nullable=False)
+    standardized_name = db.Column(db.String(256), index=True, unique=True,
+                                  nullable=False)
+    search_name = db.Column(db.String(256), index=True,
+                            default=search_name_default)
+    compound = db.relationship("Compound", back_populates="synonyms")
+
+    @validates('name')
+    def standardize_name(self, key, name):
+        if name is not None:
+            self.standardized_name = standardize_compound_name(name)
+            self.search_name = normalize_compound_name(name)
+        return name
+
+    def __repr__(self):
+        return '<Synonym {}>'.format(self.name)
+
+
 class DbXref(db.Model):
     __tablename__ = 'dbxref'
     # id = db.Column(db.Integer, primary_key=True)
@@ -138,24 +351,181 @@ class ChromatographyMethod(db.Model):
                                     backref='chromatography_method')
 
     def retention_time_means(self, standard_run_ids=None,
-                             compound_list_id=None):
+                             compound_list_id=None, aligned=False):
         '''
         Return list of compounds and retention time means for specified runs
+
+        Each item is a RetentionTimeMean of (compound, mean_rt, sd_rt,
+        n_runs), summed from the per-run rows of RetentionTimeAggregate.
+        With `aligned`, each run's retention times are first corrected with
+        its RetentionTimeAlignment.
+        '''
+        return list(self.iter_retention_time_means(
+            standard_run_ids=standard_run_ids,
+            compound_list_id=compound_list_id, aligned=aligned))
+
+    def iter_retention_time_means(self, standard_run_ids=None,
+                                  compound_list_id=None, yield_per=None,
+                                  aligned=False):
         '''
-        subq = (db.session.query(RetentionTime).join(StandardRun)
-                .filter(StandardRun.chromatography_method_id == self.id))
+        Generate RetentionTimeMean items for specified runs
+
+        With `yield_per`, rows are fetched in batches of that size from a
+        server side cursor (where the database supports one) so large
+        results can be streamed in constant memory.
+        '''
+        if aligned:
+            totals = self.aligned_retention_time_totals(standard_run_ids)
+            query = db.session.query(Compound)
+            if compound_list_id:
+                query = query.join(CompoundList, Compound.compound_lists)\
+                    .filter(CompoundList.id == compound_list_id)
+            if yield_per:
+                query = query.order_by(Compound.id).yield_per(yield_per)
+            for compound in query:
+                yield _retention_time_mean(
+                    compound, *totals.get(compound.id, (None,) * 4))
+            return
+        agg = RetentionTimeAggregate
+        subq = (db.session.query(
+            agg.compound_id,
+            label('rt_sum', func.sum(agg.rt_sum)),
+            label('rt_count', func.sum(agg.rt_count)),
+            label('rt_sum_squares', func.sum(agg.rt_sum_squares)),
+            label('n_runs', func.count(agg.standard_run_id)))
+            .filter(agg.chromatography_method_id == self.id))
         if standard_run_ids:
-            subq = subq.filter(StandardRun.id.in_(standard_run_ids))
-        subq = subq.subquery()
+            subq = subq.filter(agg.standard_run_id.in_(standard_run_ids))
+        subq = subq.group_by(agg.compound_id).subquery()
         query = (db.session.query(
-            Compound, label('mean_rt', func.avg(subq.c.retention_time)))
-            .outerjoin(subq)
-            .group_by(Compound.id))
+            Compound, subq.c.rt_sum, subq.c.rt_count, subq.c.rt_sum_squares,
+            subq.c.n_runs)
+            .outerjoin(subq, subq.c.compound_id == Compound.id))
         if compound_list_id:
             query = query.join(CompoundList, Compound.compound_lists)\
                 .filter(CompoundList.id == compound_list_id)
+        if yield_per:
+            query = query.order_by(Compound.id).yield_per(yield_per)
         current_app.logger.debug(query)
-        return query.all()
+        for row in query:
+            yield _retention_time_mean(*row)
+
+    def aligned_retention_time_totals(self, standard_run_ids=None):
+        '''
+        Return dict of compound id to aligned (rt_sum, rt_count,
+        rt_sum_squares, n_runs) for the specified runs
+
+        Corrections are applied to all aggregate rows of a run at once.
+        '''
+        agg = RetentionTimeAggregate
+        query = (db.session.query(agg.standard_run_id, agg.compound_id,
+                                  agg.rt_sum, agg.rt_count,
+                                  agg.rt_sum_squares)
+                 .filter(agg.chromatography_method_id == self.id))
+        if standard_run_ids:
+            query = query.filter(agg.standard_run_id.in_(standard_run_ids))
+        rows = query.all()
+        if not rows:
+            return {}
+        run_ids, compound_ids, rt_sum, rt_count, rt_sum_squares = (
+            np.array(column) for column in zip(*rows))
+        rt_sum = rt_sum.astype(float)
+        rt_sum_squares = rt_sum_squares.astype(float)
+        alignments = {a.standard_run_id: a for a in
+                      RetentionTimeAlignment.query.filter_by(
+                          chromatography_method_id=self.id)}
+        for run_id in np.unique(run_ids):
+            if run_id not in alignments:
+                continue
+            mask = run_ids == run_id
+            means = rt_sum[mask] / rt_count[mask]
+            shift = alignments[run_id].apply(means) - means
+            rt_sum_squares[mask] += (2 * shift * rt_sum[mask]
+                                     + shift * shift * rt_count[mask])
+            rt_sum[mask] += shift * rt_count[mask]
+        ids, index = np.unique(compound_ids, return_inverse=True)
+        totals = zip(np.bincount(index, weights=rt_sum),
+                     np.bincount(index, weights=rt_count),
+                     np.bincount(index, weights=rt_sum_squares),
+                     np.bincount(index))
+        return {int(id): (float(s), int(c), float(ss), int(n))
+                for id, (s, c, ss, n) in zip(ids, totals)}
+
+    def reference_standard_run_id(self):
+        '''Return id of the run other runs are aligned to, if any'''
+        alignment = RetentionTimeAlignment.query.filter(
+            RetentionTimeAlignment.chromatography_method_id == self.id,
+            RetentionTimeAlignment.standard_run_id
+            == RetentionTimeAlignment.reference_run_id).first()
+        return alignment.standard_run_id if alignment else None
+
+    def align_standard_run(self, standard_run_id, reference_run_id=None,
+                           session=None):
+        '''
+        Fit and store the retention time alignment of one run
+
+        The run is aligned to `reference_run_id` or to the method's current
+        reference run. If the method has no reference yet, the run becomes
+        the reference. Only this run's alignment is changed.
+        '''
+        session = session or db.session
+        if reference_run_id is None:
+            reference_run_id = (self.reference_standard_run_id()
+                                or standard_run_id)
+        knots_x, knots_y, shared = [], [], 0
+        if reference_run_id != standard_run_id:
+            run_rts = self._run_mean_retention_times(standard_run_id)
+            reference_rts = self._run_mean_retention_times(reference_run_id)
+            shared_ids = sorted(set(run_rts) & set(reference_rts))
+            shared = len(shared_ids)
+            knots_x, knots_y = fit_alignment(
+                [run_rts[id] for id in shared_ids],
+                [reference_rts[id] for id in shared_ids])
+        alignment = session.merge(RetentionTimeAlignment(
+            standard_run_id=standard_run_id,
+            chromatography_method_id=self.id,
+            reference_run_id=reference_run_id,
+            knots=json.dumps([knots_x, knots_y]),
+            num_shared_compounds=shared,
+            fitted=datetime.utcnow()))
+        return alignment
+
+    def align_standard_runs(self, reference_run_id=None, refit=False,
+                            session=None):
+        '''
+        Align runs of this method that have no alignment yet
+
+        With `refit`, or when a new `reference_run_id` is given, every run is
+        aligned again. Returns the list of alignments fitted.
+        '''
+        session = session or db.session
+        current_reference = self.reference_standard_run_id()
+        if reference_run_id is None:
+            reference_run_id = current_reference
+        elif reference_run_id != current_reference:
+            refit = True
+        aligned = set(id for id, in session.query(
+            RetentionTimeAlignment.standard_run_id).filter_by(
+                chromatography_method_id=self.id))
+        runs = (session.query(StandardRun.id)
+                .filter_by(chromatography_method_id=self.id)
+                .order_by(StandardRun.date))
+        run_ids = [id for id, in runs]
+        if reference_run_id is None and run_ids:
+            reference_run_id = run_ids[0]
+        if reference_run_id is not None:
+            run_ids.remove(reference_run_id)
+            run_ids.insert(0, reference_run_id)
+        return [self.align_standard_run(id, reference_run_id, session)
+                for id in run_ids if refit or id not in aligned]
+
+    def _run_mean_retention_times(self, standard_run_id):
+        agg = RetentionTimeAggregate
+        return {compound_id: rt_sum / rt_count
+                for compound_id, rt_sum, rt_count in db.session.query(
+                    agg.compound_id, agg.rt_sum, agg.rt_count).filter(
+                    agg.chromatography_method_id == self.id,
+                    agg.standard_run_id == standard_run_id)}
 
     def compounds_with_retention_times(self, standard_run_ids=None):
         query = db.session.query(Compound.id).\
@@ -178,10 +548,14 @@ class ChromatographyMethod(db.Model):
 
 
 class RetentionTime(db.Model):
+    # One retention time per compound and run; the unique index also serves
+    # lookups of a run's retention times
+    __table_args__ = (db.UniqueConstraint('standard_run_id', 'compound_id'),)
     id = db.Column(db.Integer, primary_key=True)
     compound_id = db.Column(
         db.Integer,
         db.ForeignKey('compound.id'),
+        index=True,
         nullable=False)
     standard_run_id = db.Column(db.Integer, db.ForeignKey('standard_run.id'))
     retention_time = db.Column(db.Float)
@@ -190,14 +564,186 @@ class RetentionTime(db.Model):
         return '<RetentionTime {}>'.format(self.retention_time)
 
 
+class RetentionTimeAggregate(db.Model):
+    '''
+    Retention time totals for each compound in each standard run
+
+    Rows are rebuilt with refresh_retention_time_aggregates whenever
+    retention times are recorded for a run.
+    '''
+    __tablename__ = 'retention_time_aggregate'
+    chromatography_method_id = db.Column(
+        db.Integer, db.ForeignKey('chromatography_method.id'),
+        primary_key=True)
+    standard_run_id = db.Column(db.Integer, db.ForeignKey('standard_run.id'),
+                                primary_key=True)
+    compound_id = db.Column(db.Integer, db.ForeignKey('compound.id'),
+                            primary_key=True)
+    rt_sum = db.Column(db.Float, nullable=False)
+    rt_count = db.Column(db.Integer, nullable=False)
+    rt_sum_squares = db.Column(db.Float, nullable=False)
+    rt_min = db.Column(db.Float)
+    rt_max = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<RetentionTimeAggregate {} {}>'.format(
+            self.standard_run_id, self.compound_id)
+
+
+class RetentionTimeAlignment(db.Model):
+    '''
+    Retention time correction of a standard run against a reference run
+
+    `knots` holds the JSON [x, y] knots of a monotone piecewise-linear
+    mapping from this run's retention times to the reference run's. The
+    reference run of a method has an identity alignment to itself.
+    '''
+    __tablename__ = 'retention_time_alignment'
+    standard_run_id = db.Column(db.Integer, db.ForeignKey('standard_run.id'),
+                                primary_key=True)
+    chromatography_method_id = db.Column(
+        db.Integer, db.ForeignKey('chromatography_method.id'),
+        index=True, nullable=False)
+    reference_run_id = db.Column(db.Integer,
+                                 db.ForeignKey('standard_run.id'),
+                                 nullable=False)
+    knots = db.Column(db.Text, nullable=False, default='[[], []]')
+    num_shared_compounds = db.Column(db.Integer, nullable=False, default=0)
+    fitted = db.Column(db.DateTime)
+
+    def apply(self, retention_times):
+        '''Return aligned retention times as an array'''
+        knots_x, knots_y = json.loads(self.knots)
+        return apply_alignment(knots_x, knots_y, retention_times)
+
+    def __repr__(self):
+        return '<RetentionTimeAlignment {} to {}>'.format(
+            self.standard_run_id, self.reference_run_id)
+
+
+def refresh_retention_time_aggregates(standard_run_ids, session=None):
+    '''Rebuild the retention time aggregates for the given standard runs'''
+    session = session or db.session
+    standard_run_ids = list(standard_run_ids)
+    if not standard_run_ids:
+        return
+    agg = RetentionTimeAggregate.__table__
+    session.execute(agg.delete().where(
+        agg.c.standard_run_id.in_(standard_run_ids)))
+    rt = RetentionTime.__table__
+    sr = StandardRun.__table__
+    totals = (db.select(
+        sr.c.chromatography_method_id, rt.c.standard_run_id,
+        rt.c.compound_id, func.sum(rt.c.retention_time),
+        func.count(rt.c.retention_time),
+        func.sum(rt.c.retention_time * rt.c.retention_time),
+        func.min(rt.c.retention_time), func.max(rt.c.retention_time))
+        .select_from(rt.join(sr, rt.c.standard_run_id == sr.c.id))
+        .where(rt.c.standard_run_id.in_(standard_run_ids))
+        .where(rt.c.retention_time.isnot(None))
+        .where(sr.c.chromatography_method_id.isnot(None))
+        .group_by(sr.c.chromatography_method_id, rt.c.standard_run_id,
+                  rt.c.compound_id))
+    session.execute(agg.insert().from_select(
+        ['chromatography_method_id', 'standard_run_id', 'compound_id',
+         'rt_sum', 'rt_count', 'rt_sum_squares', 'rt_min', 'rt_max'],
+        totals))
+
+
+class RetentionTimeSummary(db.Model):
+    '''
+    Retention time statistics of a compound across all runs of a method
+
+    Rows are rebuilt with refresh_retention_time_summaries for the
+    compounds whose retention times change, so the retention times of any
+    set of compounds on every method are read from this table alone.
+    '''
+    __tablename__ = 'retention_time_summary'
+    compound_id = db.Column(db.Integer, db.ForeignKey('compound.id'),
+                            primary_key=True)
+    chromatography_method_id = db.Column(
+        db.Integer, db.ForeignKey('chromatography_method.id'),
+        primary_key=True, index=True)
+    mean_rt = db.Column(db.Float, nullable=False)
+    median_rt = db.Column(db.Float, nullable=False)
+    sd_rt = db.Column(db.Float)
+    min_rt = db.Column(db.Float, nullable=False)
+    max_rt = db.Column(db.Float, nullable=False)
+    n_runs = db.Column(db.Integer, nullable=False)
+    last_run_date = db.Column(db.DateTime, nullable=False)
+    chromatography_method = db.relationship('ChromatographyMethod')
+
+    def to_dict(self):
+        return {'mean_rt': self.mean_rt,
+                'median_rt': self.median_rt,
+                'sd_rt': self.sd_rt,
+                'min_rt': self.min_rt,
+                'max_rt': self.max_rt,
+                'n_runs': self.n_runs,
+                'last_run_date': self.last_run_date.isoformat()}
+
+    def __repr__(self):
+        return '<RetentionTimeSummary {} {}>'.format(
+            self.compound_id, self.chromatography_method_id)
+
+
+def _retention_time_summary(method_id, compound_id, rows):
+    values = np.array([rt for _, rt, _ in rows], dtype=float)
+    return {'compound_id': compound_id,
+            'chromatography_method_id': method_id,
+            'mean_rt': float(values.mean()),
+            'median_rt': float(np.median(values)),
+            'sd_rt': float(values.std(ddof=1)) if len(values) > 1 else None,
+            'min_rt': float(values.min()),
+            'max_rt': float(values.max()),
+            'n_runs': len(values),
+            'last_run_date': max(date for _, _, date in rows)}
+
+
+def refresh_retention_time_summaries(method_id, compound_ids=None,
+                                     session=None):
+    '''
+    Rebuild the retention time summaries of a method
+
+    Only the summaries of `compound_ids` are rebuilt when given (callers
+    pass them in chunks small enough for an IN clause); otherwise every
+    compound of the method is.
+    '''
+    session = session or db.session
+    summary = RetentionTimeSummary.__table__
+    rt = RetentionTime.__table__
+    sr = StandardRun.__table__
+    delete = summary.delete().where(
+        summary.c.chromatography_method_id == method_id)
+    query = (db.select(rt.c.compound_id, rt.c.retention_time, sr.c.date)
+             .select_from(rt.join(sr, rt.c.standard_run_id == sr.c.id))
+             .where(sr.c.chromatography_method_id == method_id)
+             .where(rt.c.retention_time.isnot(None))
+             .order_by(rt.c.compound_id))
+    if compound_ids is not None:
+        compound_ids = list(compound_ids)
+        if not compound_ids:
+            return
+        delete = delete.where(summary.c.compound_id.in_(compound_ids))
+        query = query.where(rt.c.compound_id.in_(compound_ids))
+    session.execute(delete)
+    summaries = [
+        _retention_time_summary(method_id, compound_id, list(rows))
+        for compound_id, rows in groupby(session.execute(query),
+                                         key=itemgetter(0))]
+    if summaries:
+        session.execute(summary.insert(), summaries)
+
+
 class StandardRun(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     notes = db.Column(db.Text)
     date = db.Column(db.DateTime, index=True, nullable=False)
     operator = db.Column(db.String(256), index=True, nullable=False)
     mzxml_file = db.Column(db.String(256), index=True)
+    file_digest = db.Column(db.String(64))
     chromatography_method_id = db.Column(
-        db.Integer, db.ForeignKey('chromatography_method.id'))
+        db.Integer, db.ForeignKey('chromatography_method.id'), index=True)
     retention_times = db.relationship('RetentionTime',
                                       backref='standard_run')
 
@@ -206,6 +752,216 @@ class StandardRun(db.Model):
             self.chromatography_method, self.operator, self.date)
 
 
+class Job(db.Model):
+    '''
+    Background import queued from the web interface
+
+    `parameters` and `result` hold JSON. Jobs move from 'queued' to
+    'running' when a worker claims them and end 'done' or 'failed'. The
+    worker running a job updates `heartbeat` while it is alive.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), index=True, nullable=False,
+                       default='queued')
+    filename = db.Column(db.String(256))
+    path = db.Column(db.String(512))
+    parameters = db.Column(db.Text, nullable=False, default='{}')
+    progress = db.Column(db.String(256))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(64))
+    created = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    heartbeat = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    @property
+    def result_data(self):
+        return json.loads(self.result) if self.result else None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return ((self.finished or datetime.utcnow())
+                - self.started).total_seconds()
+
+    def to_dict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'filename': self.filename,
+                'parameters': json.loads(self.parameters),
+                'progress': self.progress,
+                'result': self.result_data,
+                'error': self.error,
+                'created': self.created.isoformat() if self.created
+                else None,
+                'started': self.started.isoformat() if self.started
+                else None,
+                'finished': self.finished.isoformat() if self.finished
+                else None,
+                'duration': self.duration}
+
+    def __repr__(self):
+        return '<Job {} {} {}>'.format(self.id, self.kind, self.status)
+
+
+class DataVersion(db.Model):
+    '''
+    Counter bumped whenever data is loaded
+
+    The 'global' key changes on every import; 'method:<id>' keys change
+    when retention times are added for that chromatography method. Cached
+    pages and query results are keyed on these versions.
+    '''
+    __tablename__ = 'data_version'
+    key = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DataVersion {} {}>'.format(self.key, self.version)
+
+
+def method_version_key(method_id):
+    return 'method:{}'.format(method_id)
+
+
+def data_versions(keys, session=None):
+    '''Return tuple of the current versions of the given keys'''
+    session = session or db.session
+    versions = dict(session.query(DataVersion.key, DataVersion.version)
+                    .filter(DataVersion.key.in_(keys)))
+    return tuple(versions.get(key, 0) for key in keys)
+
+
+def bump_data_version(method_ids=(), session=None):
+    '''Increment the global version and those of the given methods'''
+    session = session or db.session
+    table = DataVersion.__table__
+    for key in ['global'] + [method_version_key(id) for id in method_ids]:
+        updated = session.execute(
+            table.update().where(table.c.key == key)
+            .values(version=table.c.version + 1))
+        if not updated.rowcount:
+            session.execute(table.insert().values(key=key, version=1))
+
+
+# Counts used when listing objects. These are deferred so they are only
+# computed, as correlated subqueries in the same SELECT, when a query asks
+# for them with undefer().
+Compound.retention_time_count = db.column_property(
+    db.select(func.count(RetentionTime.id))
+    .where(RetentionTime.compound_id == Compound.id)
+    .correlate_except(RetentionTime).scalar_subquery(),
+    deferred=True)
+Compound.compound_list_count = db.column_property(
+    db.select(func.count(compoundlists.c.compound_list_id))
+    .where(compoundlists.c.compound_id == Compound.id)
+    .correlate_except(compoundlists).scalar_subquery(),
+    deferred=True)
+CompoundList.compound_count = db.column_property(
+    db.select(func.count(compoundlists.c.compound_id))
+    .where(compoundlists.c.compound_list_id == CompoundList.id)
+    .correlate_except(compoundlists).scalar_subquery(),
+    deferred=True)
+StandardRun.retention_time_count = db.column_property(
+    db.select(func.count(RetentionTime.id))
+    .where(RetentionTime.standard_run_id == StandardRun.id)
+    .correlate_except(RetentionTime).scalar_subquery(),
+    deferred=True)
+ChromatographyMethod.standard_run_count = db.column_property(
+    db.select(func.count(StandardRun.id))
+    .where(StandardRun.chromatography_method_id == ChromatographyMethod.id)
+    .correlate_except(StandardRun).scalar_subquery(),
+    deferred=True)
+ChromatographyMethod.compound_count = db.column_property(
+    db.select(func.count(RetentionTime.compound_id.distinct()))
+    .select_from(RetentionTime.__table__.join(StandardRun.__table__))
+    .where(StandardRun.chromatography_method_id == ChromatographyMethod.id)
+    .where(RetentionTime.retention_time.isnot(None))
+    .correlate_except(RetentionTime, StandardRun).scalar_subquery(),
+    deferred=True)
+
+
+# Name search indexes (see name_search). PostgreSQL gets trigram GIN indexes
+# on the search names. SQLite gets an FTS5 table with the trigram tokenizer
+# holding every compound name (rowid 2 * id) and synonym (rowid 2 * id + 1),
+# kept in sync by triggers.
+db.Index('ix_compound_search_name_trgm', Compound.search_name,
+         postgresql_using='gin',
+         postgresql_ops={'search_name': 'gin_trgm_ops'}).ddl_if(
+    dialect='postgresql')
+db.Index('ix_synonym_search_name_trgm', Synonym.search_name,
+         postgresql_using='gin',
+         postgresql_ops={'search_name': 'gin_trgm_ops'}).ddl_if(
+    dialect='postgresql')
+
+NAME_FTS_TABLE = 'compound_name_fts'
+NAME_FTS_VOCAB_TABLE = 'compound_name_fts_vocab'
+
+
+def name_fts_ddl():
+    '''Return the statements creating the SQLite name search table'''
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(search_name, "
+        "name UNINDEXED, compound_id UNINDEXED, tokenize='trigram')".format(
+            NAME_FTS_TABLE),
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5vocab({}, 'row')"
+        .format(NAME_FTS_VOCAB_TABLE, NAME_FTS_TABLE)]
+    for table, offset, compound_id in (('compound', 0, 'id'),
+                                       ('synonym', 1, 'compound_id')):
+        insert = ("INSERT INTO {fts} (rowid, search_name, name, compound_id) "
+                  "VALUES (new.id * 2 + {offset}, new.search_name, new.name, "
+                  "new.{compound_id});")
+        delete = "DELETE FROM {fts} WHERE rowid = old.id * 2 + {offset};"
+        triggers = [('insert', 'INSERT', insert),
+                    ('update', 'UPDATE OF name, search_name, ' + compound_id,
+                     delete + ' ' + insert),
+                    ('delete', 'DELETE', delete)]
+        for name, when, body in triggers:
+            statements.append(
+                ("CREATE TRIGGER IF NOT EXISTS {table}_name_fts_{name} "
+                 "AFTER {when} ON {table} BEGIN " + body + " END").format(
+                    fts=NAME_FTS_TABLE, table=table, name=name, when=when,
+                    offset=offset, compound_id=compound_id))
+    return statements
+
+
+def sqlite_has_trigram_fts(connection):
+    '''Return whether SQLite supports FTS5 with the trigram tokenizer'''
+    import sqlite3
+    return sqlite3.sqlite_version_info >= (3, 34) and bool(
+        connection.exec_driver_sql(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+@event.listens_for(Synonym.__table__, 'after_create')
+def create_name_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite' and \
+            sqlite_has_trigram_fts(connection):
+        for statement in name_fts_ddl():
+            connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Compound.__table__, 'after_drop')
+def drop_name_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for table in (NAME_FTS_VOCAB_TABLE, NAME_FTS_TABLE):
+            connection.exec_driver_sql(
+                'DROP TABLE IF EXISTS {}'.format(table))
+
+
+event.listen(db.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+    dialect='postgresql'))
+
+
 def get_one_or_create(session,
                       model,
                       create_method='',
@@ -0,0 +1,264 @@
+'''
+Type-ahead search of compound names and synonyms
+
+Names and synonyms are stored with a normalized search name (see
+normalize_compound_name) and looked up by the normalized query. Candidates
+come from an n-gram index: an FTS5 table with the trigram tokenizer on
+SQLite or pg_trgm GIN indexes on PostgreSQL. When the database has neither,
+an in-memory trigram index is built for the current data version, as for
+the mass index.
+
+Matches are ranked exact, prefix, word prefix and substring matches first,
+then names within a trigram similarity of the query (for misspellings), and
+each compound is returned once.
+'''
+from bisect import bisect_left
+from collections import namedtuple
+from operator import itemgetter
+from metabolite_database import cache, db
+from metabolite_database.matching import TrigramIndex, trigrams
+from metabolite_database.models import (NAME_FTS_TABLE, NAME_FTS_VOCAB_TABLE,
+                                        Compound, Synonym, data_versions,
+                                        normalize_compound_name)
+
+Candidate = namedtuple('Candidate',
+                       ['compound_id', 'name', 'search_name', 'synonym'])
+
+name_search_backends = ('fts5', 'pg_trgm', 'python')
+
+match_types = ('exact', 'prefix', 'word', 'substring', 'fuzzy')
+
+# Candidates read from the index for each kind of match
+MAX_CANDIDATES = 200
+
+# Lowest trigram similarity of a fuzzy match (the pg_trgm default)
+FUZZY_SIMILARITY = 0.3
+
+# Most names containing the trigrams used for a fuzzy FTS5 search
+FUZZY_ROWS = 5000
+
+MAX_LIMIT = 100
+
+
+def name_search_backend(session=None):
+    '''Return the name index available in the database'''
+    session = session or db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        query = "SELECT 1 FROM sqlite_master WHERE name = '{}'".format(
+            NAME_FTS_TABLE)
+    elif dialect == 'postgresql':
+        query = "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+    else:
+        return 'python'
+    if session.execute(db.text(query)).first() is None:
+        return 'python'
+    return 'fts5' if dialect == 'sqlite' else 'pg_trgm'
+
+
+def _select_candidates(session, where, order_by=None):
+    '''Return candidates from compound names and synonyms'''
+    compound = Compound.__table__
+    synonym = Synonym.__table__
+    candidates = []
+    for query, column in (
+            (db.select(compound.c.id, compound.c.name,
+                       compound.c.search_name, db.literal(False)),
+             compound.c.search_name),
+            (db.select(synonym.c.compound_id, synonym.c.name,
+                       synonym.c.search_name, db.literal(True)),
+             synonym.c.search_name)):
+        query = query.where(where(column))
+        if order_by is not None:
+            query = query.order_by(order_by(column))
+        candidates.extend(Candidate(*row) for row in session.execute(
+            query.limit(MAX_CANDIDATES)))
+    return candidates
+
+
+def _compound_count(candidates):
+    return len(set(c.compound_id for c in candidates))
+
+
+def _fts_phrase(text):
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+def _fts_candidates(session, match, ranked=False):
+    query = ("SELECT compound_id, name, search_name, rowid % 2 FROM {0} "
+             "WHERE {0} MATCH :match".format(NAME_FTS_TABLE))
+    if ranked:
+        query += " ORDER BY rank"
+    return [Candidate(*row) for row in session.execute(
+        db.text(query + " LIMIT :limit"),
+        {'match': match, 'limit': MAX_CANDIDATES})]
+
+
+def _fts5_candidates(session, text, limit):
+    # Prefixes are read in order from the search_name indexes; the trigram
+    # tokenizer matches a quoted phrase anywhere in a name
+    end = text[:-1] + chr(ord(text[-1]) + 1)
+    candidates = _select_candidates(
+        session, lambda column: db.and_(column >= text, column < end),
+        lambda column: column)
+    if len(text) < 3:
+        return candidates
+    candidates.extend(_fts_candidates(session, _fts_phrase(text)))
+    if _compound_count(candidates) < limit:
+        # Ranking every name sharing any trigram is slow for common
+        # trigrams, so similar names are looked for by the rarest ones
+        grams = sorted(set(text[i:i + 3] for i in range(len(text) - 2)))
+        counts = session.execute(
+            db.text("SELECT term, doc FROM {} WHERE term IN :grams".format(
+                NAME_FTS_VOCAB_TABLE)).bindparams(
+                db.bindparam('grams', expanding=True)),
+            {'grams': grams}).fetchall()
+        rare = []
+        rows = 0
+        for gram, count in sorted(counts, key=itemgetter(1)):
+            if rare and rows + count > FUZZY_ROWS:
+                break
+            rare.append(gram)
+            rows += count
+        if rare:
+            candidates.extend(_fts_candidates(
+                session, ' OR '.join(_fts_phrase(gram) for gram in rare),
+                ranked=True))
+    return candidates
+
+
+def _pg_trgm_candidates(session, text, limit):
+    candidates = _select_candidates(
+        session, lambda column: column.startswith(text, autoescape=True),
+        lambda column: column)
+    if len(text) < 3:
+        return candidates
+    candidates.extend(_select_candidates(
+        session, lambda column: column.contains(text, autoescape=True)))
+    if _compound_count(candidates) < limit:
+        candidates.extend(_select_candidates(
+            session, lambda column: column.op('%')(text),
+            lambda column: db.func.similarity(column, text).desc()))
+    return candidates
+
+
+class NameIndex(object):
+    '''Compound names and synonyms in memory, sorted by search name'''
+    def __init__(self, candidates):
+        self.candidates = sorted(candidates, key=lambda c: c.search_name)
+        self.search_names = [c.search_name for c in self.candidates]
+        self.trigrams = TrigramIndex(self.search_names)
+
+    @classmethod
+    def from_database(cls, session=None):
+        session = session or db.session
+        rows = session.execute(db.union_all(
+            db.select(Compound.id, Compound.name, Compound.search_name,
+                      db.literal(False)),
+            db.select(Synonym.compound_id, Synonym.name, Synonym.search_name,
+                      db.literal(True))))
+        return cls([Candidate(*row) for row in rows
+                    if row.search_name is not None])
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def search(self, text, limit):
+        '''Return candidates for normalized text'''
+        start = bisect_left(self.search_names, text)
+        candidates = []
+        for candidate in self.candidates[start:start + MAX_CANDIDATES]:
+            if not candidate.search_name.startswith(text):
+                break
+            candidates.append(candidate)
+        candidates.extend(self.candidates[i] for i in
+                          self.trigrams.containing(text)[:MAX_CANDIDATES])
+        if len(text) >= 3 and _compound_count(candidates) < limit:
+            similar = sorted(self.trigrams.similar(text, FUZZY_SIMILARITY),
+                             key=lambda r: -r[1])
+            candidates.extend(self.candidates[i] for i, similarity
+                              in similar[:MAX_CANDIDATES])
+        return candidates
+
+
+def current_name_index():
+    '''Return the in-memory NameIndex for the current data version'''
+    version = data_versions(['global'])[0]
+    return cache.memoize('name_index', (version,), NameIndex.from_database)
+
+
+def _python_candidates(session, text, limit):
+    return current_name_index().search(text, limit)
+
+
+_backend_candidates = {'fts5': _fts5_candidates,
+                       'pg_trgm': _pg_trgm_candidates,
+                       'python': _python_candidates}
+
+
+def _rank(candidate, text, grams):
+    '''Return (match type index, similarity) of a candidate'''
+    search_name = candidate.search_name
+    other = trigrams(search_name)
+    shared = len(grams & other)
+    similarity = shared / (len(grams | other) or 1)
+    if search_name == text:
+        return 0, similarity
+    if search_name.startswith(text):
+        return 1, similarity
+    if ' ' + text in ' ' + search_name:
+        return 2, similarity
+    if text in search_name:
+        return 3, similarity
+    return 4, similarity
+
+
+def search_compound_names(query, limit=10, backend=None, session=None):
+    '''
+    Return the compounds best matching a name, best first
+
+    Each result gives the compound's id, name and formula, the name or
+    synonym that matched, the kind of match and the trigram similarity of
+    the matched name to the query. Raises ValueError for an invalid limit
+    or backend.
+    '''
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError("Invalid limit {}: use 1 to {}".format(
+            limit, MAX_LIMIT))
+    session = session or db.session
+    backend = backend or name_search_backend(session)
+    if backend not in name_search_backends:
+        raise ValueError("Invalid name search backend '{}': use one of "
+                         "{}".format(backend, ', '.join(name_search_backends)))
+    text = normalize_compound_name(query)
+    if not text:
+        return []
+    grams = trigrams(text)
+    best = {}
+    for candidate in _backend_candidates[backend](session, text, limit):
+        rank, similarity = _rank(candidate, text, grams)
+        if rank == 4 and similarity < FUZZY_SIMILARITY:
+            continue
+        key = (rank, -similarity, len(candidate.search_name), candidate.name)
+        previous = best.get(candidate.compound_id)
+        if previous is None or key < previous[0]:
+            best[candidate.compound_id] = (key, similarity, candidate)
+    ranked = sorted(best.values(), key=lambda r: r[0])[:limit]
+    compounds = {}
+    if ranked:
+        compounds = {row.id: row for row in session.query(
+            Compound.id, Compound.name, Compound.molecular_formula).filter(
+            Compound.id.in_([c.compound_id for _, _, c in ranked]))}
+    results = []
+    for (rank, _, _, _), similarity, candidate in ranked:
+        compound = compounds.get(candidate.compound_id)
+        if compound is None:
+            continue
+        results.append({'id': compound.id,
+                        'name': compound.name,
+                        'molecular_formula': compound.molecular_formula,
+                        'matched_name': candidate.name,
+                        'synonym': bool(candidate.synonym),
+                        'match': match_types[rank],
+                        'similarity': similarity})
+    return results
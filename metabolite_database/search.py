@@ -0,0 +1,119 @@
+import numpy as np
+from metabolite_database import db
+from metabolite_database.ions import compound_ion_table
+from metabolite_database.mass_index import current_mass_index
+from metabolite_database.models import Compound
+from metabolite_database.models import valid_atoms
+
+PROTON_MASS = valid_atoms['H'] - valid_atoms['e']
+
+ionization_modes = {
+    '1': 1, '+': 1, '+1': 1, 'pos': 1, 'positive': 1,
+    '-1': -1, '-': -1, 'neg': -1, 'negative': -1}
+
+tolerance_units = ('ppm', 'Da')
+
+
+def parse_mode(mode):
+    '''Return ionization mode (1 or -1) from an integer or string'''
+    try:
+        return ionization_modes[str(mode).strip().lower()]
+    except KeyError:
+        raise ValueError("Invalid ionization mode '{}': use 1/pos or "
+                         "-1/neg".format(mode))
+
+
+def neutral_mass(mz, mode):
+    '''Return neutral monoisotopic mass for a singly charged [M+H]+/[M-H]-
+    ion observed at the given m/z'''
+    return mz - PROTON_MASS * mode
+
+
+def mass_tolerance(mass, tolerance, unit='ppm'):
+    '''Return the absolute tolerance (Da) around a mass'''
+    if unit == 'ppm':
+        return abs(mass) * tolerance * 1e-6
+    if unit == 'Da':
+        return tolerance
+    raise ValueError("Invalid tolerance unit '{}': use one of {}".format(
+        unit, ', '.join(tolerance_units)))
+
+
+def search_mz(mz_values, tolerance=5.0, unit='ppm', mode=1):
+    '''
+    Return matching compounds for each of the given m/z values
+
+    All m/z windows are located with one vectorized binary search of the
+    compound mass index, so no compounds are loaded from the database.
+    Results are returned in the order of `mz_values`.
+    '''
+    mode = parse_mode(mode)
+    mz = np.asarray([float(v) for v in mz_values], dtype=float)
+    masses = neutral_mass(mz, mode)
+    delta = mass_tolerance(masses, tolerance, unit)
+    if not len(mz):
+        return []
+    index = current_mass_index()
+    starts, ends = index.ranges(masses - delta, masses + delta)
+    results = []
+    for query_mz, start, end in zip(mz.tolist(), starts, ends):
+        matches = []
+        for i in range(start, end):
+            mass = float(index.masses[i])
+            theoretical_mz = mass + PROTON_MASS * mode
+            matches.append({
+                'id': int(index.ids[i]),
+                'name': index.name(i),
+                'molecular_formula': index.formula(i),
+                'monoisotopic_mass': mass,
+                'm_z': theoretical_mz,
+                'error_ppm': (query_mz - theoretical_mz)
+                / theoretical_mz * 1e6})
+        matches.sort(key=lambda m: abs(m['error_ppm']))
+        results.append({'mz': query_mz, 'matches': matches})
+    return results
+
+
+def search_ions(mz_values, tolerance=5.0, unit='ppm', mode=None):
+    '''
+    Return matching compound ions for each of the given m/z values
+
+    Searches every isotopologue and adduct in the compound ion table, for
+    ions of the polarity of `mode` if it is given. Windows for all m/z
+    values are located with one vectorized binary search.
+    '''
+    if mode is not None:
+        mode = parse_mode(mode)
+    mz = np.asarray([float(v) for v in mz_values], dtype=float)
+    delta = mass_tolerance(mz, tolerance, unit)
+    if not len(mz):
+        return []
+    table = compound_ion_table()
+    starts, ends = table.ranges(mz - delta, mz + delta)
+    matched = set()
+    for start, end in zip(starts, ends):
+        matched.update(table.compound_ids[start:end].tolist())
+    compounds = {}
+    for chunk in [list(matched)[i:i + 500]
+                  for i in range(0, len(matched), 500)]:
+        for row in (db.session.query(Compound.id, Compound.name,
+                                     Compound.molecular_formula)
+                    .filter(Compound.id.in_(chunk))):
+            compounds[row.id] = row
+    results = []
+    for query_mz, start, end in zip(mz.tolist(), starts, ends):
+        matches = []
+        for ion in table.rows(range(start, end)):
+            if mode is not None and ion['charge'] * mode < 0:
+                continue
+            compound = compounds[ion['compound_id']]
+            ion.update({
+                'id': compound.id,
+                'name': compound.name,
+                'molecular_formula': compound.molecular_formula,
+                'error_ppm': (query_mz - ion['m_z']) / ion['m_z'] * 1e6})
+            del ion['compound_id']
+            matches.append(ion)
+        matches.sort(key=lambda m: abs(m['error_ppm']))
+        results.append({'mz': query_mz, 'matches': matches})
+    return results
@@ -0,0 +1,254 @@
+'''
+Columnar snapshots of the database in Arrow or Parquet files
+
+A snapshot is a directory with one file per table and a manifest.json
+listing the tables, their row counts and the file format. Rows are read
+with a streaming query and written in record batches; string columns are
+dictionary encoded. Arrow files use the IPC file format without
+compression, so they can be memory-mapped directly, for example with
+`pyarrow.ipc.open_file(pyarrow.memory_map(path))`,
+`polars.read_ipc(path, memory_map=True)` or
+`pandas.read_feather(path)`.
+
+Retention time aggregates, summaries and data versions are not written;
+they are rebuilt when a snapshot is loaded. pyarrow is an optional
+dependency that is only needed for snapshots.
+'''
+import json
+import os
+from datetime import datetime
+from metabolite_database import db
+from metabolite_database.models import (ChromatographyMethod, CompoundList,
+                                        Compound, DbXref, ExternalDatabase,
+                                        RetentionTime, RetentionTimeAlignment,
+                                        StandardRun, Synonym,
+                                        bump_data_version, compoundlists,
+                                        refresh_retention_time_aggregates,
+                                        refresh_retention_time_summaries)
+
+SNAPSHOT_VERSION = 1
+
+# Tables in the order they are loaded, so foreign keys are always satisfied
+snapshot_tables = [ChromatographyMethod.__table__,
+                   ExternalDatabase.__table__,
+                   Compound.__table__,
+                   Synonym.__table__,
+                   DbXref.__table__,
+                   CompoundList.__table__,
+                   compoundlists,
+                   StandardRun.__table__,
+                   RetentionTime.__table__,
+                   RetentionTimeAlignment.__table__]
+
+snapshot_formats = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+# Rows per record batch
+BATCH_SIZE = 50000
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError("pyarrow is required for snapshots")
+    return pyarrow
+
+
+def _arrow_type(pa, column):
+    python_type = column.type.python_type
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is bool:
+        return pa.bool_()
+    if python_type is datetime:
+        return pa.timestamp('us')
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def table_schema(pa, table):
+    '''Return the Arrow schema of a table'''
+    return pa.schema([pa.field(column.name, _arrow_type(pa, column),
+                               nullable=column.nullable)
+                      for column in table.columns])
+
+
+class _DictionaryEncoder(object):
+    '''
+    Dictionary encode a string column across record batches
+
+    Values are only ever appended to the dictionary, so each batch's
+    dictionary extends the previous one and the Arrow file writer can emit
+    it as a delta.
+    '''
+    def __init__(self, pa):
+        self.pa = pa
+        self.indexes = {}
+        self.values = []
+
+    def encode(self, values):
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            index = self.indexes.get(value)
+            if index is None:
+                index = self.indexes[value] = len(self.values)
+                self.values.append(value)
+            indices.append(index)
+        return self.pa.DictionaryArray.from_arrays(
+            self.pa.array(indices, type=self.pa.int32()),
+            self.pa.array(self.values, type=self.pa.string()))
+
+
+def _iter_batches(pa, table, schema, session, batch_size):
+    encoders = {field.name: _DictionaryEncoder(pa) for field in schema
+                if pa.types.is_dictionary(field.type)}
+    result = session.execute(
+        db.select(table).order_by(*table.primary_key.columns)
+        .execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        arrays = []
+        for field, values in zip(schema, columns):
+            if field.name in encoders:
+                arrays.append(encoders[field.name].encode(values))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        yield pa.record_batch(arrays, schema=schema)
+
+
+def _write_table(pa, table, path, output_format, session, batch_size):
+    schema = table_schema(pa, table)
+    rows = 0
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        import pyarrow.ipc as ipc
+        sink = pa.OSFile(path, 'wb')
+        writer = ipc.new_file(sink, schema, options=ipc.IpcWriteOptions(
+            emit_dictionary_deltas=True))
+    try:
+        for batch in _iter_batches(pa, table, schema, session, batch_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+        if output_format != 'parquet':
+            sink.close()
+    return rows
+
+
+def export_snapshot(directory, output_format='arrow', batch_size=BATCH_SIZE,
+                    session=None):
+    '''
+    Write a snapshot of the database to `directory`
+
+    Returns a dict of the number of rows written for each table. Raises
+    ValueError for an unknown format or if pyarrow is not installed.
+    '''
+    if output_format not in snapshot_formats:
+        raise ValueError("Invalid snapshot format '{}': use one of {}".format(
+            output_format, ', '.join(sorted(snapshot_formats))))
+    pa = _pyarrow()
+    session = session or db.session
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table in snapshot_tables:
+        path = os.path.join(directory,
+                            table.name + snapshot_formats[output_format])
+        counts[table.name] = _write_table(pa, table, path, output_format,
+                                          session, batch_size)
+    manifest = {'version': SNAPSHOT_VERSION,
+                'format': output_format,
+                'created': datetime.utcnow().isoformat(),
+                'tables': counts}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    return counts
+
+
+def read_manifest(directory):
+    '''Return the manifest of a snapshot directory'''
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError) as e:
+        raise ValueError("Not a snapshot directory '{}': {}".format(
+            directory, e))
+    if manifest.get('version') != SNAPSHOT_VERSION or \
+            manifest.get('format') not in snapshot_formats:
+        raise ValueError("Unsupported snapshot version or format in "
+                         "'{}'".format(directory))
+    return manifest
+
+
+def _read_batches(pa, path, input_format, batch_size):
+    if input_format == 'parquet':
+        import pyarrow.parquet as pq
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+        return
+    import pyarrow.ipc as ipc
+    with pa.memory_map(path) as source:
+        reader = ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _reset_sequences(session):
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    for table in snapshot_tables:
+        if 'id' in table.c and table.c.id.primary_key:
+            session.execute(db.text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "COALESCE(MAX(id), 0) + 1, false) FROM {}".format(
+                    table.name)), {'table': table.name})
+
+
+def import_snapshot(directory, batch_size=BATCH_SIZE, session=None):
+    '''
+    Load a snapshot into an empty database
+
+    Rows are bulk inserted with their original ids. Afterwards retention
+    time aggregates and summaries are rebuilt, runs without an alignment
+    are aligned and data versions are bumped. Returns a dict of the number
+    of rows loaded for each table. Raises ValueError if the database
+    already has data, the snapshot is invalid or pyarrow is not installed.
+    '''
+    manifest = read_manifest(directory)
+    pa = _pyarrow()
+    session = session or db.session
+    for table in snapshot_tables:
+        if session.execute(db.select(table).limit(1)).first() is not None:
+            raise ValueError("Snapshots can only be loaded into an empty "
+                             "database ('{}' has rows)".format(table.name))
+    counts = {}
+    extension = snapshot_formats[manifest['format']]
+    for table in snapshot_tables:
+        path = os.path.join(directory, table.name + extension)
+        counts[table.name] = 0
+        if not os.path.exists(path):
+            continue
+        for batch in _read_batches(pa, path, manifest['format'], batch_size):
+            unknown = set(batch.schema.names) - set(table.c.keys())
+            if unknown:
+                raise ValueError("Unknown columns in {}: {}".format(
+                    path, ', '.join(sorted(unknown))))
+            rows = batch.to_pylist()
+            if rows:
+                session.execute(table.insert(), rows)
+            counts[table.name] += len(rows)
+    _reset_sequences(session)
+    refresh_retention_time_aggregates(
+        [id for id, in session.query(StandardRun.id)], session=session)
+    methods = session.query(ChromatographyMethod).all()
+    for method in methods:
+        refresh_retention_time_summaries(method.id, session=session)
+        method.align_standard_runs(session=session)
+    bump_data_version([m.id for m in methods], session=session)
+    session.commit()
+    return counts
@@ -0,0 +1,150 @@
+"""Add compound search name
+
+Revision ID: 2c8d5f7a9b14
+Revises: 7a2f4c9d1e36
+Create Date: 2026-10-18 18:22:47.306115
+
+"""
+import re
+import sqlite3
+import unicodedata
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8d5f7a9b14'
+down_revision = '7a2f4c9d1e36'
+branch_labels = None
+depends_on = None
+
+
+compound = sa.table('compound',
+                    sa.column('id', sa.Integer),
+                    sa.column('name', sa.String),
+                    sa.column('search_name', sa.String))
+synonym = sa.table('synonym',
+                   sa.column('id', sa.Integer),
+                   sa.column('name', sa.String),
+                   sa.column('search_name', sa.String))
+
+# Name normalization and search table as of this revision, so the backfill
+# and schema do not change when the application's versions do
+greek_letters = {
+    'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta', 'ε': 'epsilon',
+    'ζ': 'zeta', 'η': 'eta', 'θ': 'theta', 'ι': 'iota', 'κ': 'kappa',
+    'λ': 'lambda', 'μ': 'mu', 'ν': 'nu', 'ξ': 'xi', 'ο': 'omicron',
+    'π': 'pi', 'ρ': 'rho', 'σ': 'sigma', 'ς': 'sigma', 'τ': 'tau',
+    'υ': 'upsilon', 'φ': 'phi', 'χ': 'chi', 'ψ': 'psi', 'ω': 'omega'}
+stereo_prefix_pattern = re.compile(
+    r'(?<!\w)(?:(?:d|l|dl|rac)-|\((?:\+|-|\+/-|±|r|s|rs)\)-?)')
+hydrate_suffix_pattern = re.compile(
+    r'[\s,;.·*]+(?:(?:mono|di|tri|tetra|penta|hexa|hepta|octa|hemi|sesqui)?'
+    r'hydrate|(?:[xn]\s*)?(?:\d+(?:\.\d+)?)?\s*h2o)$')
+separator_pattern = re.compile(r'[\W_]+')
+
+NAME_FTS_TABLE = 'compound_name_fts'
+NAME_FTS_VOCAB_TABLE = 'compound_name_fts_vocab'
+
+
+def normalize_compound_name(name):
+    name = unicodedata.normalize('NFKC', name).lower()
+    name = ''.join(greek_letters.get(c, c) for c in name)
+    name = hydrate_suffix_pattern.sub('', name.strip())
+    name = stereo_prefix_pattern.sub('', name)
+    return separator_pattern.sub(' ', name).strip()
+
+
+def name_fts_ddl():
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(search_name, "
+        "name UNINDEXED, compound_id UNINDEXED, tokenize='trigram')".format(
+            NAME_FTS_TABLE),
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5vocab({}, 'row')"
+        .format(NAME_FTS_VOCAB_TABLE, NAME_FTS_TABLE)]
+    for table, offset, compound_id in (('compound', 0, 'id'),
+                                       ('synonym', 1, 'compound_id')):
+        insert = ("INSERT INTO {fts} (rowid, search_name, name, compound_id) "
+                  "VALUES (new.id * 2 + {offset}, new.search_name, new.name, "
+                  "new.{compound_id});")
+        delete = "DELETE FROM {fts} WHERE rowid = old.id * 2 + {offset};"
+        triggers = [('insert', 'INSERT', insert),
+                    ('update', 'UPDATE OF name, search_name, ' + compound_id,
+                     delete + ' ' + insert),
+                    ('delete', 'DELETE', delete)]
+        for name, when, body in triggers:
+            statements.append(
+                ("CREATE TRIGGER IF NOT EXISTS {table}_name_fts_{name} "
+                 "AFTER {when} ON {table} BEGIN " + body + " END").format(
+                    fts=NAME_FTS_TABLE, table=table, name=name, when=when,
+                    offset=offset, compound_id=compound_id))
+    return statements
+
+
+def sqlite_has_trigram_fts(connection):
+    return sqlite3.sqlite_version_info >= (3, 34) and bool(
+        connection.exec_driver_sql(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+def upgrade():
+    with op.batch_alter_table('compound', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_name', sa.String(length=256), nullable=True))
+        batch_op.create_index(batch_op.f('ix_compound_search_name'), ['search_name'], unique=False)
+
+    with op.batch_alter_table('synonym', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_name', sa.String(length=256), nullable=True))
+        batch_op.create_index(batch_op.f('ix_synonym_search_name'), ['search_name'], unique=False)
+
+    # Backfill search names of existing compounds and synonyms
+    conn = op.get_bind()
+    for table in (compound, synonym):
+        rows = conn.execute(sa.select(table.c.id, table.c.name)).fetchall()
+        names = [{'b_id': id, 'b_search_name': normalize_compound_name(name)}
+                 for id, name in rows]
+        if names:
+            conn.execute(
+                table.update()
+                .where(table.c.id == sa.bindparam('b_id'))
+                .values(search_name=sa.bindparam('b_search_name')),
+                names)
+
+    # Trigram indexes for name search (without them searches use an
+    # in-memory index)
+    if conn.dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in ('compound', 'synonym'):
+            op.create_index('ix_{}_search_name_trgm'.format(table), table,
+                            ['search_name'], postgresql_using='gin',
+                            postgresql_ops={'search_name': 'gin_trgm_ops'})
+    elif conn.dialect.name == 'sqlite' and sqlite_has_trigram_fts(conn):
+        for statement in name_fts_ddl():
+            op.execute(statement)
+        op.execute(
+            "INSERT INTO {} (rowid, search_name, name, compound_id) "
+            "SELECT id * 2, search_name, name, id FROM compound UNION ALL "
+            "SELECT id * 2 + 1, search_name, name, compound_id "
+            "FROM synonym".format(NAME_FTS_TABLE))
+
+
+def downgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'postgresql':
+        for table in ('compound', 'synonym'):
+            op.drop_index('ix_{}_search_name_trgm'.format(table),
+                          table_name=table)
+    elif conn.dialect.name == 'sqlite':
+        for table in ('compound', 'synonym'):
+            for event in ('insert', 'update', 'delete'):
+                op.execute('DROP TRIGGER IF EXISTS {}_name_fts_{}'.format(
+                    table, event))
+        op.execute('DROP TABLE IF EXISTS {}'.format(NAME_FTS_VOCAB_TABLE))
+        op.execute('DROP TABLE IF EXISTS {}'.format(NAME_FTS_TABLE))
+
+    with op.batch_alter_table('synonym', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_synonym_search_name'))
+        batch_op.drop_column('search_name')
+
+    with op.batch_alter_table('compound', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_compound_search_name'))
+        batch_op.drop_column('search_name')
@@ -0,0 +1,56 @@
+"""Add retention time aggregate
+
+Revision ID: 4d8e2a71f0c5
+Revises: c1f4a9e2b7d3
+Create Date: 2026-10-18 10:03:17.264011
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8e2a71f0c5'
+down_revision = 'c1f4a9e2b7d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('retention_time_aggregate',
+    sa.Column('chromatography_method_id', sa.Integer(), nullable=False),
+    sa.Column('standard_run_id', sa.Integer(), nullable=False),
+    sa.Column('compound_id', sa.Integer(), nullable=False),
+    sa.Column('rt_sum', sa.Float(), nullable=False),
+    sa.Column('rt_count', sa.Integer(), nullable=False),
+    sa.Column('rt_sum_squares', sa.Float(), nullable=False),
+    sa.Column('rt_min', sa.Float(), nullable=True),
+    sa.Column('rt_max', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['chromatography_method_id'], ['chromatography_method.id'], name=op.f('fk_retention_time_aggregate_chromatography_method_id_chromatography_method')),
+    sa.ForeignKeyConstraint(['compound_id'], ['compound.id'], name=op.f('fk_retention_time_aggregate_compound_id_compound')),
+    sa.ForeignKeyConstraint(['standard_run_id'], ['standard_run.id'], name=op.f('fk_retention_time_aggregate_standard_run_id_standard_run')),
+    sa.PrimaryKeyConstraint('chromatography_method_id', 'standard_run_id', 'compound_id', name=op.f('pk_retention_time_aggregate'))
+    )
+
+    # Backfill aggregates for existing retention times
+    op.execute(
+        "INSERT INTO retention_time_aggregate "
+        "(chromatography_method_id, standard_run_id, compound_id, rt_sum, "
+        "rt_count, rt_sum_squares, rt_min, rt_max) "
+        "SELECT standard_run.chromatography_method_id, "
+        "retention_time.standard_run_id, retention_time.compound_id, "
+        "SUM(retention_time.retention_time), "
+        "COUNT(retention_time.retention_time), "
+        "SUM(retention_time.retention_time * retention_time.retention_time), "
+        "MIN(retention_time.retention_time), "
+        "MAX(retention_time.retention_time) "
+        "FROM retention_time JOIN standard_run "
+        "ON retention_time.standard_run_id = standard_run.id "
+        "WHERE retention_time.retention_time IS NOT NULL "
+        "AND standard_run.chromatography_method_id IS NOT NULL "
+        "GROUP BY standard_run.chromatography_method_id, "
+        "retention_time.standard_run_id, retention_time.compound_id")
+
+
+def downgrade():
+    op.drop_table('retention_time_aggregate')
@@ -0,0 +1,93 @@
+"""Add compound monoisotopic mass
+
+Revision ID: c1f4a9e2b7d3
+Revises: 893db350df3d
+Create Date: 2026-10-18 09:12:41.518204
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1f4a9e2b7d3'
+down_revision = '893db350df3d'
+branch_labels = None
+depends_on = None
+
+
+compound = sa.table('compound',
+                    sa.column('id', sa.Integer),
+                    sa.column('molecular_formula', sa.String),
+                    sa.column('monoisotopic_mass', sa.Float))
+
+# A copy of the atom masses and formula parsing of a later revision, which
+# added Br, Cl, F, K, Na, Si and isotope labels to the atoms of this one.
+# It is frozen here so the backfill does not change when the application's
+# parser does.
+atom_masses = {
+    'e': 0.00054857990943,
+    'Br': 78.9183371,
+    'C': 12.00000000,
+    'Cl': 34.96885268,
+    'F': 18.99840322,
+    'H': 1.00782503224,
+    'I': 126.904457,
+    'K': 38.96370649,
+    'N': 14.0030740052,
+    'Na': 22.98976928,
+    'O': 15.9949146221,
+    'P': 30.97376151,
+    'S': 31.972072,
+    'Si': 27.9769265325,
+    '[2H]': 2.0141017778,
+    '[13C]': 13.0033548378,
+    '[15N]': 15.0001088984,
+    '[18O]': 17.9991596129,
+    '[34S]': 33.96786690}
+
+formula_token = re.compile(r'(\[\d+[A-Z][a-z]?\]|[A-Z][a-z]?|e)(\d*)')
+
+
+def formula_monoisotopic_mass(formula):
+    '''Return the monoisotopic mass of a formula, or None if it is invalid'''
+    if not formula:
+        return None
+    mass = 0.0
+    pos = 0
+    while pos < len(formula):
+        m = formula_token.match(formula, pos)
+        if not m or m.group(1) not in atom_masses:
+            return None
+        atom, num_atom = m.groups()
+        mass += atom_masses[atom] * (int(num_atom) if num_atom else 1)
+        pos = m.end()
+    return mass
+
+
+def upgrade():
+    with op.batch_alter_table('compound', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('monoisotopic_mass', sa.Float(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_compound_monoisotopic_mass'), ['monoisotopic_mass'], unique=False)
+
+    # Backfill masses for existing compounds
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.select(compound.c.id, compound.c.molecular_formula)).fetchall()
+    masses = []
+    for id, formula in rows:
+        masses.append({'b_id': id,
+                       'b_mass': formula_monoisotopic_mass(formula)})
+    if masses:
+        conn.execute(
+            compound.update()
+            .where(compound.c.id == sa.bindparam('b_id'))
+            .values(monoisotopic_mass=sa.bindparam('b_mass')),
+            masses)
+
+
+def downgrade():
+    with op.batch_alter_table('compound', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_compound_monoisotopic_mass'))
+        batch_op.drop_column('monoisotopic_mass')
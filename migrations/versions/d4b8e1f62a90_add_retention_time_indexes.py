@@ -0,0 +1,125 @@
+"""Add retention time indexes
+
+Revision ID: d4b8e1f62a90
+Revises: 6c0e9b45d8f3
+Create Date: 2026-10-18 15:48:52.216407
+
+"""
+import logging
+import os
+from alembic import op
+import sqlalchemy as sa
+
+logger = logging.getLogger('alembic.env')
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8e1f62a90'
+down_revision = '6c0e9b45d8f3'
+branch_labels = None
+depends_on = None
+
+
+def duplicate_retention_times(conn):
+    """Return rows of compounds recorded more than once for a run"""
+    return conn.execute(sa.text(
+        'SELECT retention_time.id, retention_time.standard_run_id, '
+        'retention_time.compound_id, compound.name, '
+        'retention_time.retention_time '
+        'FROM retention_time LEFT OUTER JOIN compound '
+        'ON retention_time.compound_id = compound.id '
+        'WHERE EXISTS (SELECT 1 FROM retention_time other '
+        'WHERE other.standard_run_id = retention_time.standard_run_id '
+        'AND other.compound_id = retention_time.compound_id '
+        'AND other.id != retention_time.id) '
+        'ORDER BY retention_time.standard_run_id, '
+        'retention_time.compound_id, retention_time.id')).fetchall()
+
+
+def upgrade():
+    # The unique constraint needs one retention time per compound and run.
+    # Duplicates are listed and the upgrade stops unless
+    # DROP_DUPLICATE_RETENTION_TIMES is set, in which case the first one
+    # recorded is kept and every row removed is logged.
+    conn = op.get_bind()
+    duplicates = duplicate_retention_times(conn)
+    groups = {}
+    for row in duplicates:
+        groups.setdefault((row.standard_run_id, row.compound_id),
+                          []).append(row)
+    drop = os.environ.get('DROP_DUPLICATE_RETENTION_TIMES') not in (
+        None, '', '0', 'false', 'False')
+    for (run_id, compound_id), rows in groups.items():
+        values = ['id {} ({})'.format(r.id, r.retention_time) for r in rows]
+        if drop:
+            logger.warning(
+                "Standard run %s, compound %s (%s): keeping %s, dropping %s",
+                run_id, compound_id, rows[0].name, values[0],
+                ', '.join(values[1:]))
+        else:
+            logger.error(
+                "Standard run %s, compound %s (%s) has retention times %s",
+                run_id, compound_id, rows[0].name, ', '.join(values))
+    if groups and not drop:
+        message = (
+            "{} compounds have more than one retention time for a standard "
+            "run (listed above). Remove the extra rows, or set "
+            "DROP_DUPLICATE_RETENTION_TIMES=1 to keep the first one "
+            "recorded, and upgrade again.".format(len(groups)))
+        logger.error(message)
+        raise RuntimeError(message)
+    dropped = [r.id for rows in groups.values() for r in rows[1:]]
+    for start in range(0, len(dropped), 500):
+        conn.execute(
+            sa.text('DELETE FROM retention_time WHERE id IN :ids')
+            .bindparams(sa.bindparam('ids', expanding=True)),
+            {'ids': dropped[start:start + 500]})
+    if dropped:
+        logger.warning("Dropped %d duplicate retention times", len(dropped))
+        op.execute('DELETE FROM retention_time_aggregate')
+        op.execute(
+            'INSERT INTO retention_time_aggregate (chromatography_method_id, '
+            'standard_run_id, compound_id, rt_sum, rt_count, rt_sum_squares, '
+            'rt_min, rt_max) '
+            'SELECT standard_run.chromatography_method_id, '
+            'retention_time.standard_run_id, retention_time.compound_id, '
+            'SUM(retention_time.retention_time), '
+            'COUNT(retention_time.retention_time), '
+            'SUM(retention_time.retention_time * '
+            'retention_time.retention_time), '
+            'MIN(retention_time.retention_time), '
+            'MAX(retention_time.retention_time) '
+            'FROM retention_time JOIN standard_run '
+            'ON retention_time.standard_run_id = standard_run.id '
+            'WHERE retention_time.retention_time IS NOT NULL '
+            'AND standard_run.chromatography_method_id IS NOT NULL '
+            'GROUP BY standard_run.chromatography_method_id, '
+            'retention_time.standard_run_id, retention_time.compound_id')
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('compoundlists', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_compoundlists_compound_list_id'), ['compound_list_id'], unique=False)
+
+    with op.batch_alter_table('retention_time', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_retention_time_compound_id'), ['compound_id'], unique=False)
+        batch_op.create_unique_constraint(batch_op.f('uq_retention_time_standard_run_id'), ['standard_run_id', 'compound_id'])
+
+    with op.batch_alter_table('standard_run', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_standard_run_chromatography_method_id'), ['chromatography_method_id'], unique=False)
+
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('standard_run', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_standard_run_chromatography_method_id'))
+
+    with op.batch_alter_table('retention_time', schema=None) as batch_op:
+        batch_op.drop_constraint(batch_op.f('uq_retention_time_standard_run_id'), type_='unique')
+        batch_op.drop_index(batch_op.f('ix_retention_time_compound_id'))
+
+    with op.batch_alter_table('compoundlists', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_compoundlists_compound_list_id'))
+
+    # ### end Alembic commands ###
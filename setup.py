@@ -7,5 +7,9 @@ setup(
     install_requires=[
         'flask',
         'flask_wtf',
+        'numpy',
     ],
+    extras_require={
+        'snapshot': ['pyarrow'],
+    },
 )
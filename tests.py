@@ -1,18 +1,85 @@
 #!/usr/bin/env python
-from datetime import datetime
+from datetime import datetime, timedelta
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import click
+import numpy
 import unittest
+from contextlib import contextmanager
+from flask.cli import ScriptInfo
+from sqlalchemy import event
 from config import Config
+from benchmarks.synthetic import SyntheticDataset
+from metabolite_database import command_profile
 from metabolite_database import create_app
 from metabolite_database import db
+from metabolite_database import cache
+from metabolite_database import cli
+from metabolite_database.annotate import ReferenceTable
+from metabolite_database.annotate import annotate_features
+from metabolite_database.annotate import read_feature_table
 from metabolite_database.models import Compound
+from metabolite_database.models import CompoundList
+from metabolite_database.models import Synonym
+from metabolite_database.models import parse_formula
+from metabolite_database.models import check_formula
+from metabolite_database.models import hill_order_warning
+from metabolite_database.matching import CompoundLookup
+from metabolite_database.name_search import name_search_backend
+from metabolite_database.name_search import search_compound_names
+from metabolite_database.jobs import claim_job
+from metabolite_database.jobs import run_job
+from metabolite_database.jobs import work
+from metabolite_database.models import Job
+from metabolite_database.models import formula_monoisotopic_mass
+from metabolite_database.models import normalize_compound_name
+from metabolite_database.models import validate_formulas
+from metabolite_database.importer import StandardRunExistsError
+from metabolite_database.importer import load_knowns
+from metabolite_database.importer import read_knowns_csv
+from metabolite_database.importer import read_manifest
+from metabolite_database.ions import build_ion_table
+from metabolite_database.mass_index import MassIndex
+from metabolite_database.mass_index import build_mass_index
+from metabolite_database.mass_index import current_mass_index
+from metabolite_database.models import bump_data_version
+from metabolite_database.models import data_versions
+from metabolite_database.snapshot import export_snapshot
+from metabolite_database.snapshot import import_snapshot
+from metabolite_database.search import search_ions
+from metabolite_database.search import search_mz
 from metabolite_database.models import ChromatographyMethod
 from metabolite_database.models import RetentionTime
 from metabolite_database.models import StandardRun
+from metabolite_database.models import refresh_retention_time_aggregates
+from metabolite_database.models import RetentionTimeAlignment
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    CACHE_TYPE = 'null'
+    MASS_INDEX_DIR = None
+
+
+@contextmanager
+def count_queries():
+    '''Collect the SQL statements executed within the block'''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
 
 
 class CompoundModelCase(unittest.TestCase):
@@ -36,6 +103,82 @@ class CompoundModelCase(unittest.TestCase):
         self.assertEqual(c.m_z(-1), 173.00916147370944)
         self.assertEqual(c.m_z(1), 175.02371437837056)
 
+    def test_normalize_compound_name(self):
+        self.assertEqual(normalize_compound_name("D-Glucose monohydrate"),
+                         "glucose")
+        self.assertEqual(normalize_compound_name("α-Ketoglutarate"),
+                         "alpha ketoglutarate")
+        self.assertEqual(normalize_compound_name("L-(+)-Lactic acid"),
+                         "lactic acid")
+        self.assertEqual(normalize_compound_name("citric acid · H2O"),
+                         "citric acid")
+        self.assertEqual(normalize_compound_name("Vitamin D"), "vitamin d")
+        c = Compound(name="2-Deoxy-D-ribose", molecular_formula="C5H10O4")
+        self.assertEqual(c.search_name, "2 deoxy ribose")
+
+    def test_parse_formula(self):
+        self.assertEqual(parse_formula("C6H6O6"), {'C': 6, 'H': 6, 'O': 6})
+        self.assertEqual(parse_formula("CH3COOH"),
+                         {'C': 2, 'H': 4, 'O': 2})
+        with self.assertRaises(AssertionError):
+            parse_formula("C6Z6O6")
+
+    def test_check_formula(self):
+        self.assertEqual(check_formula("C6H5ClO"),
+                         ({'C': 6, 'H': 5, 'Cl': 1, 'O': 1}, []))
+        self.assertEqual(check_formula("C4[13C]2H12O6")[0],
+                         {'C': 4, '[13C]': 2, 'H': 12, 'O': 6})
+        self.assertEqual(check_formula("BrNa")[1], [])
+        self.assertEqual(check_formula("CH3COOH")[1],
+                         ["'C' repeated", "'O' repeated", "'H' repeated"])
+        self.assertEqual(check_formula("H2OC")[1], [])
+        self.assertEqual(hill_order_warning("H2OC"),
+                         "not in Hill order, expected CH2O")
+        self.assertIsNone(hill_order_warning("C4[13C]2H12O6"))
+        self.assertIsNone(hill_order_warning("BrNa"))
+        self.assertEqual(check_formula("C6Zz6")[1], ["unknown atom 'Zz'"])
+        self.assertEqual(check_formula("C6H6O6+")[1], ["'+' not recognized"])
+        self.assertAlmostEqual(
+            formula_monoisotopic_mass("C4[13C]2H12O6")
+            - formula_monoisotopic_mass("C6H12O6"), 2.0067096756)
+        with self.assertRaises(AssertionError):
+            Compound(name="acetic acid", molecular_formula="CH3COOH")
+        c = Compound(name="phosphoric acid", molecular_formula="H3PO4")
+        self.assertAlmostEqual(c.monoisotopic_mass, 97.976895, places=5)
+
+    def test_validate_formulas(self):
+        masses, errors, warnings = validate_formulas(
+            ["C6H6O6", "", "C6Z6O6", "C6H6O6", "NaCl", "NH4Cl", "NaCl"])
+        self.assertAlmostEqual(masses[0], 174.01643792604)
+        self.assertEqual(masses[0], masses[3])
+        self.assertEqual(masses[1:3], [None, None])
+        self.assertAlmostEqual(masses[4], 57.95862196)
+        self.assertEqual([(e.row, e.formula) for e in errors],
+                         [(1, ""), (2, "C6Z6O6")])
+        self.assertEqual([(w.row, w.message) for w in warnings],
+                         [(4, "not in Hill order, expected ClNa"),
+                          (5, "not in Hill order, expected ClH4N"),
+                          (6, "not in Hill order, expected ClNa")])
+
+    def test_monoisotopic_mass_persisted(self):
+        c = Compound(name="aconitate",
+                     molecular_formula="C6H6O6")
+        db.session.add(c)
+        db.session.commit()
+        self.assertEqual(
+            Compound.query.filter(
+                Compound.monoisotopic_mass.between(174.0, 174.1)).one(), c)
+        c.molecular_formula = "C6H8O7"
+        db.session.commit()
+        self.assertAlmostEqual(c.monoisotopic_mass, 192.02700261, places=6)
+
+    def test_synthetic_formulas(self):
+        dataset = SyntheticDataset(num_compounds=50, seed=1)
+        self.assertEqual(dataset.compounds,
+                         SyntheticDataset(num_compounds=50, seed=1).compounds)
+        for name, formula in dataset.compounds:
+            Compound(name=name, molecular_formula=formula)
+
     def test_invalid_formula(self):
         with self.assertRaises(AssertionError):
             Compound(name="Invalid compound", molecular_formula="C6Z6O6")
@@ -57,5 +200,924 @@ class CompoundModelCase(unittest.TestCase):
         self.assertEqual(res_list[0], (c, rt))
 
 
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add_all([
+            Compound(name="aconitate", molecular_formula="C6H6O6"),
+            Compound(name="citrate", molecular_formula="C6H8O7"),
+            Compound(name="glucose", molecular_formula="C6H12O6")])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search_mz(self):
+        results = search_mz([173.009, 191.0197, 500.0], tolerance=5,
+                            mode=-1)
+        self.assertEqual([[m['name'] for m in r['matches']]
+                          for r in results],
+                         [['aconitate'], ['citrate'], []])
+        results = search_mz([175.0237], tolerance=0.001, unit='Da',
+                            mode='pos')
+        self.assertEqual(results[0]['matches'][0]['name'], "aconitate")
+        with self.assertRaises(ValueError):
+            search_mz([173.009], mode=2)
+
+    def test_mass_index(self):
+        directory = tempfile.mkdtemp()
+        self.app.config['MASS_INDEX_DIR'] = directory
+        path = build_mass_index(directory, 0)
+        index = MassIndex.load(path)
+        self.assertIsInstance(index.masses, numpy.memmap)
+        self.assertEqual([index.name(i) for i in range(len(index))],
+                         ["aconitate", "glucose", "citrate"])
+        self.assertEqual(index.formula(2), "C6H8O7")
+        self.assertIs(current_mass_index(), current_mass_index())
+        self.assertEqual(search_mz([191.0197], mode=-1)[0]['matches'][0]
+                         ['name'], "citrate")
+        Compound.query.delete()
+        bump_data_version()
+        db.session.commit()
+        self.assertEqual(len(current_mass_index()), 0)
+        self.assertEqual(sorted(os.listdir(directory)), ['v0', 'v1'])
+
+        # An index removed between the check and the load (here an empty
+        # directory) is built in memory instead
+        db.session.add(Compound(name="citrate", molecular_formula="C6H8O7"))
+        bump_data_version()
+        db.session.commit()
+        os.mkdir(os.path.join(directory, 'v2'))
+        self.assertEqual(len(current_mass_index()), 1)
+        self.assertEqual(search_mz([191.0197], mode=-1)[0]['matches'][0]
+                         ['name'], "citrate")
+        build_mass_index(directory, 3)
+        self.assertEqual(sorted(os.listdir(directory)), ['v2', 'v3'])
+        shutil.rmtree(directory)
+
+    def test_search_mz_api(self):
+        client = self.app.test_client()
+        response = client.get('/api/search/mz?mz=173.009,191.0197&mode=neg')
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual(results[1]['matches'][0]['name'], "citrate")
+        response = client.post('/api/search/mz',
+                               json={'mz': [181.0707], 'mode': 1})
+        self.assertEqual(
+            response.get_json()['results'][0]['matches'][0]['name'],
+            "glucose")
+        response = client.get('/api/search/mz?mz=173.009&unit=mmu')
+        self.assertEqual(response.status_code, 400)
+        for mz in ([None], [{'mz': 173.009}]):
+            response = client.post('/api/search/mz', json={'mz': mz})
+            self.assertEqual(response.status_code, 400)
+
+    def test_ion_table(self):
+        c = Compound.query.filter_by(name="aconitate").one()
+        table = build_ion_table([c.id], [c.molecular_formula])
+        ions = {(ion['adduct'], ion['isotopologue']): ion['m_z']
+                for ion in table.rows()}
+        self.assertAlmostEqual(ions[('[M+H]+', 'M+0')], c.m_z(1), places=9)
+        self.assertAlmostEqual(ions[('[M-H]-', 'M+0')], c.m_z(-1),
+                               places=9)
+        self.assertAlmostEqual(ions[('[M+Na]+', 'M+0')], 197.00565, places=4)
+        self.assertAlmostEqual(ions[('[M-2H]2-', 'M+1 13C')], 86.50262,
+                               places=4)
+        self.assertNotIn(('[M+H]+', 'M+1 15N'), ions)
+        self.assertNotIn(('[M+H]+', 'M+2 34S'), ions)
+        self.assertTrue(all(a <= b for a, b in zip(table.mz, table.mz[1:])))
+
+    def test_search_ions(self):
+        results = search_ions([197.00565, 174.0125], tolerance=5, mode='pos')
+        self.assertEqual([(m['name'], m['adduct'], m['isotopologue'])
+                          for m in results[0]['matches']],
+                         [("aconitate", "[M+Na]+", "M+0")])
+        self.assertEqual(results[1]['matches'], [])
+        results = search_ions([174.0125], tolerance=5, mode='neg')
+        self.assertEqual(results[0]['matches'][0]['adduct'], "[M-H]-")
+
+    def test_instrumentation(self):
+        client = self.app.test_client()
+        response = client.get('/compounds')
+        self.assertEqual(response.status_code, 200)
+        timing = response.headers['Server-Timing']
+        for part in ('sql;', 'template;', 'python;', 'total;'):
+            self.assertIn(part, timing)
+        self.app.config['SLOW_REQUEST_SECONDS'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            client.get('/compound/1')
+        self.assertIn('Slow request GET /compound/1', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+        self.assertEqual(client.get('/_metrics').status_code, 404)
+
+        class MetricsConfig(TestConfig):
+            METRICS_ENDPOINT = True
+            SLOW_REQUEST_SECONDS = 0
+        app = create_app(MetricsConfig)
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            with self.assertLogs(app.logger, 'WARNING'):
+                client.get('/compounds')
+            metrics = client.get('/_metrics').get_data(as_text=True)
+            self.assertIn('metabolite_database_requests_total{'
+                          'endpoint="main.compounds",method="GET",'
+                          'status="200"} 1', metrics)
+            self.assertIn('metabolite_database_slow_requests_total{'
+                          'endpoint="main.compounds"} 1', metrics)
+            self.assertEqual(client.get('/_metrics', environ_base={
+                'REMOTE_ADDR': '10.0.0.1'}).status_code, 403)
+            app.config['METRICS_TOKEN'] = 'secret'
+            self.assertEqual(client.get('/_metrics').status_code, 403)
+            self.assertEqual(client.get('/_metrics', environ_base={
+                'REMOTE_ADDR': '10.0.0.1'}, headers={
+                'Authorization': 'Bearer secret'}).status_code, 200)
+            db.session.remove()
+            db.drop_all()
+
+    def test_add_compound_list(self):
+        tmpdir = tempfile.mkdtemp()
+        synonyms = os.path.join(tmpdir, 'synonyms.csv')
+        with open(synonyms, 'w') as csvfh:
+            csvfh.write("citrate,citric acid,2-hydroxypropane-tricarboxylate\n"
+                        "unknown,something\n")
+        listfile = os.path.join(tmpdir, 'list.csv')
+        with open(listfile, 'w') as csvfh:
+            csvfh.write("1\nCitric Acid\nC6H12O6\nGlucose\naconitat\n"
+                        "C6H8O7\nnothing like it\n")
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['add-synonyms', synonyms])
+        self.assertIn("Added 2 synonyms", result.output)
+        result = runner.invoke(args=['add-compound-list', listfile, 'test'])
+        shutil.rmtree(tmpdir)
+        self.assertIn("Matched 'aconitat' to compound 1", result.output)
+        self.assertIn("Added 3 new compounds", result.output)
+        self.assertIn("Unable to find 1 compounds", result.output)
+        compound_list = CompoundList.query.filter_by(name='test').one()
+        self.assertEqual(sorted(c.name for c in compound_list.compounds),
+                         ['aconitate', 'citrate', 'glucose'])
+        lookup = CompoundLookup()
+        self.assertEqual(lookup.resolve('CITRIC ACID').method, 'synonym')
+        self.assertEqual(lookup.resolve('aconitate', fuzzy=False).method,
+                         'name')
+        self.assertIsNone(lookup.resolve('aconitat', fuzzy=False).compound_id)
+
+        client = self.app.test_client()
+        page = client.get('/compound_list/{}'.format(
+            compound_list.id)).get_data(as_text=True)
+        self.assertIn('/api/retention_time_matrix?compound_list_id=', page)
+        page = client.get('/compounds').get_data(as_text=True)
+        self.assertNotIn('retention times by method', page)
+
+    def test_search_compound(self):
+        db.session.add_all([
+            Compound(name="alpha-Ketoglutarate", molecular_formula="C5H6O5"),
+            Compound(name="Glucose-6-phosphate",
+                     molecular_formula="C6H13O9P")])
+        db.session.add(Synonym(compound_id=1, name="cis-Aconitic acid"))
+        db.session.commit()
+        self.assertEqual(name_search_backend(), 'fts5')
+        for backend in ('fts5', 'python'):
+            results = search_compound_names("Gluc", backend=backend)
+            self.assertEqual([(r['name'], r['match']) for r in results],
+                             [("glucose", 'prefix'),
+                              ("Glucose-6-phosphate", 'prefix')])
+            results = search_compound_names("α-ketoglutarate",
+                                            backend=backend)
+            self.assertEqual(results[0]['match'], 'exact')
+            results = search_compound_names("aconitic", backend=backend)
+            self.assertEqual((results[0]['name'], results[0]['synonym'],
+                              results[0]['match']),
+                             ("aconitate", True, 'word'))
+            results = search_compound_names("phosphate", backend=backend)
+            self.assertEqual(results[0]['match'], 'word')
+            results = search_compound_names("citrte", backend=backend)
+            self.assertEqual([(r['name'], r['match']) for r in results],
+                             [("citrate", 'fuzzy')])
+        compound = db.session.get(Compound, 3)
+        compound.name = "D-Glucose"
+        db.session.commit()
+        results = search_compound_names("glucose", limit=1)
+        self.assertEqual([(r['name'], r['match']) for r in results],
+                         [("D-Glucose", 'exact')])
+        client = self.app.test_client()
+        data = client.get('/api/search/compound?q=cit').get_json()
+        self.assertEqual([r['url'] for r in data['results']],
+                         ['/compound/2'])
+        response = client.get('/api/search/compound?q=cit&limit=500')
+        self.assertEqual(response.status_code, 400)
+
+    def test_compounds_api(self):
+        client = self.app.test_client()
+        params = {'draw': 3, 'start': 0, 'length': 2,
+                  'columns[0][data]': 'name',
+                  'columns[1][data]': 'monoisotopic_mass',
+                  'order[0][column]': 1, 'order[0][dir]': 'desc'}
+        data = client.get('/api/compounds', query_string=params).get_json()
+        self.assertEqual(data['draw'], 3)
+        self.assertEqual(data['recordsTotal'], 3)
+        self.assertEqual([c['name'] for c in data['data']],
+                         ["citrate", "glucose"])
+        params.update({'start': 2})
+        data = client.get('/api/compounds', query_string=params).get_json()
+        self.assertEqual([c['name'] for c in data['data']], ["aconitate"])
+        params.update({'start': 0, 'search[value]': 'C6H1'})
+        data = client.get('/api/compounds', query_string=params).get_json()
+        self.assertEqual(data['recordsFiltered'], 1)
+        self.assertEqual(data['data'][0]['name'], "glucose")
+        self.assertEqual(data['data'][0]['retention_time_count'], 0)
+
+
+class ImportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        fd, self.csvfile = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.25\n"
+                        "Citrate,C6H8O7,6.5\n"
+                        "glucose,C6H12O6,not a number\n"
+                        "bad compound,C6Z6O6,1.0\n"
+                        "citrate,C6H8O7,6.6\n")
+
+    def tearDown(self):
+        os.remove(self.csvfile)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_knowns(self):
+        db.session.add(Compound(name="Aconitate",
+                                molecular_formula="C6H6O6"))
+        db.session.commit()
+        knowns = read_knowns_csv(self.csvfile)
+        self.assertEqual(knowns.num_rows, 5)
+        result = load_knowns(knowns, "Test Method", datetime(2019, 1, 1),
+                             "Lance")
+        self.assertEqual(result.compounds_created, 2)
+        self.assertEqual(result.retention_times_created, 2)
+        self.assertEqual([row['Name'] for row, _ in result.bad_compounds],
+                         ["bad compound"])
+        self.assertEqual(
+            [row['Name'] for row, _ in result.bad_retention_times],
+            ["glucose", "citrate"])
+        self.assertEqual(Compound.query.count(), 3)
+        citrate = Compound.query.filter_by(
+            standardized_name="citrate").one()
+        self.assertEqual([rt.retention_time for rt in
+                          citrate.retention_times], [6.5])
+        self.assertIsNotNone(citrate.monoisotopic_mass)
+        with self.assertRaises(StandardRunExistsError):
+            load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                        datetime(2019, 1, 1), "Lance")
+
+    def test_import_non_hill_formula(self):
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "sodium chloride,NaCl,1.5\n"
+                        "phosphoric acid,H3PO4,2.5\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance")
+        self.assertEqual(result.retention_times_created, 2)
+        self.assertEqual(result.bad_compounds, [])
+        self.assertEqual([row['Name'] for row, _ in result.formula_warnings],
+                         ["sodium chloride", "phosphoric acid"])
+        self.assertEqual(Compound.query.filter_by(
+            name="phosphoric acid").one().molecular_formula, "H3PO4")
+
+    def test_upsert_knowns(self):
+        first = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                            datetime(2019, 1, 1), "Lance")
+        run_id = first.standard_run.id
+        again = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                            datetime(2019, 1, 1), "Lance", upsert=True)
+        self.assertTrue(again.unchanged)
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "Citrate,C6H8O7,6.4\n"
+                        "glucose,C6H12O6,7.0\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance", upsert=True)
+        self.assertFalse(result.unchanged)
+        self.assertEqual(result.standard_run.id, run_id)
+        self.assertEqual((result.retention_times_created,
+                          result.retention_times_updated,
+                          result.retention_times_deleted), (1, 1, 1))
+        means = {m.compound.name: m.mean_rt
+                 for m in result.method.retention_time_means()}
+        self.assertEqual(means, {'aconitate': None, 'Citrate': 6.4,
+                                 'glucose': 7.0})
+        self.assertEqual(StandardRun.query.count(), 1)
+
+    def test_upsert_conflicting_formula(self):
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 1, 1), "Lance")
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.5\n"
+                        "Citrate,C6H8O8,6.9\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance", upsert=True)
+        self.assertEqual([row['Name'] for row, _ in result.bad_compounds],
+                         ["Citrate"])
+        self.assertEqual((result.retention_times_created,
+                          result.retention_times_updated,
+                          result.retention_times_deleted), (0, 1, 0))
+        means = {m.compound.name: m.mean_rt
+                 for m in result.method.retention_time_means()}
+        self.assertEqual(means, {'aconitate': 5.5, 'Citrate': 6.5,
+                                 'glucose': None})
+
+    def test_upsert_rejected_rows(self):
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 1, 1), "Lance")
+        for citrate in ("Citrate,C6H8O7,oops", "Citrate,C6Z8O7,6.9"):
+            with open(self.csvfile, 'w') as csvfh:
+                csvfh.write("Name,Formula,RT\n"
+                            "aconitate,C6H6O6,5.5\n" + citrate + "\n")
+            result = load_knowns(read_knowns_csv(self.csvfile),
+                                 "Test Method", datetime(2019, 1, 1),
+                                 "Lance", upsert=True)
+            self.assertEqual(result.retention_times_deleted, 0)
+            means = {m.compound.name: m.mean_rt
+                     for m in result.method.retention_time_means()}
+            self.assertEqual(means, {'aconitate': 5.5, 'Citrate': 6.5,
+                                     'glucose': None})
+
+    def test_retention_time_means(self):
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 1, 1), "Lance")
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.75\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 2, 1), "Lance")
+        method = result.method
+        means = {m.compound.name: m for m in method.retention_time_means()}
+        self.assertEqual(means['aconitate'].mean_rt, 5.5)
+        self.assertAlmostEqual(means['aconitate'].sd_rt, 0.353553, places=6)
+        self.assertEqual(means['aconitate'].n_runs, 2)
+        self.assertEqual(means['Citrate'].mean_rt, 6.5)
+        self.assertIsNone(means['Citrate'].sd_rt)
+        self.assertIsNone(means['glucose'].mean_rt)
+        means = method.retention_time_means(
+            standard_run_ids=[result.standard_run.id])
+        self.assertEqual([m.mean_rt for m in means
+                          if m.compound.name == 'aconitate'], [5.75])
+
+    def test_retention_time_summaries(self):
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 1, 1), "Lance")
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.75\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 2, 1), "Lance")
+        aconitate = Compound.query.filter_by(name="aconitate").one()
+        summary, = aconitate.retention_time_summaries
+        self.assertEqual((summary.mean_rt, summary.median_rt,
+                          summary.n_runs), (5.5, 5.5, 2))
+        self.assertAlmostEqual(summary.sd_rt, 0.353553, places=6)
+        self.assertEqual(summary.last_run_date, datetime(2019, 2, 1))
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "citrate,C6H8O7,7.0\n")
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 2, 1), "Lance", upsert=True)
+        db.session.expire_all()
+        self.assertEqual(aconitate.retention_time_summaries[0].n_runs, 1)
+        client = self.app.test_client()
+        response = client.get('/api/retention_time_matrix')
+        self.assertEqual(response.status_code, 200)
+        matrix = response.get_json()
+        self.assertEqual(matrix['methods'],
+                         [{'id': result.method.id, 'name': "Test Method"}])
+        self.assertEqual(
+            {c['name']: c['summaries'][0]['median_rt']
+             for c in matrix['compounds']},
+            {'aconitate': 5.25, 'Citrate': 6.75})
+        response = client.get('/api/retention_time_matrix?compound_id=x')
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/compound/{}'.format(aconitate.id))
+        self.assertIn(b"Retention Times by Method", response.data)
+
+    def test_aligned_retention_time_means(self):
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.0\n"
+                        "citrate,C6H8O7,6.0\n"
+                        "glucose,C6H12O6,7.0\n")
+        first = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                            datetime(2019, 1, 1), "Lance")
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.5\n"
+                        "citrate,C6H8O7,6.5\n"
+                        "glucose,C6H12O6,7.5\n")
+        second = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 2, 1), "Lance")
+        method = second.method
+        self.assertEqual(method.reference_standard_run_id(),
+                         first.standard_run.id)
+        alignment = db.session.get(RetentionTimeAlignment,
+                                   second.standard_run.id)
+        self.assertEqual(alignment.num_shared_compounds, 3)
+        means = {m.compound.name: m for m in method.retention_time_means()}
+        self.assertAlmostEqual(means['citrate'].mean_rt, 6.25)
+        aligned = {m.compound.name: m for m in
+                   method.retention_time_means(aligned=True)}
+        self.assertAlmostEqual(aligned['citrate'].mean_rt, 6.0)
+        self.assertAlmostEqual(aligned['citrate'].sd_rt, 0.0)
+        self.assertEqual(aligned['citrate'].n_runs, 2)
+
+    def test_export_method(self):
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance")
+        client = self.app.test_client()
+        response = client.get('/method/{}/export?format=elmaven&mode=neg'
+                              .format(result.method.id))
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "compound,formula,RT,mz,charge")
+        self.assertIn("aconitate,C6H6O6,5.25,173.00916147370944,-1", lines)
+        self.assertEqual(len(lines), 4)
+        response = client.get('/method/{}/export?format=skyline'
+                              .format(result.method.id))
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_aligned_method(self):
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.0\n"
+                        "citrate,C6H8O7,6.0\n"
+                        "glucose,C6H12O6,7.0\n")
+        load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                    datetime(2019, 1, 1), "Lance")
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.5\n"
+                        "citrate,C6H8O7,6.5\n"
+                        "glucose,C6H12O6,7.5\n")
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 2, 1), "Lance")
+        client = self.app.test_client()
+        url = '/method/{}/export?mode=neg&aligned='.format(result.method.id)
+        for aligned, rt in (('0', '6.25'), ('false', '6.25'), ('', '6.25'),
+                            ('1', '6.0')):
+            lines = client.get(url + aligned).get_data(
+                as_text=True).splitlines()
+            self.assertEqual([line.split(',')[2] for line in lines
+                              if line.startswith('citrate,')], [rt])
+
+    def test_annotate(self):
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance")
+        features = read_feature_table(io.StringIO(
+            "feature\tmzmed\trtmed\tinto\n"
+            "F1\t173.0092\t5.3\t1000\n"
+            "F2\t191.0197\t9.0\t500\n"
+            "F3\t191.0199\t6.4\t\n"))
+        reference = ReferenceTable.for_method(result.method, -1)
+        self.assertEqual(len(reference), 2)
+        annotations = list(annotate_features(features, reference, ppm=5,
+                                             rt_tolerance=0.5,
+                                             block_size=2))
+        self.assertEqual([[c.name for c in candidates]
+                          for i, candidates in annotations],
+                         [['aconitate'], [], ['Citrate']])
+        self.assertAlmostEqual(annotations[2][1][0].rt_error, -0.1)
+        client = self.app.test_client()
+        response = client.post('/api/annotate', data={
+            'features': (io.BytesIO(b"mz,rt\n173.0092,5.3\n500.0,1.0\n"),
+                         'features.csv'),
+            'method': "Test Method", 'mode': 'neg', 'format': 'ndjson',
+            'unmatched': '1'})
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])['candidates'][0]['name'],
+                         "aconitate")
+        self.assertEqual(json.loads(lines[1])['candidates'], [])
+        response = client.post('/api/annotate', data={
+            'features': (io.BytesIO(b"mass,time\n1,2\n"), 'features.csv'),
+            'method': "Test Method"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cli_profile(self):
+        app = create_app(TestConfig, profile='cli')
+        self.assertEqual(app.blueprints, {})
+        self.assertNotIn('bootstrap', app.extensions)
+        self.assertIn('migrate', app.extensions)
+        cli.register(app)
+        with app.app_context():
+            db.create_all()
+            result = app.test_cli_runner().invoke(args=[
+                'import-csv', self.csvfile, 'Test Method', '2019-01-01',
+                'Lance'])
+            self.assertIn("Recorded 2 new Retention Times", result.output)
+            db.session.remove()
+        with self.assertRaises(ValueError):
+            create_app(TestConfig, profile='worker')
+
+    def test_command_profile(self):
+        self.assertIsNone(command_profile(['import-csv']))
+        with click.Context(click.Command('flask'), obj=ScriptInfo()):
+            self.assertEqual(command_profile(
+                ['--app', 'main.py', 'import-csv', 'run']), 'cli')
+            self.assertEqual(command_profile(['--help']), 'cli')
+            self.assertEqual(command_profile(['-A', 'main.py', 'run']),
+                             'web')
+            app = create_app(TestConfig)
+        self.assertEqual(app.config['APP_PROFILE'], 'cli')
+        self.assertEqual(app.blueprints, {})
+
+    def test_cached_pages(self):
+        self.app.config['CACHE_TYPE'] = 'lru'
+        cache.init_app(self.app)
+        client = self.app.test_client()
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance")
+        client.get('/methods')
+        with count_queries() as statements:
+            response = client.get('/methods')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        with open(self.csvfile, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\nglucose,C6H12O6,1.5\n")
+        load_knowns(read_knowns_csv(self.csvfile), "Other Method",
+                    datetime(2019, 1, 1), "Lance")
+        response = client.get('/methods')
+        self.assertIn(b"Other Method", response.data)
+        data = {'compoundlist': 0,
+                'standardruns': [result.standard_run.id]}
+        response = client.post('/method/{}'.format(result.method.id),
+                               data=data)
+        self.assertIn(b"C6H6O6", response.data)
+        with count_queries() as statements:
+            client.post('/method/{}'.format(result.method.id), data=data)
+        self.assertEqual(len(statements), 2)
+
+    def test_read_manifest(self):
+        fd, manifest = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write("csvfile,method,date,operator,notes\n"
+                     "{},Test Method,2019-01-01,Lance,first run\n"
+                     .format(os.path.basename(self.csvfile)))
+        runs = read_manifest(manifest)
+        os.remove(manifest)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['csvfile'], self.csvfile)
+        self.assertEqual(runs[0]['run_notes'], "first run")
+        self.assertIsNone(runs[0]['method_description'])
+
+    def test_import_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        second = os.path.join(tmpdir, 'second.csv')
+        with open(second, 'w') as csvfh:
+            csvfh.write("Name,Formula,RT\n"
+                        "aconitate,C6H6O6,5.75\n")
+        manifest = os.path.join(tmpdir, 'manifest.csv')
+        with open(manifest, 'w') as fh:
+            fh.write("csvfile,method,date,operator\n"
+                     "{},Test Method,2019-01-01,Lance\n"
+                     "second.csv,Test Method,2019-02-01,Lance\n"
+                     "missing.csv,Test Method,2019-03-01,Lance\n"
+                     .format(self.csvfile))
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(
+            args=['import-batch', manifest, '--jobs', '1'])
+        shutil.rmtree(tmpdir)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Imported 2 of 3 files", result.output)
+        self.assertIn("missing.csv", result.stderr)
+        self.assertEqual(sorted(run.date for run in StandardRun.query),
+                         [datetime(2019, 1, 1), datetime(2019, 2, 1)])
+        aconitate = Compound.query.filter_by(name="aconitate").one()
+        self.assertEqual(len(aconitate.retention_times), 2)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'),
+                         "pyarrow is not installed")
+    def test_snapshot(self):
+        result = load_knowns(read_knowns_csv(self.csvfile), "Test Method",
+                             datetime(2019, 1, 1), "Lance")
+        method_id = result.method.id
+        means = [(m.compound.name, m.mean_rt)
+                 for m in result.method.retention_time_means()]
+        directory = tempfile.mkdtemp()
+        for output_format in ('arrow', 'parquet'):
+            path = os.path.join(directory, output_format)
+            counts = export_snapshot(path, output_format, batch_size=2)
+            self.assertEqual(counts['compound'], 3)
+            self.assertEqual(counts['retention_time'], 2)
+        with self.assertRaises(ValueError):
+            import_snapshot(os.path.join(directory, 'arrow'))
+        for output_format in ('arrow', 'parquet'):
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            counts = import_snapshot(os.path.join(directory, output_format))
+            self.assertEqual(counts['standard_run'], 1)
+            method = db.session.get(ChromatographyMethod, method_id)
+            self.assertEqual([(m.compound.name, m.mean_rt)
+                              for m in method.retention_time_means()], means)
+            self.assertEqual(data_versions(['global']), (1,))
+        shutil.rmtree(directory)
+
+
+class DatabaseProfileCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir, 'primary.db')
+            DATABASE_REPLICA_URL = 'sqlite:///' + os.path.join(
+                self.tmpdir, 'replica.db')
+            DATABASE_PROFILE = 'tuned'
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.metadata.create_all(self.app.extensions['replica_engine'])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqlite_pragmas(self):
+        with db.engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+
+    def test_get_routes_read_replica(self):
+        with self.app.extensions['replica_engine'].begin() as conn:
+            conn.execute(Compound.__table__.insert(), {
+                'name': 'citrate', 'standardized_name': 'citrate',
+                'molecular_formula': 'C6H8O7'})
+        client = self.app.test_client()
+        self.assertEqual(client.get('/compound/1').status_code, 200)
+        self.assertEqual(Compound.query.count(), 0)
+
+
+class JobCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class JobConfig(TestConfig):
+            UPLOAD_DIR = self.tmpdir
+        self.app = create_app(JobConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upload_knowns(self):
+        client = self.app.test_client()
+        csvdata = (b"Name,Formula,RT\n"
+                   b"aconitate,C6H6O6,5.25\n"
+                   b"glucose,C6H12O6,not a number\n")
+        response = client.post('/upload', data={
+            'knowns-csvfile': (io.BytesIO(csvdata), 'knowns.csv'),
+            'knowns-method': 'Test Method',
+            'knowns-date': '2019-01-01',
+            'knowns-operator': 'Lance',
+            'knowns-submit': 'Upload Knowns'},
+            content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 302)
+        job_id = Job.query.one().id
+        self.assertEqual(client.get('/api/job/{}'.format(job_id))
+                         .get_json()['status'], 'queued')
+
+        self.assertEqual(work('test', once=True), 1)
+        data = client.get('/api/job/{}'.format(job_id)).get_json()
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(data['result']['retention_times_created'], 1)
+        self.assertEqual(
+            [e['row']['Name'] for e in data['result']['bad_retention_times']],
+            ['glucose'])
+        page = client.get('/job/{}'.format(job_id)).get_data(as_text=True)
+        self.assertIn('not a number', page)
+        self.assertEqual(RetentionTime.query.count(), 1)
+
+        # The same run cannot be imported twice without upsert
+        client.post('/upload', data={
+            'knowns-csvfile': (io.BytesIO(csvdata), 'knowns.csv'),
+            'knowns-method': 'Test Method',
+            'knowns-date': '2019-01-01',
+            'knowns-operator': 'Lance',
+            'knowns-submit': 'Upload Knowns'},
+            content_type='multipart/form-data')
+        work('test', once=True)
+        job = Job.query.order_by(Job.id.desc()).first()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('already exists', job.error)
+
+    def test_reap_stale_jobs(self):
+        now = datetime.utcnow()
+        stale = Job(kind='knowns', status='running', worker='gone:1',
+                    started=now - timedelta(hours=2),
+                    heartbeat=now - timedelta(hours=1))
+        running = Job(kind='knowns', status='running', worker='busy:2',
+                      started=now - timedelta(hours=2), heartbeat=now)
+        db.session.add_all([stale, running])
+        db.session.commit()
+        stale_id, running_id = stale.id, running.id
+
+        # Reading the status changes nothing
+        data = self.app.test_client().get(
+            '/api/job/{}'.format(stale_id)).get_json()
+        self.assertEqual(data['status'], 'running')
+
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['reap-jobs'])
+        self.assertIn("Marked 1 jobs failed", result.output)
+        stale = db.session.get(Job, stale_id)
+        self.assertEqual(stale.status, 'failed')
+        self.assertIn('no heartbeat', stale.error)
+        self.assertIsNotNone(stale.finished)
+        self.assertEqual(db.session.get(Job, running_id).status, 'running')
+
+    def test_reaped_job_result_not_recorded(self):
+        client = self.app.test_client()
+        client.post('/upload', data={
+            'knowns-csvfile': (io.BytesIO(b"Name,Formula,RT\n"
+                                          b"aconitate,C6H6O6,5.25\n"),
+                               'knowns.csv'),
+            'knowns-method': 'Test Method',
+            'knowns-date': '2019-01-01',
+            'knowns-operator': 'Lance',
+            'knowns-submit': 'Upload Knowns'},
+            content_type='multipart/form-data')
+        job = claim_job('test')
+        self.assertIsNotNone(job.heartbeat)
+        # Reaped while the worker was still running it
+        job.status = 'failed'
+        db.session.commit()
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            job = run_job(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertIsNone(job.result)
+
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        compound_list = CompoundList(name="list")
+        method = ChromatographyMethod(name="Test Method")
+        run = StandardRun(date=datetime(2019, 1, 1), operator="Lance",
+                          chromatography_method=method)
+        for i in range(10):
+            compound = Compound(name="compound {}".format(i),
+                                molecular_formula="C6H12O6")
+            compound_list.compounds.append(compound)
+            db.session.add(RetentionTime(compound=compound, standard_run=run,
+                                         retention_time=i))
+        db.session.add_all([compound_list, method, run])
+        db.session.commit()
+        refresh_retention_time_aggregates([run.id])
+        db.session.commit()
+        self.method_id, self.run_id = method.id, run.id
+        self.compound_list_id = compound_list.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def full_scans(self, function):
+        '''Return names of tables scanned by the SELECTs `function` runs'''
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            function()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        scans = set()
+        connection = db.session.connection()
+        for statement, parameters in statements:
+            for row in connection.exec_driver_sql(
+                    'EXPLAIN QUERY PLAN ' + statement, parameters):
+                detail = row[-1].split()
+                if detail[0] == 'SCAN':
+                    scans.add(detail[1])
+        return scans
+
+    def test_retention_time_means_plan(self):
+        method = db.session.get(ChromatographyMethod, self.method_id)
+        # Every compound is listed, so only the compound table is scanned
+        self.assertEqual(self.full_scans(method.retention_time_means),
+                         {'compound'})
+        self.assertEqual(self.full_scans(
+            lambda: method.retention_time_means(
+                standard_run_ids=[self.run_id],
+                compound_list_id=self.compound_list_id)), set())
+
+    def test_compounds_with_retention_times_plan(self):
+        method = db.session.get(ChromatographyMethod, self.method_id)
+        self.assertEqual(self.full_scans(
+            lambda: method.compounds_with_retention_times().all()), set())
+        self.assertEqual(self.full_scans(
+            lambda: method.unique_compounds_with_retention_times(
+                [self.run_id]).all()), set())
+
+
+class RouteQueryCountCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        db.session.add_all([ChromatographyMethod(name="Test Method"),
+                            CompoundList(name="Test List")])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_data(self, num_compounds):
+        method = ChromatographyMethod.query.one()
+        compound_list = CompoundList.query.one()
+        offset = Compound.query.count()
+        runs = [StandardRun(date=datetime(2019, 1, day + 1 + offset),
+                            operator="Lance",
+                            chromatography_method=method)
+                for day in range(2)]
+        db.session.add_all(runs)
+        for i in range(offset, offset + num_compounds):
+            c = Compound(name="compound {}".format(i),
+                         molecular_formula="C{}H6O6".format(i + 1))
+            compound_list.compounds.append(c)
+            for run in runs:
+                run.retention_times.append(
+                    RetentionTime(compound=c, retention_time=float(i)))
+        db.session.add_all(runs)
+        db.session.commit()
+        refresh_retention_time_aggregates([r.id for r in runs])
+        db.session.commit()
+
+    def query_counts(self):
+        requests = [
+            ('get', '/compounds', {}),
+            ('get', '/api/compounds?compound_list_id=1&length=100', {}),
+            ('get', '/compound/1', {}),
+            ('get', '/compound_lists', {}),
+            ('get', '/compound_list/1', {}),
+            ('get', '/methods', {}),
+            ('get', '/method/1', {}),
+            ('post', '/method/1',
+             {'data': {'compoundlist': 0, 'standardruns': [1, 2],
+                       'submit': 'Get List'}}),
+            ('get', '/standard_runs', {}),
+            ('get', '/standard_run/1', {})]
+        counts = {}
+        for method, url, kwargs in requests:
+            db.session.expunge_all()
+            with count_queries() as statements:
+                response = getattr(self.client, method)(url, **kwargs)
+            self.assertEqual(response.status_code, 200, url)
+            counts[(method, url)] = len(statements)
+        return counts
+
+    def test_query_counts_do_not_grow_with_rows(self):
+        self.add_data(3)
+        small = self.query_counts()
+        self.add_data(12)
+        large = self.query_counts()
+        self.assertEqual(small, large)
+        for request, count in large.items():
+            self.assertLessEqual(count, 6, request)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)